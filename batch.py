@@ -0,0 +1,341 @@
+# batch.py
+#
+# Headless batch analysis of recorded spectra.
+#
+#   python batch.py ~/ImpulseQtData --out results --workers 8
+#   python batch.py a.json b_hmp.json --format json --identify --export-spectrum
+#
+# Every NPES .json (2D) and _hmp.json / .jsonl (3D, analysed as the sum of
+# all rows) is processed in a worker process: peak search, ROI table around
+# the peaks found, isotope matches from a flag library and, optionally,
+# template-matrix nuclide identification. Results go to summary + peaks CSV
+# files (or one results.json); per-file spectrum CSVs and 3D per-row ROI
+# sums can be exported alongside. 3D recordings are read through a .wfb
+# memory map built in the output directory (reused on the next run), so the
+# input folders are never written. No window is opened, so it runs on a
+# server without a display.
+
+import os
+import sys
+import csv
+import json
+import argparse
+
+os.environ.setdefault("IMPULSEQT_HEADLESS", "1")    # shared: no Qt for the data paths
+
+import numpy as np
+
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import jsonio
+import snip
+import catalog
+import calibration
+import roi_stats
+import peak_search
+import isotope_index
+import nuclide_id
+import waterfall_mmap
+
+from shared import logger
+
+MAX_PEAKS   = 12
+SUMMARY_KEYS = ["file", "kind", "bins", "counts", "elapsed", "start_time",
+                "coefficients", "peaks", "identified", "error"]
+PEAK_KEYS    = ["file", "roi", "i0", "i1", "centroid", "energy", "fwhm_energy",
+                "resolution", "gross", "net", "isotopes"]
+
+
+# ------------------------------------------------------------
+# Input
+# ------------------------------------------------------------
+INPUT_KINDS  = ("spectrum", "3d", "store")
+
+
+def find_files(paths, recursive=False):
+    """
+    Spectrum files under the given files / directories, sorted and unique.
+    Directories yield only what the catalog counts as a spectrum or 3D
+    recording (no _cps, _user or settings files); a .jsonl store is skipped
+    when its _hmp.json export exists.
+    """
+    out = []
+    for p in map(Path, paths):
+        if p.is_dir():
+            pattern = "**/*" if recursive else "*"
+            for f in p.glob(pattern + ".json*"):
+                kind = catalog.classify(f.name)
+                if kind not in INPUT_KINDS:
+                    continue
+                if kind == "store" and f.with_suffix(".json").exists():
+                    continue
+                out.append(f)
+        elif p.exists():
+            out.append(p)
+    return sorted(set(out))
+
+
+def _is_3d(path):
+    return path.name.endswith(("_hmp.json", "_hmp.jsonl"))
+
+
+def read_spectrum(path, out=None):
+    """
+    Dict with kind, histogram, coeffs ([c1, c2, c3]), counts, elapsed,
+    start_time, plus `map` (WaterfallMap) for 3D recordings. The .wfb of a
+    3D recording goes to `out` (default: the app's .wfb cache).
+    """
+    path = Path(path)
+    if _is_3d(path):
+        json_path = path.with_suffix(".json") if path.suffix == ".jsonl" else path
+        wfb = Path(out) / waterfall_mmap.wfb_name(json_path.name) if out else None
+        wm  = waterfall_mmap.open_map(json_path, wfb)
+        if wm is None:
+            raise ValueError("not a 3D recording")
+        total = np.zeros(wm.bins, dtype=np.int64)
+        for _, block in wm.iter_chunks():
+            total += block.sum(axis=0, dtype=np.int64)
+        return {
+            "kind":       "3d",
+            "histogram":  total,
+            "coeffs":     wm.coeffs,
+            "counts":     int(total.sum()),
+            "elapsed":    wm.header.get("measurementTime", 0),
+            "start_time": wm.header.get("startTime", ""),
+            "map":        wm,
+        }
+
+    data = jsonio.load(path)
+    if not isinstance(data, dict):
+        raise ValueError("not an NPES spectrum")
+    if data.get("schemaVersion") == "NPESv2":
+        data = data["data"][0]
+    result = data["resultData"]
+    es     = result["energySpectrum"]
+    coeffs = es.get("energyCalibration", {}).get("coefficients", [0, 1, 0])
+    y      = np.asarray(es["spectrum"], dtype=float)
+    if y.ndim != 1:
+        raise ValueError("3D data in a 2D file name")
+    return {
+        "kind":       "2d",
+        "histogram":  y,
+        "coeffs":     [coeffs[2], coeffs[1], coeffs[0]],   # NPES [c3, c2, c1] -> [c1, c2, c3]
+        "counts":     int(y.sum()),
+        "elapsed":    es.get("measurementTime", 0),
+        "start_time": result.get("startTime", ""),
+    }
+
+
+_library = (None, None)     # per worker process: (path, IsotopeIndex)
+
+
+def _flag_index(path):
+    """IsotopeIndex for a flag table ({"rows": [...]} or a plain list), cached per process."""
+    global _library
+    if not path:
+        return None
+    if _library[0] == path:
+        return _library[1]
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        rows = data if isinstance(data, list) else (data.get("rows") or data.get("data") or [])
+    except Exception as e:
+        logger.error(f"  ❌ batch reading isotope table '{path}': {e}")
+        rows = []
+    _library = (path, isotope_index.IsotopeIndex(rows))
+    return _library[1]
+
+
+# ------------------------------------------------------------
+# Analysis (runs in the worker processes)
+# ------------------------------------------------------------
+def analyse(path, opts):
+    """Summary dict (with a "peaks" list) for one file; never raises."""
+    path    = Path(path)
+    summary = {"file": str(path), "kind": "", "peaks": [], "error": ""}
+    try:
+        spec = read_spectrum(path, opts["out"])
+    except Exception as e:
+        summary["error"] = f"unreadable: {e}"
+        return summary
+
+    y      = np.asarray(spec["histogram"], dtype=float)
+    coeffs = [float(c) for c in spec["coeffs"]]
+    n      = len(y)
+    cal    = n > 1 and all(np.isfinite(coeffs)) and any(coeffs)
+    summary.update(kind=spec["kind"], bins=n, counts=spec["counts"], elapsed=spec["elapsed"],
+                   start_time=spec["start_time"], coefficients=coeffs)
+    if n < 5:
+        return summary
+
+    found = peak_search.engine.search(y, prominence=opts["prominence"],
+                                      min_width=max(1e-3, opts["min_width"]),
+                                      smoothing_window=opts["smoothing"])
+    # strongest peaks first, so noise at low channels does not crowd them out
+    found = sorted(found, key=lambda pk: pk["prominence"], reverse=True)[:opts["max_peaks"]]
+    rois  = []
+    for pk in sorted(found, key=lambda pk: pk["index"]):
+        w = int(max(2, round(pk["fwhm"])))
+        rois.append((max(0, pk["index"] - w), min(n - 1, pk["index"] + w)))
+
+    stats = roi_stats.roi_table(y, rois, coeffs if cal else None)
+    if opts["net"] == "snip" and rois:
+        stats["net"] = stats["gross"] - roi_stats.range_sums(snip.background(y), rois)
+
+    # isotope lines near each centroid (same tolerance as the ROI table)
+    matches = [[] for _ in rois]
+    index   = _flag_index(opts["library"])
+    if cal and index is not None and len(index) and rois:
+        c      = calibration.for_coeffs(coeffs, n)
+        energy = np.asarray(stats["energy"], dtype=float)
+        fw_kev = np.where(np.isfinite(stats["fwhm"]), np.abs(c.slope(stats["centroid"])) * stats["fwhm"], 0.0)
+        for k, ranked in enumerate(index.match(energy, isotope_index.tolerance(energy, fw_kev), top=3)):
+            matches[k] = [f"{row.get('isotope', '')} {e:.1f}" for _, _, e, row in ranked]
+
+    for k, (i0, i1) in enumerate(rois):
+        summary["peaks"].append({
+            "roi":         k + 1,
+            "i0":          int(i0),
+            "i1":          int(i1),
+            "centroid":    round(float(stats["centroid"][k]), 2),
+            "energy":      round(float(stats["energy"][k]), 3),
+            "fwhm_energy": round(float(stats["fwhm_energy"][k]), 3),
+            "resolution":  round(float(stats["resolution"][k]), 2),
+            "gross":       int(round(float(stats["gross"][k]))),
+            "net":         int(round(float(stats["net"][k]))),
+            "isotopes":    "; ".join(matches[k]),
+        })
+
+    if opts["identify"] and cal:
+        ranked = nuclide_id.identify(y, coeffs, top=5)
+        summary["identified"] = "; ".join(f"{r['nuclide']} {r['confidence'] * 100:.0f}%"
+                                          for r in ranked if r["confidence"] >= 0.5)
+
+    try:
+        _export(path, spec, rois, coeffs if cal else None, opts)
+    except Exception as e:
+        summary["error"] = f"export failed: {e}"
+    return summary
+
+
+def _export(path, spec, rois, coeffs, opts):
+    out  = Path(opts["out"])
+    stem = path.name[:-len(path.suffix)]
+
+    if opts["export_spectrum"]:
+        y = np.asarray(spec["histogram"])
+        with open(out / f"{stem}.csv", "w", newline="") as fh:
+            writer = csv.writer(fh)
+            if coeffs is not None:
+                writer.writerow(["Energy", "Counts"])
+                writer.writerows(zip(np.round(calibration.for_coeffs(coeffs, len(y)).energies, 3),
+                                     y.astype(np.int64).tolist()))
+            else:
+                writer.writerow(["Bin", "Counts"])
+                writer.writerows(enumerate(y.astype(np.int64).tolist()))
+
+    wm = spec.get("map")
+    if opts["export_rows"] and wm is not None and rois:
+        sums = wm.roi_sums(rois, net=opts["net"] == "snip")
+        with open(out / f"{stem}_roi_rows.csv", "w", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["Time Step"] + [f"ROI {k + 1} ({i0}-{i1})" for k, (i0, i1) in enumerate(rois)])
+            for k, row in enumerate(sums.tolist()):
+                writer.writerow([k] + row)
+
+
+# ------------------------------------------------------------
+# Output
+# ------------------------------------------------------------
+def write_results(results, out, fmt):
+    out = Path(out)
+    if fmt == "json":
+        with open(out / "results.json", "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=1, default=str)
+        return [out / "results.json"]
+
+    with open(out / "summary.csv", "w", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=SUMMARY_KEYS, extrasaction="ignore")
+        writer.writeheader()
+        for r in results:
+            writer.writerow({**r, "peaks": len(r.get("peaks", []))})
+
+    with open(out / "peaks.csv", "w", newline="") as fh:
+        writer = csv.DictWriter(fh, fieldnames=PEAK_KEYS, extrasaction="ignore")
+        writer.writeheader()
+        for r in results:
+            for pk in r.get("peaks", []):
+                writer.writerow({"file": r["file"], **pk})
+    return [out / "summary.csv", out / "peaks.csv"]
+
+
+# ------------------------------------------------------------
+# CLI
+# ------------------------------------------------------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Headless batch analysis of ImpulseQt spectra")
+    ap.add_argument("paths", nargs="+",                        help="spectrum files or directories")
+    ap.add_argument("--out",        default="batch_results",  help="output directory")
+    ap.add_argument("--format",     choices=("csv", "json"), default="csv")
+    ap.add_argument("--workers",    type=int,   default=os.cpu_count() or 1)
+    ap.add_argument("--recursive",  action="store_true",       help="search directories recursively")
+    ap.add_argument("--prominence", type=float, default=10.0,  help="peak search prominence (counts)")
+    ap.add_argument("--min-width",  type=float, default=2.0,   help="minimum peak FWHM (channels)")
+    ap.add_argument("--smoothing",  type=int,   default=3,     help="peak search smoothing window")
+    ap.add_argument("--max-peaks",  type=int,   default=MAX_PEAKS)
+    ap.add_argument("--net",        choices=("linear", "snip"), default="linear",
+                                                               help="ROI net counts background")
+    ap.add_argument("--library",    default="",                help="isotope flag table (lib/*.json) for matches")
+    ap.add_argument("--identify",   action="store_true",       help="template-matrix nuclide identification")
+    ap.add_argument("--export-spectrum", action="store_true",  help="write <name>.csv per spectrum")
+    ap.add_argument("--export-rows",     action="store_true",  help="write <name>_roi_rows.csv per 3D file")
+    args = ap.parse_args(argv)
+
+    files = find_files(args.paths, args.recursive)
+    if not files:
+        logger.warning("👆 batch: no spectrum files found")
+        return 1
+
+    out = Path(args.out)
+    out.mkdir(parents=True, exist_ok=True)
+    opts = {
+        "out":             str(out),
+        "prominence":      args.prominence,
+        "min_width":       args.min_width,
+        "smoothing":       args.smoothing,
+        "max_peaks":       args.max_peaks,
+        "net":             args.net,
+        "library":         args.library,
+        "identify":        args.identify,
+        "export_spectrum": args.export_spectrum,
+        "export_rows":     args.export_rows,
+    }
+
+    logger.info(f"   ✅ batch: {len(files)} files, {args.workers} workers")
+    work    = partial(analyse, opts=opts)
+    results = []
+    if args.workers <= 1:
+        results = [work(f) for f in files]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {pool.submit(work, f): f for f in files}
+            for done, fut in enumerate(as_completed(futures), 1):
+                try:
+                    results.append(fut.result())
+                except Exception as e:
+                    results.append({"file": str(futures[fut]), "peaks": [], "error": str(e)})
+                if done % 100 == 0:
+                    logger.info(f"   ✅ batch: {done}/{len(files)}")
+    results.sort(key=lambda r: r["file"])
+
+    written = write_results(results, out, args.format)
+    failed  = sum(1 for r in results if r.get("error"))
+    logger.info(f"   ✅ batch: wrote {', '.join(str(p) for p in written)} ({failed} failed)")
+    return 0 if not failed else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
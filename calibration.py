@@ -0,0 +1,121 @@
+# calibration.py
+#
+# Channel <-> energy lookup tables for a calibration polynomial.
+#
+# A Calibration precomputes, for one coefficient set [c1, c2, c3] (x^2 first,
+# as in shared.coeff_1..3) and bin count, the energy of every channel and of
+# every bin edge. Drawing an axis is then a table read, and the inverse
+# (energy -> fractional channel) is a searchsorted on the monotonic table
+# plus one Newton step, instead of np.roots per mouse event.
+#
+# for_coeffs() hands out one shared, read-only Calibration per
+# (coefficients, bins); a new one is only built when the coefficients or the
+# bin count change. Non-monotonic calibrations fall back to the polynomial
+# roots, as before.
+
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+CACHE_SIZE = 8
+
+
+class Calibration:
+
+    def __init__(self, coeffs, bins):
+        self.coeffs = tuple(float(c) for c in coeffs)
+        self.bins   = max(0, int(bins))
+
+        ch = np.arange(self.bins, dtype=float)
+        self.energies = np.polyval(self.coeffs, ch)
+        self.edges    = np.polyval(self.coeffs, np.arange(self.bins + 1, dtype=float) - 0.5)
+        self.energies.flags.writeable = False
+        self.edges.flags.writeable    = False
+
+        d = np.diff(self.energies)
+        self.increasing = bool(self.bins > 1 and np.all(d > 0))
+        self._top = float(np.polyval(self.coeffs, self.bins))     # energy at channel `bins`
+        self._axis = None
+
+    def axis(self):
+        """Energies of channels 0..bins-1 as a list (built once)."""
+        if self._axis is None:
+            self._axis = self.energies.tolist()
+        return self._axis
+
+    def energy(self, channels):
+        """Energy at (fractional) channels; integer channels in range are table reads."""
+        x = np.asarray(channels, dtype=float)
+        if x.ndim == 0:
+            k = int(x)
+            if k == x and 0 <= k < self.bins:
+                return float(self.energies[k])
+            return float(np.polyval(self.coeffs, x))
+        return np.polyval(self.coeffs, x)
+
+    def slope(self, channels):
+        """dE/dx (keV per channel)."""
+        a, b, _ = self.coeffs
+        return 2.0 * a * np.asarray(channels, dtype=float) + b
+
+    def channel(self, energy):
+        """
+        Fractional channel in [0, bins) with this energy, or None. Same answer
+        as the polynomial root in range, found on the table.
+        """
+        if not self.bins:
+            return None
+        e = float(energy)
+        if not self.increasing:
+            return self._root(e)
+
+        E = self.energies
+        if e < E[0] or e >= self._top:
+            return None
+        k = int(np.searchsorted(E, e, side="right")) - 1
+        k = min(max(k, 0), self.bins - 2)
+        x = k + (e - E[k]) / (E[k + 1] - E[k])
+        s = float(self.slope(x))
+        if s:
+            x -= (float(np.polyval(self.coeffs, x)) - e) / s     # polish the linear guess
+        return float(x) if 0.0 <= x < self.bins else None
+
+    def channels(self, energies):
+        """Vectorised channel() for monotonic calibrations (NaN outside the table)."""
+        e = np.asarray(energies, dtype=float)
+        if not self.increasing:
+            roots = [self._root(v) for v in e.ravel()]
+            return np.array([np.nan if r is None else r for r in roots]).reshape(e.shape)
+        x = np.interp(e, self.energies, np.arange(self.bins, dtype=float), left=np.nan, right=np.nan)
+        s = self.slope(x)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x = np.where(s != 0, x - (np.polyval(self.coeffs, x) - e) / s, x)
+        return x
+
+    def _root(self, e):
+        roots = np.roots(np.poly1d(self.coeffs) - e)
+        real  = roots[np.isreal(roots)].real
+        valid = [r for r in real if 0 <= r < self.bins]
+        return float(valid[0]) if valid else None
+
+
+_lock  = threading.Lock()
+_cache = OrderedDict()
+
+
+def for_coeffs(coeffs, bins):
+    """Shared Calibration for these coefficients and bin count."""
+    key = (tuple(float(c) for c in coeffs), int(bins))
+    with _lock:
+        cal = _cache.get(key)
+        if cal is not None:
+            _cache.move_to_end(key)
+            return cal
+    cal = Calibration(key[0], key[1])
+    with _lock:
+        _cache[key] = cal
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return cal
@@ -2,6 +2,7 @@
 import shared
 import numpy as np
 import json
+import jsonio
 
 from qt_compat import QDialog
 from qt_compat import QVBoxLayout
@@ -92,8 +93,7 @@ class CalibrationPopup(QDialog):
 
                 # Load existing JSON
                 if file_path.exists():
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        data = json.load(f)
+                    data = jsonio.load(file_path)
                 else:
                     logger.error(f"  ❌ calibration file {file_path} not found")
                     return
@@ -115,8 +115,7 @@ class CalibrationPopup(QDialog):
                 # ]
 
                 # Save updated file
-                with open(file_path, "w", encoding="utf-8") as f:
-                    json.dump(data, f)
+                jsonio.save(file_path, data, "json")
 
                 logger.info(f"   ✅ Calibration updated {file_path}")
 
@@ -0,0 +1,349 @@
+# catalog.py
+#
+# SQLite catalog of the recordings in USER_DATA_DIR.
+#
+# One row per file with the NPES header fields (times, device, channels,
+# counts, measurement time, calibration, note) and GPS bounds for 3D files.
+# refresh() lists the folder, compares mtime/size with what is stored and
+# only opens files that are new or changed, reading the JSON only up to the
+# "spectrum" rows (jsonio.load_head); rows of deleted files are
+# removed. A query refreshes only the kind it asks for, and files of a run
+# that is still recording (its .run marker exists) are not read until the
+# run has finished; they are listed by name only meanwhile. The file
+# pickers call options(kind) instead of globbing, and search() finds
+# recordings by date, device, duration or counts.
+
+import os
+import csv
+import json
+import sqlite3
+import threading
+
+import numpy as np
+
+from pathlib import Path
+
+import shared
+import jsonio
+import waterfall_store
+from shared import logger
+
+DB_NAME = "_catalog.sqlite"
+TAIL_GPS_BYTES = 16 << 20       # end of an older _hmp.json searched for its gps list
+SCHEMA_VERSION = 1
+
+_lock = threading.Lock()
+
+_COLUMNS = (
+    "path", "kind", "stem", "mtime", "size",
+    "start_time", "end_time", "device", "channels", "counts", "measurement_time",
+    "coefficients", "note", "lat_min", "lat_max", "lon_min", "lon_max", "ok",
+)
+
+
+def db_path(folder=None):
+    return Path(folder or shared.USER_DATA_DIR) / DB_NAME
+
+
+def classify(name):
+    """Catalog kind for a file name, or None if it is not a recording."""
+    if name.endswith("_hmp.json"):
+        return "3d"
+    if name.endswith("_hmp.jsonl"):
+        return "store"
+    if name.endswith(("_cps.json", "-cps.json", "_cps.csv")):
+        return "cps"
+    if name.endswith(("_user.json", "_settings.json")) or name == "settings.json":
+        return None
+    if name.endswith(".json"):
+        return "spectrum"
+    return None
+
+
+def _connect(folder=None):
+    con = sqlite3.connect(db_path(folder), timeout=5.0)
+    con.row_factory = sqlite3.Row
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version != SCHEMA_VERSION:
+        con.execute("DROP TABLE IF EXISTS files")
+        con.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, kind TEXT, stem TEXT, mtime REAL, size INTEGER,
+            start_time TEXT, end_time TEXT, device TEXT, channels INTEGER,
+            counts INTEGER, measurement_time REAL, coefficients TEXT, note TEXT,
+            lat_min REAL, lat_max REAL, lon_min REAL, lon_max REAL, ok INTEGER
+        )""")
+    con.execute("CREATE INDEX IF NOT EXISTS files_kind ON files(kind, stem)")
+    return con
+
+
+# ------------------------------------------------------------
+# Metadata extraction (only for new or changed files)
+# ------------------------------------------------------------
+def _gps_bounds(gps):
+    lats, lons = [], []
+    for g in gps or []:
+        if isinstance(g, dict):
+            lat, lon = g.get("lat"), g.get("lon")
+        elif isinstance(g, (list, tuple)) and len(g) >= 2:
+            lat, lon = g[0], g[1]
+        else:
+            continue
+        if lat is None or lon is None:
+            continue
+        try:
+            lats.append(float(lat))
+            lons.append(float(lon))
+        except (TypeError, ValueError):
+            continue
+    if not lats:
+        return None, None, None, None
+    return min(lats), max(lats), min(lons), max(lons)
+
+
+def _energy_spectrum(data):
+    if data.get("schemaVersion") == "NPESv2":
+        data = data["data"][0]
+    return data.get("resultData", {}).get("energySpectrum", {})
+
+
+def _npes_meta(data):
+    if data.get("schemaVersion") == "NPESv2":
+        data = data["data"][0]
+    res = data.get("resultData", {})
+    es  = res.get("energySpectrum", {})
+    spectrum = es.get("spectrum") or []
+    channels = es.get("numberOfChannels")
+    if channels is None:
+        first = spectrum[0] if spectrum else []
+        channels = len(first) if isinstance(first, list) else len(spectrum)
+    lat_min, lat_max, lon_min, lon_max = _gps_bounds(es.get("gps"))
+    return {
+        "start_time":       res.get("startTime", ""),
+        "end_time":         res.get("endTime", ""),
+        "device":           data.get("deviceData", {}).get("deviceName", ""),
+        "channels":         int(channels or 0),
+        "counts":           int(es.get("validPulseCount", 0) or 0),
+        "measurement_time": float(es.get("measurementTime", 0) or 0),
+        "coefficients":     json.dumps(es.get("energyCalibration", {}).get("coefficients", [])),
+        "note":             data.get("sampleInfo", {}).get("note", ""),
+        "lat_min": lat_min, "lat_max": lat_max, "lon_min": lon_min, "lon_max": lon_max,
+    }
+
+
+def _store_meta(path):
+    hdr, ck, gps, n = waterfall_store.read_meta(path)
+    lat_min, lat_max, lon_min, lon_max = _gps_bounds(gps)
+    return {
+        "start_time":       hdr.get("startTime", ""),
+        "end_time":         ck.get("endTime", ""),
+        "device":           hdr.get("deviceName", ""),
+        "channels":         int(ck.get("numberOfChannels") or ck.get("_bins") or 0),
+        "counts":           int(ck.get("validPulseCount", 0) or 0),
+        "measurement_time": float(ck.get("measurementTime", 0) or 0),
+        "coefficients":     json.dumps(hdr.get("coefficients", [])),
+        "note":             "",
+        "lat_min": lat_min, "lat_max": lat_max, "lon_min": lon_min, "lon_max": lon_max,
+    }
+
+
+def _cps_meta(path):
+    if path.suffix == ".csv":
+        values = []
+        with open(path, "r", newline="") as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                try:
+                    values.append(int(row[1]))
+                except (IndexError, ValueError):
+                    continue
+        counts, elapsed = int(np.sum(values)) if values else 0, len(values)
+    else:
+        data    = jsonio.load(path)
+        hist    = data.get("count_history", []) or []
+        counts  = int(sum(v for v in hist if isinstance(v, (int, float))))
+        elapsed = data.get("elapsed", len(hist))
+    return {"counts": counts, "measurement_time": float(elapsed or 0)}
+
+
+def _tail_gps(path):
+    """gps list at the end of an older plain _hmp.json (written after the rows), or None."""
+    if jsonio.is_compressed(path):
+        return None
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - TAIL_GPS_BYTES))
+        tail = f.read().decode("utf-8", errors="replace")
+    k = tail.rfind('"gps":')
+    if k < 0:
+        return None
+    try:
+        return json.JSONDecoder().raw_decode(tail[k + 6:].lstrip())[0]
+    except ValueError:
+        return None
+
+
+def _read_meta(path, kind):
+    if kind == "store":
+        return _store_meta(path)
+    if kind == "cps":
+        return _cps_meta(path)
+    # header fields only: the rows of a large export are never parsed
+    data = jsonio.load_head(path)
+    meta = _npes_meta(data)
+    if kind == "3d" and "gps" not in _energy_spectrum(data):
+        bounds = _gps_bounds(_tail_gps(path))
+        meta.update(zip(("lat_min", "lat_max", "lon_min", "lon_max"), bounds))
+    return meta
+
+
+def _stem_for(name, kind):
+    for sfx in ("_hmp.jsonl", "_hmp.json", "_cps.json", "-cps.json", "_cps.csv", ".json"):
+        if name.endswith(sfx):
+            return name[: -len(sfx)]
+    return Path(name).stem
+
+
+# ------------------------------------------------------------
+# Incremental refresh
+# ------------------------------------------------------------
+def _scan(folder):
+    """
+    ({relative path: (kind, mtime, size)}, stems with a run marker).
+    Root level: every kind; subfolders: 3D only.
+    """
+    found, running = {}, set()
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        rel_dir = os.path.relpath(dirpath, folder)
+        for name in filenames:
+            if rel_dir == "." and name.endswith(".run"):
+                running.add(name[:-4].removesuffix("_hmp"))     # recovery.marker_path()
+                continue
+            kind = classify(name)
+            if kind is None or (rel_dir != "." and kind != "3d"):
+                continue
+            full = os.path.join(dirpath, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            rel = name if rel_dir == "." else f"{rel_dir}/{name}".replace("\\", "/")
+            found[rel] = (kind, st.st_mtime, st.st_size)
+    return found, running
+
+
+def refresh(folder=None, kinds=None):
+    """
+    Bring the catalog in line with the folder, for the given kinds only
+    (default: all). Returns the number of files (re)read.
+    """
+    folder = Path(folder or shared.USER_DATA_DIR)
+    kinds  = set(kinds) if kinds else None
+    with _lock:
+        try:
+            con = _connect(folder)
+        except sqlite3.Error as e:
+            logger.error(f"  ❌ catalog open failed: {e}")
+            return 0
+        try:
+            known = {r["path"]: (r["mtime"], r["size"])
+                     for r in con.execute("SELECT path, kind, mtime, size FROM files")
+                     if kinds is None or r["kind"] in kinds}
+            found, running = _scan(folder)
+            if kinds is not None:
+                found = {p: v for p, v in found.items() if v[0] in kinds}
+
+            gone = [p for p in known if p not in found]
+            if gone:
+                con.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in gone])
+
+            read = 0
+            for rel, (kind, mtime, size) in found.items():
+                if known.get(rel) == (mtime, size):
+                    continue
+                stem = _stem_for(Path(rel).name, kind)
+                live = "/" not in rel and stem in running
+                if live and rel in known:
+                    continue                # keep the last row until the run ends
+                row = dict.fromkeys(_COLUMNS)
+                row.update(path=rel, kind=kind, stem=stem, ok=1)
+                if live:
+                    pass                    # name only; no mtime, so it is read after the run
+                else:
+                    row.update(mtime=mtime, size=size)
+                    try:
+                        row.update(_read_meta(folder / rel, kind))
+                    except Exception as e:
+                        row["ok"] = 0
+                        logger.warning(f"👆 catalog could not read {rel}: {e}")
+                con.execute(
+                    f"INSERT OR REPLACE INTO files ({', '.join(_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(_COLUMNS))})",
+                    [row[c] for c in _COLUMNS],
+                )
+                read += 1
+            con.commit()
+            if read or gone:
+                logger.info(f"   ✅ catalog updated: {read} read, {len(gone)} removed")
+            return read
+        except sqlite3.Error as e:
+            logger.error(f"  ❌ catalog refresh failed: {e}")
+            return 0
+        finally:
+            con.close()
+
+
+# ------------------------------------------------------------
+# Queries
+# ------------------------------------------------------------
+def query(sql_where="1", params=(), order="stem COLLATE NOCASE", folder=None, do_refresh=True,
+          kinds=None):
+    """Rows matching sql_where; `kinds` limits the refresh before the query."""
+    if do_refresh:
+        refresh(folder, kinds)
+    with _lock:
+        try:
+            con = _connect(folder)
+        except sqlite3.Error as e:
+            logger.error(f"  ❌ catalog open failed: {e}")
+            return []
+        try:
+            rows = con.execute(f"SELECT * FROM files WHERE {sql_where} ORDER BY {order}", params).fetchall()
+            return [dict(r) for r in rows]
+        finally:
+            con.close()
+
+
+def files(kind, folder=None):
+    """Catalog rows of one kind ('spectrum', '3d', 'store', 'cps')."""
+    return query("kind = ?", (kind,), folder=folder, kinds=(kind,))
+
+
+def search(kind=None, device=None, since=None, until=None, min_seconds=None,
+           max_seconds=None, min_counts=None, text=None, folder=None):
+    """
+    Find recordings by metadata. since/until compare against startTime
+    (ISO strings sort correctly), text matches file name or note.
+    """
+    where, params = [], []
+    if kind:
+        where.append("kind = ?");                 params.append(kind)
+    if device:
+        where.append("device LIKE ?");            params.append(f"%{device}%")
+    if since:
+        where.append("start_time >= ?");          params.append(str(since))
+    if until:
+        where.append("start_time <= ?");          params.append(str(until))
+    if min_seconds is not None:
+        where.append("measurement_time >= ?");    params.append(float(min_seconds))
+    if max_seconds is not None:
+        where.append("measurement_time <= ?");    params.append(float(max_seconds))
+    if min_counts is not None:
+        where.append("counts >= ?");              params.append(int(min_counts))
+    if text:
+        where.append("(stem LIKE ? OR note LIKE ?)")
+        params += [f"%{text}%", f"%{text}%"]
+    return query(" AND ".join(where) or "1", params, order="start_time DESC", folder=folder,
+                 kinds=(kind,) if kind else None)
@@ -0,0 +1,182 @@
+# checkpoint.py
+#
+# Crash-safe file writes for recordings.
+#
+# write_atomic() writes to a temp file in the same folder, fsyncs it and
+# renames it over the target, so a reader only ever sees the old file or the
+# complete new one, never a truncated JSON.
+#
+# CheckpointService runs those writes on one background thread. Saves queued
+# for the same path before the thread gets to them are coalesced: only the
+# newest payload is written. Latency and bytes are kept per path.
+
+import os
+import time
+import threading
+import tempfile
+
+from collections import deque
+from contextlib import contextmanager
+
+from shared import logger
+
+# mkstemp creates 0600 files; targets get the mode open() would give them.
+# os.umask() can only be read by setting it, so that is done once here.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextmanager
+def atomic_writer(path, mode="wb"):
+    """
+    Open a temp file next to `path` for streamed writes. On clean exit it is
+    fsynced and renamed over `path`; on error it is removed and `path` is left alone.
+    """
+    path   = os.fspath(path)
+    folder = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".part", dir=folder)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, _target_mode(path))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(folder)
+
+
+def _target_mode(path):
+    """Permissions of the file being replaced, or 0666 less the umask for a new one."""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+def write_atomic(path, data):
+    """Write bytes/str to `path` via temp file + fsync + rename. Returns bytes written."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    with atomic_writer(path, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def _fsync_dir(folder):
+    """Make the rename itself durable (no-op where directories can't be opened)."""
+    if os.name != "posix":
+        return
+    try:
+        dfd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dfd)
+
+
+class CheckpointService:
+
+    def __init__(self):
+        self._cond     = threading.Condition()
+        self._pending  = {}          # path -> bytes (newest wins)
+        self._order    = deque()     # paths in submit order
+        self._busy     = False
+        self._thread   = None
+        self._stats    = {}
+        self.coalesced = 0
+        self.failed    = 0
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True, name="CheckpointService")
+            self._thread.start()
+
+    def submit(self, path, data, wait=False):
+        """Queue `data` (bytes or str) for `path`. wait=True blocks until it is on disk."""
+        path = os.fspath(path)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self._cond:
+            if path in self._pending:
+                self.coalesced += 1
+                self._stat(path)["coalesced"] += 1
+            else:
+                self._order.append(path)
+            self._pending[path] = data
+            self._ensure_thread()
+            self._cond.notify_all()
+        if wait:
+            self.flush()
+
+    def flush(self, timeout=10.0):
+        """Block until every queued save has been written. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    logger.warning(f"👆 checkpoint flush timed out ({len(self._pending)} pending)")
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def _stat(self, path):
+        st = self._stats.get(path)
+        if st is None:
+            st = self._stats[path] = {
+                "saves": 0, "coalesced": 0, "last_ms": 0.0, "max_ms": 0.0,
+                "last_bytes": 0, "total_bytes": 0,
+            }
+        return st
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._order:
+                    self._cond.wait()
+                path = self._order.popleft()
+                data = self._pending.pop(path)
+                self._busy = True
+            t0 = time.perf_counter()
+            try:
+                n  = write_atomic(path, data)
+                ms = (time.perf_counter() - t0) * 1000.0
+                with self._cond:
+                    st = self._stat(path)
+                    st["saves"]       += 1
+                    st["last_ms"]      = ms
+                    st["max_ms"]       = max(st["max_ms"], ms)
+                    st["last_bytes"]   = n
+                    st["total_bytes"] += n
+                logger.debug(f"   💾 {os.path.basename(path)} {n} bytes in {ms:.1f} ms")
+            except Exception as e:
+                with self._cond:
+                    self.failed += 1
+                logger.error(f"  ❌ checkpoint write failed {path}: {e}")
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "pending":   len(self._pending),
+                "coalesced": self.coalesced,
+                "failed":    self.failed,
+                "files":     {os.path.basename(p): dict(st) for p, st in self._stats.items()},
+            }
+
+
+# Single service shared by all recorders
+service = CheckpointService()
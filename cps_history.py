@@ -0,0 +1,247 @@
+# cps_history.py
+#
+# Counts-per-second history, one sample per second for the whole run.
+#
+# Samples live in an array('i') (4 bytes each instead of a boxed int). Only
+# the most recent `window` samples stay in RAM once they have been written
+# to the {filename}_cps.csv by save_csv(); older ones are read back from that
+# file on demand. Tabs ask for tail(n) or range(i0, i1) instead of copying
+# the whole list, and decimated(n) for a whole-run plot: block means over a
+# power-of-two number of seconds, where the blocks of spilled samples are
+# read from the CSV once, cached, and merged in pairs when the block doubles.
+#
+# Indices are absolute seconds since the start of the run, exactly as in the
+# "second" column of the CSV.
+
+import os
+import logging
+import threading
+
+import numpy as np
+
+from array import array
+
+logger = logging.getLogger("ImpulseLogger")
+
+WINDOW    = 6 * 3600     # samples kept in RAM after they are on disk
+CHUNK     = 4096         # trim granularity and CSV seek-index stride
+HARD_CAP  = 4 * WINDOW   # RAM limit when nothing is being saved
+
+
+class CountHistory:
+
+    def __init__(self, window=WINDOW, chunk=CHUNK, hard_cap=HARD_CAP):
+        self._lock     = threading.RLock()
+        self.window    = int(window)
+        self.chunk     = int(chunk)
+        self.hard_cap  = max(int(hard_cap), self.window + self.chunk)
+        self.clear()
+
+    # ---- writing -----------------------------------------------
+
+    def clear(self):
+        with self._lock:
+            self._ram      = array('i')
+            self.base      = 0          # absolute index of self._ram[0]
+            self.saved     = 0          # samples [0, saved) are in the CSV
+            self.discarded = 0          # dropped without a CSV to spill to
+            self._offsets  = {}         # k -> (path, byte offset of row k*chunk)
+            self._spilled_means = (1, np.zeros(0))   # (step, means of spilled blocks)
+
+    def reset(self, values):
+        """Replace the history (e.g. loaded from a file); everything stays in RAM."""
+        with self._lock:
+            self.clear()
+            self._ram.extend(int(v) for v in values)
+
+    def load_csv(self, path):
+        """
+        Continue an existing {filename}_cps.csv (resumed recording): its rows
+        count as saved, so save_csv() appends after them. A torn last line is
+        cut off. Returns the number of samples loaded.
+        """
+        with self._lock:
+            self.clear()
+            path = os.fspath(path)
+            with open(path, "r+b") as f:
+                pos = len(f.readline())
+                for line in f:
+                    idx, _, val = line.partition(b",")
+                    try:
+                        i, v = int(idx), int(val)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n") or i != len(self._ram):
+                        break
+                    if i % self.chunk == 0:
+                        self._offsets[i // self.chunk] = (path, pos)
+                    self._ram.append(v)
+                    pos += len(line)
+                f.truncate(pos)
+            self.saved = len(self._ram)
+            self._trim()
+            return self.saved
+
+    def append(self, value):
+        with self._lock:
+            self._ram.append(int(value))
+            if len(self._ram) > self.hard_cap:
+                self._trim(unsaved_ok=True)
+
+    def extend(self, values):
+        with self._lock:
+            self._ram.extend(int(v) for v in values)
+            if len(self._ram) > self.hard_cap:
+                self._trim(unsaved_ok=True)
+
+    def _trim(self, unsaved_ok=False):
+        """Drop whole chunks from the front of RAM down to `window`. Caller holds the lock."""
+        limit = len(self._ram) - self.window
+        if not unsaved_ok:
+            limit = min(limit, self.saved - self.base)
+        drop = (limit // self.chunk) * self.chunk
+        if drop <= 0:
+            return
+        unsaved = max(0, self.base + drop - self.saved)
+        if unsaved:
+            self.discarded += unsaved
+            self.saved      = self.base + drop
+            logger.warning(f"👆 count history over {self.hard_cap} samples with no CPS file, dropped {unsaved}")
+        del self._ram[:drop]
+        self.base += drop
+
+    def save_csv(self, path):
+        """Append samples not yet on disk to `path` ("second,cps" rows). Returns rows written."""
+        with self._lock:
+            start = self.saved
+            new   = self._ram[start - self.base:]
+            if not new:
+                return 0
+            path  = os.fspath(path)
+            exists = os.path.exists(path)
+            with open(path, "ab") as f:
+                if not exists:
+                    f.write(b"second,cps\n")
+                pos = f.tell()
+                for j, v in enumerate(new):
+                    i = start + j
+                    if i % self.chunk == 0:
+                        self._offsets[i // self.chunk] = (path, pos)
+                    line = f"{i},{v}\n".encode("ascii")
+                    f.write(line)
+                    pos += len(line)
+            self.saved = start + len(new)
+            if len(self._ram) - self.window >= self.chunk:
+                self._trim()
+            return len(new)
+
+    # ---- reading -----------------------------------------------
+
+    def __len__(self):
+        with self._lock:
+            return self.base + len(self._ram)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def tail(self, n):
+        """Last n samples as an int64 array."""
+        with self._lock:
+            total = self.base + len(self._ram)
+            return self.range(max(0, total - int(n)), total)
+
+    def range(self, i0, i1=None):
+        """Samples [i0, i1) as an int64 array; spilled samples come from the CSV."""
+        with self._lock:
+            total = self.base + len(self._ram)
+            i1    = total if i1 is None else min(int(i1), total)
+            i0    = max(0, int(i0))
+            if i1 <= i0:
+                return np.zeros(0, dtype=np.int64)
+            out = np.zeros(i1 - i0, dtype=np.int64)
+            a = max(i0, self.base)
+            if a < i1:
+                ram = np.frombuffer(self._ram, dtype=np.int32)
+                out[a - i0:] = ram[a - self.base:i1 - self.base]
+            if i0 < self.base:
+                self._read_spilled(i0, min(i1, self.base), out, i0)
+            return out
+
+    def _read_spilled(self, i0, i1, out, origin):
+        """Fill out[i - origin] for spilled rows i0..i1-1 from the CSV files."""
+        for k in range(i0 // self.chunk, (i1 - 1) // self.chunk + 1):
+            loc = self._offsets.get(k)
+            if loc is None:
+                continue                    # never saved (discarded) -> zeros
+            path, pos = loc
+            stop = min(i1, (k + 1) * self.chunk)
+            try:
+                with open(path, "rb") as f:
+                    f.seek(pos)
+                    for line in f:
+                        idx, _, val = line.partition(b",")
+                        i = int(idx)
+                        if i >= stop:
+                            break
+                        if i >= i0:
+                            out[i - origin] = int(val)
+            except (OSError, ValueError) as e:
+                logger.warning(f"👆 count history read failed {path}: {e}")
+
+    def decimated(self, max_points=2000):
+        """
+        (x, y) for plotting the whole run in at most about max_points points:
+        y is the mean of each block of `step` samples (step a power of two),
+        x the block's first second. Only samples not yet reduced are read.
+        """
+        with self._lock:
+            total = self.base + len(self._ram)
+            step  = 1
+            while total > step * max(1, int(max_points)):
+                step *= 2
+            if step == 1:
+                y = self.range(0, total).astype(float)
+                return np.arange(total), y
+
+            # blocks entirely in the spilled part, reduced once
+            c_step, means = self._spilled_means
+            if c_step > step:
+                c_step, means = step, np.zeros(0)
+            while c_step < step:
+                m     = len(means) // 2
+                means = 0.5 * (means[0:2 * m:2] + means[1:2 * m:2])
+                c_step *= 2
+            n_sp  = self.base // step
+            means = means[:n_sp]
+            if len(means) < n_sp:
+                a   = len(means) * step
+                raw = np.zeros(n_sp * step - a, dtype=np.int64)
+                self._read_spilled(a, n_sp * step, raw, a)
+                means = np.concatenate((means, raw.reshape(-1, step).mean(axis=1)))
+            self._spilled_means = (step, means)
+
+            # the rest is mostly in RAM; the last block may be partial
+            rest = self.range(n_sp * step, total).astype(float)
+            m    = len(rest) // step
+            tail = rest[:m * step].reshape(-1, step).mean(axis=1)
+            if len(rest) > m * step:
+                tail = np.append(tail, rest[m * step:].mean())
+            y = np.concatenate((means, tail))
+            return np.arange(len(y)) * step, y
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(len(self))
+            return self.range(start, stop)[::step].tolist()
+        n = len(self)
+        if k < 0:
+            k += n
+        if not 0 <= k < n:
+            raise IndexError("count history index out of range")
+        return int(self.range(k, k + 1)[0])
+
+    def __iter__(self):
+        """Every sample, oldest first, read in chunks."""
+        n = len(self)
+        for a in range(0, n, self.chunk):
+            yield from self.range(a, min(a + self.chunk, n)).tolist()
@@ -1,7 +1,10 @@
 # functions.py
 
 import pandas as pd
-import pyaudio
+try:
+    import pyaudio
+except ImportError:      # MAX / Teensy only installs (recorder_daemon.py)
+    pyaudio = None
 import webbrowser
 import wave
 import numpy as np
@@ -21,14 +24,24 @@ import logging
 import glob
 import requests as req
 import shproto.dispatcher
+import shproto.pulses
 import serial.tools.list_ports
 import shared
 import numpy as np
 import shproto.dispatcher as disp
 import save
-
-from scipy.signal import find_peaks, peak_widths
+import jsonio
+import persistence
+import catalog
+import recovery
+import peak_search
+import isotope_index
+import pyramid
+import waterfall_store
+
+from scipy.signal import find_peaks, peak_widths, fftconvolve
 from collections import defaultdict
+from functools import partial, lru_cache
 from datetime import datetime
 from urllib.request import urlopen
 from shproto.dispatcher import process_03, start
@@ -122,12 +135,10 @@ def update_calibration_in_json(filename, coeff_1, coeff_2, coeff_3):
         logger.warning(f"  ⚠️ fn update_calibration_in_json: {filename}.json not found")
         return
     try:
-        with open(jsonfile, "r") as f:
-            data = json.load(f)
+        data = jsonio.load(jsonfile)
         # NPESv2 stores coefficients as [c, b, a] — reverse of shared.coeff order
         data["data"][0]["resultData"]["energySpectrum"]["energyCalibration"]["coefficients"] = [coeff_3, coeff_2, coeff_1]
-        with open(jsonfile, "w") as f:
-            json.dump(data, f, separators=(',', ':'))
+        jsonio.save(jsonfile, data, "json")
         logger.info(f"   ✅ fn Calibration updated in {filename}.json")
     except Exception as e:
         import traceback
@@ -183,7 +194,7 @@ def write_blank_json_schema_hmp(filename, device):
 def update_mode_3_data(
     mode, shared, full_histogram, last_histogram,
     hmp_buffer, interval_counter, t_interval, bins,
-    now, save_queue, meta, filename, hst3d, gps_hmp_full
+    now, save_queue, meta, filename, hst3d=None, gps_hmp_full=None
 ):
     """
     Returns: (interval_counter, last_histogram)
@@ -227,8 +238,8 @@ def update_mode_3_data(
     # --- Flush every t_interval seconds ---
     if interval_counter >= max(1, int(t_interval)):
         if hmp_buffer:
-            # Aggregate N seconds into one slice (per-bin sums)
-            aggregated = [sum(col) for col in zip(*hmp_buffer)]
+            # Aggregate N seconds into one slice (per-bin sums), kept sparse
+            aggregated = waterfall_store.SparseRow.from_dense([sum(col) for col in zip(*hmp_buffer)])
 
             from collections import deque
 
@@ -278,8 +289,7 @@ def update_mode_3_data(
 def clear_global_cps_list():
     with shared.write_lock:
         shared.counts          = 0
-        shared.count_history   = []
-        shared.count_history_saved_index = 0
+        shared.count_history.clear()
         shared.dropped_counts  = 0
 
 
@@ -413,38 +423,45 @@ def rolling_average(data, window_size):
     return np.convolve(data, np.ones(window_size)/window_size, mode='valid')
 
 def peak_finder(y_values, prominence, min_width, smoothing_window=3):
-    # Apply rolling average for smoothing
-    smoothed_y_values = rolling_average(y_values, smoothing_window)  
-    # Find peaks in the smoothed data
-    peaks, _ = find_peaks(smoothed_y_values, prominence=prominence, distance=30)
-    # Calculate widths at relative height 0.3
-    widths, _, _, _ = peak_widths(smoothed_y_values, peaks, rel_height=0.5)
-    # Filter peaks based on minimum width
-    filtered_peaks = [p for i, p in enumerate(peaks) if widths[i] >= min_width]
-    # Calculate full width at half maximum (FWHM) for filtered peaks
-    fwhm = [round(peak_widths(smoothed_y_values, [p], rel_height=0.5)[0][0], 1) for p in filtered_peaks]
-    # Adjust filtered peaks indices to match original data indices
-    adjusted_peaks = [p + (smoothing_window - 1) // 2 for p in filtered_peaks]
-    return adjusted_peaks, fwhm
+    """Peak channels and FWHM (see peak_search for centroid, prominence and area)."""
+    peaks = peak_search.engine.search(y_values, prominence, min_width, smoothing_window)
+    return [p["index"] for p in peaks], [p["fwhm"] for p in peaks]
 
-def gaussian_correl(data, sigma):
-    correl_values = []
-    data_len = len(data)
-    std = math.sqrt(data_len)
+GAUSS_FFT_MIN = 64      # kernel length from which FFT convolution is faster
+
+@lru_cache(maxsize=32)
+def _gauss_kernel(data_len, sigma):
+    """Zero-mean Gaussian kernel for gaussian_correl(), cached per (length, sigma)."""
+    std   = math.sqrt(data_len)
     x_max = round(sigma * std)
     gauss_values = [math.exp(-(k ** 2) / (2 * std ** 2)) for k in range(-x_max, x_max)]
     avg = sum(gauss_values) / len(gauss_values)
-    for index in range(data_len):
-        result_val = 0
-        for k in range(-x_max, x_max):
-            idx = index + k
-            if 0 <= idx < data_len:
-                result_val += data[idx] * (gauss_values[k + x_max] - avg)
-        correl_values.append(max(0, int(result_val)))
+    kernel = np.array(gauss_values) - avg
+    kernel.flags.writeable = False
+    return x_max, kernel
+
+def gaussian_correl(data, sigma):
+    """
+    Correlate the spectrum with a zero-mean Gaussian of width sigma*sqrt(bins),
+    clamp at zero and scale the peak to 0.8 x max(data). Same output as the
+    former per-channel loop (window k = -x_max .. x_max-1, zeros outside).
+    """
+    data_len      = len(data)
+    x_max, kernel = _gauss_kernel(data_len, sigma)
+    y = np.asarray(data, dtype=float)
+
+    # out[i] = sum_k y[i + k] * kernel[k + x_max]; pad so 'valid' keeps data_len points
+    padded = np.pad(y, (x_max, x_max - 1))
+    if len(kernel) >= GAUSS_FFT_MIN:
+        result = fftconvolve(padded, kernel[::-1], mode="valid")
+    else:
+        result = np.correlate(padded, kernel, mode="valid")
+
+    correl_values = np.maximum(np.trunc(result), 0)
     max_data = max(data)
-    max_correl_value = max(correl_values)
+    max_correl_value = correl_values.max()
     scaling_factor = 0.8 * max_data / max_correl_value if max_correl_value != 0 else 1
-    return [int(value * scaling_factor) for value in correl_values]
+    return np.trunc(correl_values * scaling_factor).astype(int).tolist()
 
 def start_recording(mode, device_type):
 
@@ -538,9 +555,13 @@ def start_teensy_recording(mode=2):
         coeff_2    = shared.coeff_2        # NEW
         coeff_3    = shared.coeff_3        # NEW
         spec_notes = shared.spec_notes     # NEW
+        compression = int(shared.compression)
 
     logger.info(f"   ✅ fn Starting Teensy recording on {port_str}")
 
+    if recovery.take(filename, mode):
+        logger.warning("👆 fn Teensy recordings cannot be resumed, starting over")
+
     last_histogram   = [0] * bins
     hmp_buffer       = []
     interval_counter = 0
@@ -577,6 +598,7 @@ def start_teensy_recording(mode=2):
         dt_start         = datetime.utcnow()
         last_save_time   = start_time
         first_tick       = True   # NEW
+        store            = None   # waterfall_store, mode 3 only
 
         while shared.run_flag.is_set():
             try:
@@ -612,9 +634,15 @@ def start_teensy_recording(mode=2):
                     total   = sum(compressed)
                     elapsed = int(time.time() - start_time)
 
+                    # the display pyramid keeps every coarser view current
+                    if first_tick:
+                        pyramid.primary.reset(compressed, compression)
+                    else:
+                        pyramid.primary.update(compressed)
+
                     with shared.write_lock:
-                        shared.bins           = bins
-                        shared.histogram      = compressed
+                        shared.histogram      = pyramid.primary.level(shared.compression) or compressed
+                        shared.bins           = len(shared.histogram)
                         shared.counts         = total
                         shared.elapsed        = elapsed
                         shared.cps            = live_cps
@@ -638,10 +666,25 @@ def start_teensy_recording(mode=2):
                             meta=meta,
                             filename=filename,
                         )
+                        # rows queued by update_mode_3_data go to the append-only store
+                        while not save_queue.empty():
+                            job = save_queue.get_nowait()
+                            if store is None:
+                                store = waterfall_store.WaterfallStore(
+                                    filename, device="TEENSY",
+                                    coeffs=[coeff_3, coeff_2, coeff_1],
+                                    dt_start=dt_start, t_interval=t_interval,
+                                )
+                            store.append(job["last_minute"], job.get("gps"))
 
                     now = time.time()
                     if now - last_save_time >= 60:
-                        save.save_histogram_json(
+                        dt_now = datetime.utcnow()
+                        if store is not None:
+                            store.cut(total, elapsed, dt_now)
+                        persistence.service.submit(f"{filename}.json", partial(
+                            save.save_recording,
+                            store=store,
                             filename=filename,
                             device="TEENSY",
                             histogram=compressed,
@@ -653,10 +696,8 @@ def start_teensy_recording(mode=2):
                             coeff_3=coeff_3,
                             spec_notes=spec_notes,
                             dt_start=dt_start,
-                            dt_now=datetime.utcnow(),
-                        )
-                        save.save_count_history_csv(filename)   # NEW
-                        logger.info(f"    ✅ {filename} saved ")
+                            dt_now=dt_now,
+                        ))
                         last_save_time = now
 
             except Exception as e:
@@ -675,7 +716,13 @@ def start_teensy_recording(mode=2):
             total     = shared.counts
             elapsed   = shared.elapsed
             pileup    = shared.dropped_counts
-        save.save_histogram_json(
+        dt_now = datetime.utcnow()
+        if store is not None:
+            store.cut(total, elapsed, dt_now)
+        persistence.service.submit(f"{filename}.json", partial(
+            save.save_recording,
+            store=store,
+            final=True,
             filename=filename,
             device="TEENSY",
             histogram=histogram,
@@ -687,9 +734,10 @@ def start_teensy_recording(mode=2):
             coeff_3=coeff_3,
             spec_notes=spec_notes,
             dt_start=dt_start,
-            dt_now=datetime.utcnow(),
-        )
-        save.save_count_history_csv(filename)   # NEW
+            dt_now=dt_now,
+        ), priority=True)
+        persistence.service.flush()
+        logger.info(f"    ✅ {filename} saved ")
         shared.teensy_recording.clear()  # <-- resume tab1 reader
         shared.save_done.set()
         logger.info("   ✅ fn Teensy recording stopped")
@@ -726,7 +774,9 @@ def start_pro_recording(mode):
 
         logger.info("   ✅ fn Start recording (3D) ")
 
-        write_blank_json_schema_hmp(filename, device)
+        # a resumed run keeps the store it continues
+        if not recovery.requested(filename, 3):
+            write_blank_json_schema_hmp(filename, device)
 
 
         try:
@@ -763,7 +813,7 @@ def clear_shared(mode):
 
     if mode == 2:
         with shared.write_lock:
-            shared.count_history   = []
+            shared.count_history.clear()
             shared.counts          = 0
             shared.cps             = 0
             shared.elapsed         = 0
@@ -792,7 +842,7 @@ def clear_shared(mode):
 
         
         with shared.write_lock:
-            shared.count_history   = []
+            shared.count_history.clear()
             shared.counts          = 0
             shared.cps             = 0
             shared.elapsed         = 0
@@ -822,8 +872,7 @@ def export_csv(filename, data_directory, calib_switch):
     output_file = get_unique_filename(download_folder, f'{filename}.csv')
 
     try:
-        with open(os.path.join(data_directory, f'{filename}.json')) as f:
-            data = json.load(f)
+        data = jsonio.load(os.path.join(data_directory, f'{filename}.json'))
     except FileNotFoundError:
         logger.error(f"  ❌ fn {filename}.json not found in {data_directory} ")
         return
@@ -910,17 +959,17 @@ def publish_spectrum(filename):
 
     spectrum_file_path = f'{data_directory}/{filename}.json'
     try:
-        with open(spectrum_file_path, 'rb') as file:
-            files = {'file': (filename, file)}
-            data = {'api_key': api_key}
-            response = req.post(url, files=files, data=data)
-            if response.status_code == 200:
-                logger.info(f"   ✅ fn {filename} Published ok ")
-                return f'{filename}\npublished:\n{response}'
-            else:
-                logger.error(f"  ❌ fn {response.text} ")
+        # server expects plain NPES JSON, so send compressed files decompressed
+        files = {'file': (filename, jsonio.read_bytes(spectrum_file_path))}
+        data = {'api_key': api_key}
+        response = req.post(url, files=files, data=data)
+        if response.status_code == 200:
+            logger.info(f"   ✅ fn {filename} Published ok ")
+            return f'{filename}\npublished:\n{response}'
+        else:
+            logger.error(f"  ❌ fn {response.text} ")
 
-                return f'Error from /code/functions/publish_spectrum: {response.text}'
+            return f'Error from /code/functions/publish_spectrum: {response.text}'
     except req.exceptions.RequestException as e:
         logger.error(f"  ❌ fn publish failed {e}")
 
@@ -938,8 +987,7 @@ def get_spec_notes(filename):
     try:
         filename = Path(filename).stem
         path = get_path(os.path.join(USER_DATA_DIR, f"{filename}.json"))
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = jsonio.load(path)
 
         if data.get("schemaVersion") == "NPESv2":
             data = data["data"][0]
@@ -1026,68 +1074,36 @@ def allowed_command(cmd: str) -> bool:
 
 def is_valid_json(file_path):
     try:
-        with open(file_path, 'r') as f:
+        with jsonio.open_text(file_path) as f:
             data = f.read()
             if not data.strip():
                 return False
             json.loads(data)
         return True
-    except (json.JSONDecodeError, FileNotFoundError):
+    except Exception:   # bad JSON, missing file or corrupt gzip/xz stream
         return False
 
 from pathlib import Path
 
 def get_filename_options(kind="user"):
-    def match(filename: str) -> bool:
-        if kind == "user":
-            excluded = ["_cps.json", "-cps.json", "_hmp.json", "_user.json"]
-            return not any(filename.endswith(sfx) for sfx in excluded)
-        elif kind == "cps":
-            return filename.endswith("_cps.json") or filename.endswith("_cps.csv")
-        elif kind == "3d":
-            return filename.endswith("_hmp.json")
-        elif kind == "all":
-            return filename.endswith(".json")
-        else:
-            return False
+    """Picker options from the recordings catalog (see catalog.py)."""
+    kinds = {
+        "user": ("spectrum",),
+        "cps":  ("cps",),
+        "3d":   ("3d",),
+        "all":  ("spectrum", "3d", "cps"),
+    }.get(kind, ())
 
-    def make_option(file_path: Path, base_dir: Path):
-        try:
-            rel = file_path.relative_to(base_dir)
-        except ValueError:
-            rel = file_path.name
-        label = Path(rel).stem
-        value = str(rel).replace("\\", "/")
-        return {'label': label, 'value': value}
-
-    patterns = ["*.csv", "*.json"] if kind == "cps" else ["*.json"]
     files = []
-    for pattern in patterns:
-        files.extend(
-            make_option(f, shared.USER_DATA_DIR)
-            for f in shared.USER_DATA_DIR.glob(pattern)
-            if match(f.name)
-        )
+    for k in kinds:
+        for row in catalog.files(k):
+            rel = row["path"]
+            if "/" in rel or (kind == "all" and not rel.endswith(".json")):
+                continue
+            files.append({'label': Path(rel).stem, 'value': rel})
     files.sort(key=lambda x: x['label'].lower())
     return files
 
-    def make_option(file_path: Path, base_dir: Path):
-        try:
-            rel = file_path.relative_to(base_dir)
-        except ValueError:
-            rel = file_path.name  # fallback to just the filename
-        label = Path(rel).stem
-        value = str(rel).replace("\\", "/")
-        return {'label': label, 'value': value}
-
-    files = [
-        make_option(f, shared.USER_DATA_DIR)
-        for f in shared.USER_DATA_DIR.glob("*.json")
-        if match(f.name)
-    ]
-    files.sort(key=lambda x: x['label'].lower())  # case-insensitive sort
-    return files
-
 
 def get_filename_2_options():
 
@@ -1107,9 +1123,9 @@ def get_filename_2_options():
 
     # --- User files at USER_DATA_DIR root ---
     user_files = [
-        make_option(f, shared.USER_DATA_DIR)
-        for f in shared.USER_DATA_DIR.glob("*.json")
-        if is_valid(f.name)
+        make_option(shared.USER_DATA_DIR / row["path"], shared.USER_DATA_DIR)
+        for row in catalog.files("spectrum")
+        if "/" not in row["path"] and is_valid(row["path"])
     ]
     user_files.sort(key=lambda x: x['sort_key'])
 
@@ -1155,8 +1171,7 @@ def get_options_hmp():
     with shared.write_lock:
         data_directory = shared.USER_DATA_DIR
 
-    files = [os.path.relpath(file, data_directory).replace("\\", "/")
-             for file in glob.glob(os.path.join(data_directory, "**", "*_hmp.json"), recursive=True)]
+    files = [row["path"] for row in catalog.files("3d", folder=data_directory)]
     
     options = [{'label': "~ " + os.path.basename(file), 'value': file} if "lib/" in file and file.endswith(".json")
         else {'label': os.path.basename(file), 'value': file} for file in files]
@@ -1183,12 +1198,12 @@ def find_peaks_in_gc(gc, sigma):
 
 # Finds matching isotopes in the JSON data file
 def matching_isotopes(x_calibrated, data, width):
+    """Library lines within `width` keV of each significant (x, y) point, keyed by point index."""
+    index   = isotope_index.index_for(data)
     matches = {}
     for idx, (x, y) in enumerate(x_calibrated):
         if y > 4:  # Threshold for significant peaks
-            matched_isotopes = [
-                isotope for isotope in data if abs(isotope['energy'] - x) <= width
-            ]
+            matched_isotopes = index.lines_between(x - width, x + width)
             if matched_isotopes:
                 matches[idx] = (x, y, matched_isotopes)
     return matches
@@ -1206,8 +1221,7 @@ def load_histogram(filename):
     path     = get_path(os.path.join(shared.USER_DATA_DIR, filename))
 
     try:
-        with open(path, "r", encoding="utf-8") as file:
-            data = json.load(file)
+        data = jsonio.load(path)
 
         if data.get("schemaVersion") == "NPESv2":
             data = data["data"][0]
@@ -1229,6 +1243,7 @@ def load_histogram(filename):
             shared.compression     = int(shared.bins_abs / shared.bins)
             shared.counts          = sum(shared.histogram)
 
+        pyramid.primary.reset(result["spectrum"], shared.compression)
 
         logger.info(f"   ✅ fn Loaded histogram {filename} ")    
 
@@ -1244,8 +1259,7 @@ def load_histogram_2(filename):
     path = get_path(os.path.join(shared.USER_DATA_DIR, filename))
 
     try:
-        with open(path, 'r') as file:
-            data = json.load(file)
+        data = jsonio.load(path)
 
         if data["schemaVersion"] == "NPESv2":
             data = data["data"][0]
@@ -1265,6 +1279,8 @@ def load_histogram_2(filename):
             shared.compression_2   = int(shared.bins_abs / shared.bins_2)
             shared.counts_2        = sum(shared.histogram_2)
 
+        pyramid.comparison.reset(result["spectrum"], shared.compression_2)
+
 
         logger.info(f"   ✅ fn Loaded comparison {filename} ") 
 
@@ -1281,7 +1297,7 @@ def load_histogram_hmp(stem):
     clean_stem = Path(stem).stem.removesuffix("_hmp")
     file_path  = Path(shared.USER_DATA_DIR) / f"{clean_stem}_hmp.json"
 
-    if not file_path.exists():
+    if not waterfall_store.hmp_exists(file_path):
         logger.warning(f"👆 fn file not found: {file_path} ")
 
         with shared.write_lock:
@@ -1291,9 +1307,8 @@ def load_histogram_hmp(stem):
         return
 
     try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            logger.info("   ✅ fn loading 3d file ")
-            data = json.load(file)
+        logger.info("   ✅ fn loading 3d file ")
+        data = waterfall_store.load_hmp(file_path, sparse=True)
 
         if data.get("schemaVersion") == "NPESv2":
             data = data["data"][0]
@@ -1330,7 +1345,7 @@ def load_histogram_hmp(stem):
                 fixed_gps.append(default_row.copy())
 
         with shared.write_lock:
-            shared.histogram_hmp  = [row[:] for row in spectrum]
+            shared.histogram_hmp  = list(spectrum)      # SparseRow, dense only when drawn
             shared.gps_hmp        = fixed_gps
 
             shared.counts         = result.get("validPulseCount", 0)
@@ -1377,7 +1392,7 @@ def load_cps_file(filepath):
             else:
                 raise ValueError("Invalid format for 'count_history' in JSON file.")
 
-            shared.count_history   = valid_count_history
+            shared.count_history.reset(valid_count_history)
             shared.elapsed         = int(elapsed)
             shared.counts          = int(counts)
             shared.dropped_counts  = int(dropped_counts)
@@ -1409,7 +1424,7 @@ def load_cps_csv(filepath):
                 if cps_val >= 0:
                     count_history.append(cps_val)
 
-        shared.count_history   = count_history
+        shared.count_history.reset(count_history)
         shared.counts          = sum(count_history)
         shared.elapsed         = len(count_history)
         shared.dropped_counts  = 0
@@ -1464,15 +1479,20 @@ def start_max_oscilloscope():
         threading.Thread(target=capture_pulse_data, daemon=True).start()
         return False  # Signal that the interval should be enabled        
   
-def stop_max_pulse_check():
+def stop_max_pulse_check(export_csv=False):
+    """Stop the MAX pulse / oscilloscope mode; export_csv also writes _max-pulse-shape.csv."""
     try:
         process_03('-sto')  # Stop recording
         time.sleep(0.1)
         process_03('-mode 0')  # Reset mode to default
     except Exception as e:
         logger.error(f"  ❌ fn process_03: {e} ")
-    
+
+    shproto.pulses.sink.flush()
     stop_thread.set()  # Signal the thread to stop
+    if export_csv:
+        # the log can be large; keep the CSV off the UI thread
+        threading.Thread(target=shproto.dispatcher.export_pulse_csv, name="pulse-csv").start()
     return True  # Signal that the interval should be disabled
 
 def capture_pulse_data():
@@ -1709,26 +1729,20 @@ def generate_synthetic_histogram(isotope_key: str, include_xray: bool = False) -
         scale = TARGET_COUNTS / I_sum
 
         # accumulate (fractional) counts by your exact bin formula
-        acc = [0.0] * bins
-        added = 0
-        for ln in lines:
-            E = ln["energy"]; I = ln["intensity"] * scale
-            if E < 0:
-                continue
-            i = int((E / MAX_ENERGY_KEV) * bins)  # <-- EXACT formula you specified
-            if i >= bins:                         # clamp edge case E≈MAX_ENERGY_KEV
-                i = bins - 1
-            if i >= 0:
-                acc[i] += I
-                added += 1
+        E   = np.array([ln["energy"] for ln in lines], dtype=float)
+        I   = np.array([ln["intensity"] for ln in lines], dtype=float) * scale
+        pos = E >= 0
+        idx = np.minimum((E[pos] / MAX_ENERGY_KEV * bins).astype(np.int64), bins - 1)  # clamp E≈MAX_ENERGY_KEV
+        acc = np.bincount(idx, weights=I[pos], minlength=bins)
+        added = int(pos.sum())
 
         # round to integers while preserving exact total = TARGET_COUNTS
-        spec2 = [int(math.floor(v)) for v in acc]
-        remainder = TARGET_COUNTS - sum(spec2)
+        base = np.floor(acc)
+        remainder = TARGET_COUNTS - int(base.sum())
         if remainder > 0:
-            order = sorted(range(bins), key=lambda j: (acc[j] - spec2[j]), reverse=True)
-            for j in order[:remainder]:
-                spec2[j] += 1
+            order = np.argsort(-(acc - base), kind="stable")
+            base[order[:remainder]] += 1
+        spec2 = base.astype(np.int64).tolist()
 
         # --- rescale synthetic so max(histogram_2) == max(primary) ---
         try:
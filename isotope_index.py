@@ -0,0 +1,102 @@
+# isotope_index.py
+#
+# Sorted index over an isotope line library (shared.isotope_flags rows,
+# {"isotope", "energy", "intensity"} dicts).
+#
+# Energies, intensities and labels are held as arrays sorted by energy, so a
+# window query is two searchsorted() calls instead of a scan of the library,
+# and match() ranks candidates for many centroids at once. index_for() keeps
+# the index of the current library, rebuilding it only when a different
+# list of rows is loaded.
+
+import threading
+
+import numpy as np
+
+# tolerance recipe shared by the ROI table and markers
+BASE_TOL_KEV = 2.0
+FWHM_MULT    = 0.6
+REL_FRAC     = 0.002
+
+
+def tolerance(energy, fwhm_kev=0.0):
+    """Match window half-width in keV for a line at `energy` with peak FWHM `fwhm_kev`."""
+    return np.maximum(np.maximum(BASE_TOL_KEV, FWHM_MULT * np.asarray(fwhm_kev, dtype=float)),
+                      REL_FRAC * np.abs(np.asarray(energy, dtype=float)))
+
+
+class IsotopeIndex:
+
+    def __init__(self, rows):
+        keep, energies, intensities = [], [], []
+        for row in rows or []:
+            try:
+                e = float(row["energy"])
+                i = float(row.get("intensity", 0.0) or 0.0)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                continue
+            if not np.isfinite(e):
+                continue
+            keep.append(row)
+            energies.append(e)
+            intensities.append(i)
+
+        order = np.argsort(energies, kind="stable")
+        self.energies    = np.asarray(energies, dtype=float)[order]
+        self.intensities = np.asarray(intensities, dtype=float)[order]
+        self.rows        = [keep[k] for k in order]
+        self.labels      = [str(r.get("isotope", "")) for r in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def window(self, lo, hi):
+        """(start, stop) positions of the lines with lo <= energy <= hi."""
+        a = int(np.searchsorted(self.energies, lo, side="left"))
+        b = int(np.searchsorted(self.energies, hi, side="right"))
+        return a, b
+
+    def lines_between(self, lo, hi):
+        a, b = self.window(lo, hi)
+        return self.rows[a:b]
+
+    def match(self, energies, tol, top=3):
+        """
+        Ranked candidates for each energy: a list (one per query) of
+        (score, delta, line_energy, row) tuples, best first. Score favours
+        close and intense lines: (1 - delta/tol) * (0.1 + intensity).
+        `tol` is a scalar or one value per query.
+        """
+        q   = np.atleast_1d(np.asarray(energies, dtype=float))
+        tol = np.broadcast_to(np.asarray(tol, dtype=float), q.shape)
+        lo  = np.searchsorted(self.energies, q - tol, side="left")
+        hi  = np.searchsorted(self.energies, q + tol, side="right")
+
+        out = []
+        for e, t, a, b in zip(q, tol, lo, hi):
+            if b <= a or not np.isfinite(e) or t <= 0:
+                out.append([])
+                continue
+            d     = np.abs(self.energies[a:b] - e)
+            score = (1.0 - d / t) * (0.1 + self.intensities[a:b])
+            order = np.lexsort((d, -score))[:top] if top else np.lexsort((d, -score))
+            out.append([(float(score[k]), float(d[k]), float(self.energies[a + k]), self.rows[a + k])
+                        for k in order])
+        return out
+
+
+_lock  = threading.Lock()
+_cache = (None, None)       # (rows list, index)
+
+
+def index_for(rows):
+    """Index for this library list, built once per loaded list."""
+    global _cache
+    with _lock:
+        src, idx = _cache
+        if src is rows and idx is not None:
+            return idx
+    idx = IsotopeIndex(rows)
+    with _lock:
+        _cache = (rows, idx)
+    return idx
@@ -0,0 +1,179 @@
+# jsonio.py
+#
+# Optional compression for spectrum (.json) and waterfall (_hmp.json) files.
+#
+# File names do not change: a compressed spectrum is still my_spectrum.json,
+# so the pickers, globs and downloads keep working. Readers look at the first
+# bytes and decompress gzip or xz transparently; plain text passes through.
+#
+# Method and level are settings per file type:
+#   compress_json / compress_json_level   -> 2D spectrum .json
+#   compress_hmp  / compress_hmp_level    -> 3D _hmp.json exports
+# Method is "none", "gzip" or "lzma".
+
+import io
+import re
+import gzip
+import json
+import lzma
+
+import shared
+import checkpoint
+
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC   = b"\xfd7zXZ\x00"
+
+METHODS = ("none", "gzip", "lzma")
+
+_TOKENS = re.compile(r'"(?:\\.|[^"\\])*"|[{}\[\]]')     # strings are skipped whole
+
+
+def compression_for(kind):
+    """Return (method, level) from settings for kind 'json' or 'hmp'."""
+    with shared.write_lock:
+        method = str(getattr(shared, f"compress_{kind}", "none") or "none").lower()
+        level  = getattr(shared, f"compress_{kind}_level", 6)
+    if method not in METHODS:
+        method = "none"
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        level = 6
+    if method == "gzip":
+        level = min(max(level, 1), 9)
+    elif method == "lzma":
+        level = min(max(level, 0), 9)
+    return method, level
+
+
+def detect(head):
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(XZ_MAGIC):
+        return "lzma"
+    return "none"
+
+
+def encode(data, kind="json"):
+    """Compress text/bytes according to the settings for `kind`."""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    method, level = compression_for(kind)
+    if method == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if method == "lzma":
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def wrap_writer(raw, kind="json"):
+    """
+    Wrap a binary file object for streamed text writes. The returned stream
+    must be closed before `raw`; closing it leaves `raw` open.
+    """
+    method, level = compression_for(kind)
+    if method == "gzip":
+        comp = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=level, mtime=0)
+    elif method == "lzma":
+        comp = lzma.LZMAFile(raw, mode="wb", preset=level)
+    else:
+        comp = _NoClose(raw)
+    return io.TextIOWrapper(comp, encoding="utf-8")
+
+
+class _NoClose(io.RawIOBase):
+    """Passthrough that flushes instead of closing the underlying file."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return self._f.write(b)
+
+    def close(self):
+        if not self.closed:
+            self._f.flush()
+        super().close()
+
+
+def open_text(path):
+    """Open a possibly compressed JSON file for text reading."""
+    with open(path, "rb") as f:
+        head = f.read(6)
+    method = detect(head)
+    if method == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if method == "lzma":
+        return lzma.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def read_bytes(path):
+    """Whole file as plain (decompressed) bytes, e.g. for uploads."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    method = detect(raw[:6])
+    if method == "gzip":
+        return gzip.decompress(raw)
+    if method == "lzma":
+        return lzma.decompress(raw)
+    return raw
+
+
+def load(path):
+    with open_text(path) as f:
+        return json.load(f)
+
+
+def load_head(path, key="spectrum", chunk=1 << 16):
+    """
+    Parse a JSON file only up to its first `key`, for header fields of large
+    recordings. The result holds everything written before the key, with the
+    open objects and lists closed; the whole file is parsed if the key is
+    not in it.
+    """
+    pattern = re.compile(r'(?<!\\)"' + re.escape(key) + r'"\s*:')
+    text, start = "", 0
+    with open_text(path) as f:
+        while True:
+            block = f.read(chunk)
+            if not block:
+                return json.loads(text)
+            text += block
+            m = pattern.search(text, start)
+            if m:
+                break
+            start = max(0, len(text) - len(key) - 16)
+    return json.loads(_close_prefix(text[: m.start()]))
+
+
+def _close_prefix(text):
+    """Close the objects and lists left open at the end of a JSON prefix."""
+    stack = []
+    for m in _TOKENS.finditer(text):
+        c = m.group()
+        if c == "{":
+            stack.append("}")
+        elif c == "[":
+            stack.append("]")
+        elif c in "}]":
+            stack.pop()
+    return text.rstrip().rstrip(",") + "".join(reversed(stack))
+
+
+def is_compressed(path):
+    try:
+        with open(path, "rb") as f:
+            return detect(f.read(6)) != "none"
+    except OSError:
+        return False
+
+
+def save(path, data, kind="json", wait=True):
+    """Rewrite a JSON file atomically with the compression configured for `kind`."""
+    payload = encode(json.dumps(data, separators=(",", ":")), kind)
+    checkpoint.service.submit(path, payload, wait=wait)
+    return len(payload)
@@ -0,0 +1,371 @@
+# nuclide_id.py
+#
+# Whole-spectrum nuclide identification against a template matrix.
+#
+# Every nuclide in lib/isotopes.json becomes one column of a (bins, nuclides)
+# matrix: its lines placed at the calibrated channel and broadened with the
+# detector resolution (FWHM scales with sqrt(E), RESOLUTION_662 at 662 keV),
+# each column normalised to unit area. The matrix depends only on the
+# library, the calibration and the bin count, so it is built once and cached
+# per calibration.
+#
+# Lines below XRAY_MAX_KEV are left out unless x-rays are asked for. The
+# library labels most K x-rays as gamma lines, so this goes by energy: any
+# Ba/Xe/Cs K bump would otherwise confirm every nuclide listing those lines.
+#
+# identify() takes the live spectrum above a SNIP background (snip.py) of
+# the counts smoothed over one FWHM, drops nuclides whose strong lines are
+# mostly missing (side-band test on the gross counts), screens the rest
+# with one matrix-vector product (Poisson-weighted correlation), then
+# fits the best TOP_CANDIDATES with non-negative least squares. Each fitted
+# nuclide is then judged by how much worse the fit gets without it (the
+# chi-square gain of a refit). The weakest is dropped and the rest refitted
+# until every one left is needed. Of two look-alikes (all strong lines of
+# one on the other's), the one the fit needs less goes. A nuclide is
+# reported with its fitted counts, significance (the square root of that
+# gain) and a confidence derived from it. A refresh costs a few
+# milliseconds to a few tens and can run on every UI tick.
+
+import json
+import math
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+from pathlib import Path
+from scipy.optimize import nnls
+from scipy.special import ndtr
+
+import shared
+import snip
+
+from shared import logger
+
+RESOLUTION_662  = 7.0        # % FWHM at 662 keV (NaI-like default)
+MIN_ENERGY_KEV  = 20.0       # ignore lines below this (noise)
+XRAY_MAX_KEV    = 40.0       # K x-rays of I, Xe, Cs, Ba (below Am-241 59.5 keV): only with include_xray
+SPREAD_SIGMA    = 5.0        # template lines extend +-5 sigma (tails of strong peaks)
+TOP_CANDIDATES  = 24         # templates passed from the screen to NNLS
+MIN_SIGNIFICANCE = 3.0       # z at which confidence is 50 %
+DROP_SIGNIFICANCE = 1.0      # nuclides the fit needs less than this are dropped
+STRONG_LINE     = 0.25       # lines above this fraction of a nuclide's strongest line
+LINE_WINDOW     = 2.0        # line present test over +-2 sigma
+LINE_SIGNIFICANCE = 3.0      # net counts / error for a line to count as present
+MIN_LINES_PRESENT = 0.6      # fraction of strong lines that must be present
+CACHE_SIZE      = 4
+
+
+def library_path():
+    """User library first, bundled copy as fallback."""
+    user = Path(shared.USER_DATA_DIR) / "lib" / "isotopes.json"
+    if user.exists():
+        return user
+    return Path(__file__).resolve().parent / "assets" / "lib" / "isotopes.json"
+
+
+class TemplateMatrix:
+    """Unit-area line templates for one library, calibration and bin count."""
+
+    def __init__(self, library, coeffs, bins, resolution=RESOLUTION_662, include_xray=False):
+        self.bins   = int(bins)
+        self.names  = []
+        self.matrix = np.zeros((self.bins, 0), dtype=np.float32)
+
+        # every line: owning column, channel, width (channels), strong flag
+        self.line_col    = np.zeros(0, dtype=np.int64)
+        self.line_centre = np.zeros(0)
+        self.line_sigma  = np.zeros(0)
+        self.line_strong = np.zeros(0, dtype=bool)
+        self.smoothing   = 3
+
+        ch     = np.arange(self.bins, dtype=float)
+        energy = np.polyval(coeffs, ch)
+        slope  = np.gradient(energy)
+        if self.bins < 8 or not np.all(slope > 0):
+            logger.warning("👆 nuclide_id needs a monotonic energy calibration")
+            return
+
+        # background smoothing window: one FWHM at 662 keV, odd, in channels
+        fwhm_662 = (resolution / 100.0) * 662.0 / float(np.interp(662.0, energy, slope))
+        self.smoothing = max(3, int(fwhm_662) | 1)
+
+        # flatten all lines: owner column, energy, intensity
+        names, col, e_line, i_line = [], [], [], []
+        for name, entry in library.items():
+            lines = [ln for ln in entry.get("lines", [])
+                     if include_xray or str(ln.get("label", "")).lower() != "x-ray"]
+            e_min = MIN_ENERGY_KEV if include_xray else XRAY_MAX_KEV
+            k = len(names)
+            used = False
+            for ln in lines:
+                try:
+                    e, inten = float(ln["energy"]), float(ln["intensity"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if inten > 0 and e_min <= e <= energy[-1] and e >= energy[0]:
+                    col.append(k)
+                    e_line.append(e)
+                    i_line.append(inten)
+                    used = True
+            if used:
+                names.append(name)
+        if not names:
+            return
+
+        col    = np.asarray(col)
+        e_line = np.asarray(e_line)
+        i_line = np.asarray(i_line)
+
+        # channel position and width (channels) of every line
+        centre = np.interp(e_line, energy, ch)
+        fwhm_e = (resolution / 100.0) * 662.0 * np.sqrt(e_line / 662.0)
+        sigma  = np.maximum(0.5, fwhm_e / np.interp(e_line, energy, slope) / 2.3548)
+
+        # evaluate every line on its own +-SPREAD_SIGMA window in one go
+        half   = np.ceil(SPREAD_SIGMA * sigma).astype(np.int64)
+        length = 2 * half + 1
+        line   = np.repeat(np.arange(len(centre)), length)
+        starts = np.concatenate(([0], np.cumsum(length)[:-1]))
+        offset = np.arange(length.sum()) - np.repeat(starts, length) - half[line]
+        idx    = np.rint(centre).astype(np.int64)[line] + offset
+        ok     = (idx >= 0) & (idx < self.bins)
+        line, idx = line[ok], idx[ok]
+        val    = i_line[line] * np.exp(-0.5 * ((idx - centre[line]) / sigma[line]) ** 2) \
+                 / (sigma[line] * math.sqrt(2.0 * math.pi))
+
+        m = np.zeros((self.bins, len(names)))
+        np.add.at(m, (idx, col[line]), val)
+        area = m.sum(axis=0)
+        keep = area > 0
+        self.names  = [n for n, k in zip(names, keep) if k]
+        self.matrix = (m[:, keep] / area[keep]).astype(np.float32)
+
+        kept   = keep[col]
+        newcol = (np.cumsum(keep) - 1)[col[kept]]
+        top    = np.zeros(len(self.names))
+        np.maximum.at(top, newcol, i_line[kept])
+        self.line_col    = newcol
+        self.line_centre = centre[kept]
+        self.line_sigma  = sigma[kept]
+        self.line_strong = i_line[kept] >= STRONG_LINE * top[newcol]
+
+    def __len__(self):
+        return len(self.names)
+
+    def lines_present(self, y):
+        """
+        Fraction of each nuclide's strong lines that stand out of the gross
+        spectrum y: counts over +-LINE_WINDOW sigma against a linear
+        background from equal side bands on both sides, at LINE_SIGNIFICANCE.
+        """
+        s = self.line_strong
+        if not s.any():
+            return np.zeros(len(self.names))
+        cs = np.concatenate(([0.0], np.cumsum(y)))
+        n  = self.bins
+
+        def window(a, b):
+            a = np.clip(a, 0, n).astype(np.int64)
+            b = np.clip(b, 0, n).astype(np.int64)
+            return cs[b] - cs[a], (b - a).astype(float)
+
+        c    = self.line_centre[s]
+        half = np.maximum(LINE_WINDOW * self.line_sigma[s], 1.0)
+        lo   = np.floor(c - half)
+        hi   = np.ceil(c + half) + 1
+        band = hi - lo
+        g, wg = window(lo, hi)
+        l, wl = window(lo - band, lo)
+        r, wr = window(hi, hi + band)
+
+        # background density per channel from whichever side bands exist
+        dens = (l + r) / np.maximum(wl + wr, 1.0)
+        bkg  = dens * wg
+        var  = g + bkg * wg / np.maximum(wl + wr, 1.0)
+        net  = g - bkg
+        present = (wl + wr > 0) & (net >= LINE_SIGNIFICANCE * np.sqrt(np.maximum(var, 1.0)))
+
+        cols   = self.line_col[s]
+        strong = np.bincount(cols, minlength=len(self.names))
+        found  = np.bincount(cols, weights=present, minlength=len(self.names))
+        return found / np.maximum(strong, 1)
+
+    def look_alikes(self, cols):
+        """
+        Symmetric boolean matrix over the columns cols: [i, j] is True when
+        every strong line of one of the two lies within LINE_WINDOW sigma of
+        a strong line of the other, so the spectrum cannot tell them apart.
+        """
+        cols = np.asarray(cols, dtype=np.int64)
+        pos  = np.full(len(self.names), -1)
+        pos[cols] = np.arange(len(cols))
+        s    = self.line_strong & (pos[self.line_col] >= 0)
+        own  = np.eye(len(cols), dtype=float)[pos[self.line_col[s]]]     # line -> its column
+        c, sig = self.line_centre[s], self.line_sigma[s]
+        near = np.abs(c[:, None] - c[None, :]) <= LINE_WINDOW * sig[:, None]
+        hit  = (near.astype(float) @ own) > 0          # line of i sits on a line of j
+        covered = own.T @ hit                          # lines of i on j
+        n    = own.sum(axis=0)
+        same = (covered == n[:, None]) & (n[:, None] > 0)
+        same = same | same.T
+        np.fill_diagonal(same, False)
+        return same
+
+
+
+class Identifier:
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = int(cache_size)
+        self._lock      = threading.Lock()
+        self._library   = (None, None)       # (path, mtime) -> parsed json
+        self._lib_data  = {}
+        self._templates = OrderedDict()
+
+    # ---- cached inputs -------------------------------------------
+
+    def library(self):
+        path = library_path()
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            return {}
+        with self._lock:
+            if self._library == (str(path), mtime):
+                return self._lib_data
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            logger.error(f"  ❌ nuclide_id cannot read {path}: {e}")
+            data = {}
+        with self._lock:
+            self._library, self._lib_data = (str(path), mtime), data
+            self._templates.clear()
+        return data
+
+    def templates(self, coeffs, bins, resolution=RESOLUTION_662, include_xray=False):
+        """TemplateMatrix for this calibration, built once per calibration."""
+        library = self.library()
+        key = (tuple(float(c) for c in coeffs), int(bins), float(resolution), bool(include_xray))
+        with self._lock:
+            hit = self._templates.get(key)
+            if hit is not None:
+                self._templates.move_to_end(key)
+                return hit
+        tm = TemplateMatrix(library, coeffs, bins, resolution, include_xray)
+        with self._lock:
+            self._templates[key] = tm
+            while len(self._templates) > self.cache_size:
+                self._templates.popitem(last=False)
+        logger.info(f"   ✅ nuclide_id templates: {len(tm)} nuclides x {tm.bins} bins")
+        return tm
+
+    # ---- scoring -------------------------------------------------
+
+    def identify(self, y, coeffs, resolution=RESOLUTION_662, include_xray=False, top=5):
+        """
+        Ranked nuclides for spectrum `y` (calibration coeffs [c1, c2, c3],
+        x^2 first). Returns a list of dicts, best first:
+        nuclide, counts (fitted net counts), significance (z), confidence (0..1).
+        """
+        y = np.nan_to_num(np.asarray(y, dtype=float))
+        if len(y) < 8 or y.sum() <= 0:
+            return []
+        tm = self.templates(coeffs, len(y), resolution, include_xray)
+        if not len(tm):
+            return []
+
+        # SNIP on the raw counts is a lower envelope of the noise and leaves a
+        # positive net everywhere; on counts smoothed over one FWHM it follows
+        # the continuum, and the signed net averages to zero off the peaks
+        net = y - snip.background(snip.smooth(y, tm.smoothing), smoothing=0)
+        w   = 1.0 / np.sqrt(np.maximum(y, 1.0))          # Poisson weights on gross counts
+        T   = tm.matrix
+
+        # screen: weighted correlation of every template whose strong lines
+        # are mostly there with the net spectrum
+        Tw    = T * w[:, None]
+        norms = np.sqrt(np.einsum("ij,ij->j", Tw, Tw))
+        score = (Tw.T @ (net * w)) / np.where(norms > 0, norms, 1.0)
+        score[tm.lines_present(y) < MIN_LINES_PRESENT] = 0.0
+        cand  = np.argsort(score)[::-1][:TOP_CANDIDATES]
+        cand  = cand[score[cand] > 0]
+        if not len(cand):
+            return []
+
+        # NNLS on the short list; columns compete for shared lines. Rows no
+        # candidate covers add the same to every chi-square and are left out.
+        rows = np.flatnonzero((T[:, cand] > 0).any(axis=1))
+        A    = Tw[:, cand][rows].astype(float)
+        b    = (net * w)[rows]
+        # every refit below works on the small R of A = QR: the chi-square of
+        # any set of columns is |R x - Q'b|^2 plus what Q does not span
+        try:
+            Q, R = np.linalg.qr(A)
+            c    = Q.T @ b
+            coef, _ = _fit(R, c, range(len(cand)))
+        except Exception as e:
+            logger.warning(f"👆 nuclide_id nnls failed: {e}")
+            return []
+
+        # backward elimination on the chi-square gain of each nuclide, scaled
+        # by the reduced chi-square under its own lines when the fit is worse
+        # than Poisson there (a template soaking up a peak-shape mismatch)
+        keep  = [k for k in range(len(cand)) if coef[k] > 0]
+        near  = A > 0.01 * A.max(axis=0)
+        alike = tm.look_alikes(cand)
+        gain  = {}
+        while keep:
+            coef, chi2 = _fit(R, c, keep)
+            r2    = (A @ coef - b) ** 2
+            scale = {k: max(1.0, float(r2[near[:, k]].mean())) for k in keep}
+            gain  = {k: (_fit(R, c, [j for j in keep if j != k])[1] - chi2) / scale[k] for k in keep}
+            weak  = min(keep, key=gain.get)
+            if gain[weak] < DROP_SIGNIFICANCE ** 2:
+                keep.remove(weak)
+                continue
+            # look-alikes: keep the one the fit needs most
+            shadowed = [k for k in keep if alike[k, keep].any()]
+            if shadowed:
+                keep.remove(min(shadowed, key=gain.get))
+                continue
+            break
+
+        out = []
+        for k in sorted(keep, key=gain.get, reverse=True)[:top]:
+            z = math.sqrt(max(gain[k], 0.0))
+            out.append({
+                "nuclide":      tm.names[cand[k]],
+                "counts":       float(coef[k]),
+                "significance": z,
+                "confidence":   float(ndtr(z - MIN_SIGNIFICANCE)),
+            })
+        return out
+
+
+def _fit(A, b, cols):
+    """NNLS on the columns cols of A. Returns (coefficients for all columns, |A x - b|^2)."""
+    cols = list(cols)
+    coef = np.zeros(A.shape[1])
+    if not cols:
+        return coef, float(b @ b)
+    x, rnorm = nnls(A[:, cols], b)
+    coef[cols] = x
+    return coef, float(rnorm) ** 2
+
+
+# Shared identifier (keeps the library and template matrices)
+identifier = Identifier()
+
+
+def identify(y, coeffs, top=5):
+    """identify() with the nuclide_id_resolution / nuclide_id_xray settings."""
+    with shared.write_lock:
+        res  = getattr(shared, "nuclide_id_resolution", RESOLUTION_662)
+        xray = bool(getattr(shared, "nuclide_id_xray", False))
+    try:
+        res = float(res) if float(res) > 0 else RESOLUTION_662
+    except (TypeError, ValueError):
+        res = RESOLUTION_662
+    return identifier.identify(y, coeffs, res, xray, top)
@@ -0,0 +1,246 @@
+# peak_fit.py
+#
+# Gaussian peak fits for ROIs.
+#
+# fit_all() fits every ROI of a spectrum in one call. Each ROI is modelled as
+# one or more Gaussians (overlapping peaks are fitted together) on a
+#
+#   "linear" background   b0 + b1 * (x - i0)
+#   "step"   background   the same plus, per peak, a smoothed step
+#                         h * erfc((x - mu) / (sqrt(2) * sigma)) / 2
+#
+# using Poisson weights and an analytic Jacobian. Results carry centroid,
+# sigma, FWHM and net area with 1-sigma uncertainties from the covariance.
+#
+# The fitter remembers the last parameters per ROI and starts the next fit
+# from them, and returns the previous results outright when neither the
+# spectrum nor the ROIs have changed, so re-fitting on every UI tick is cheap.
+
+import math
+import hashlib
+import threading
+
+import numpy as np
+
+from scipy.optimize import least_squares
+from scipy.special import erfc
+
+from shared import logger
+
+MODELS      = ("linear", "step")
+FWHM_SIGMA  = 2.0 * math.sqrt(2.0 * math.log(2.0))    # 2.3548
+SQRT_2PI    = math.sqrt(2.0 * math.pi)
+MIN_SIGMA   = 0.3
+MAX_NFEV    = 200
+
+
+def _roi_spec(roi):
+    """(key, i0, i1, initial centroids or None) for a dict or (i0, i1) ROI."""
+    if isinstance(roi, dict):
+        i0, i1 = int(roi["i0"]), int(roi["i1"])
+        key    = roi.get("uid", (i0, i1))
+        peaks  = roi.get("peaks")
+    else:
+        i0, i1 = int(roi[0]), int(roi[1])
+        key, peaks = (i0, i1), None
+    if i1 < i0:
+        i0, i1 = i1, i0
+    return key, i0, i1, (list(peaks) if peaks else None)
+
+
+class _Model:
+    """Residuals and Jacobian for one ROI. p = [b0, b1] + per peak [A, mu, sigma(, h)]."""
+
+    def __init__(self, x, y, n_peaks, step):
+        self.x, self.y = x, y
+        self.t    = x - x[0]
+        self.k    = n_peaks
+        self.step = step
+        self.per  = 4 if step else 3
+        self.w    = 1.0 / np.sqrt(np.maximum(y, 1.0))
+
+    def split(self, p):
+        return p[:2], p[2:].reshape(self.k, self.per)
+
+    def evaluate(self, p, jac=False):
+        (b0, b1), peaks = self.split(p)
+        f = b0 + b1 * self.t
+        J = np.empty((len(self.x), len(p))) if jac else None
+        if jac:
+            J[:, 0] = 1.0
+            J[:, 1] = self.t
+        for j, q in enumerate(peaks):
+            A, mu, s = q[0], q[1], q[2]
+            d = self.x - mu
+            g = np.exp(-0.5 * (d / s) ** 2)
+            f = f + A * g
+            if jac:
+                c = 2 + j * self.per
+                J[:, c]     = g
+                J[:, c + 1] = A * g * d / s ** 2
+                J[:, c + 2] = A * g * d ** 2 / s ** 3
+            if self.step:
+                h = q[3]
+                S = 0.5 * erfc(d / (math.sqrt(2.0) * s))
+                f = f + h * S
+                if jac:
+                    J[:, c + 1] += h * g / (SQRT_2PI * s)
+                    J[:, c + 2] += h * g * d / (SQRT_2PI * s ** 2)
+                    J[:, c + 3]  = S
+        return (f, J) if jac else f
+
+    def residuals(self, p):
+        return (self.evaluate(p) - self.y) * self.w
+
+    def jacobian(self, p):
+        return self.evaluate(p, jac=True)[1] * self.w[:, None]
+
+
+class PeakFitter:
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self._warm   = {}         # (key, model, n_peaks) -> params
+        self._last   = None       # (signature, results)
+        self.fits    = 0
+        self.reused  = 0
+
+    # ---- public --------------------------------------------------
+
+    def fit_all(self, y, rois, model="linear"):
+        """
+        Fit every ROI. `rois` are dicts (i0, i1, optional uid and "peaks": a
+        list of initial centroids for overlapping peaks) or (i0, i1) tuples.
+        Returns one result dict per ROI, in order (see _fit_one).
+        """
+        model = model if model in MODELS else "linear"
+        y     = np.nan_to_num(np.asarray(y, dtype=float))
+        specs = [_roi_spec(r) for r in rois]
+        sig   = (hashlib.blake2b(y.tobytes(), digest_size=16).hexdigest(), model,
+                 tuple((k, a, b, tuple(p) if p else None) for k, a, b, p in specs))
+
+        with self._lock:
+            if self._last is not None and self._last[0] == sig:
+                self.reused += 1
+                return self._last[1]
+
+        results = [self._fit_one(y, key, i0, i1, peaks, model) for key, i0, i1, peaks in specs]
+
+        with self._lock:
+            self._last = (sig, results)
+        return results
+
+    def forget(self, key=None):
+        """Drop warm starts (all, or one ROI key)."""
+        with self._lock:
+            if key is None:
+                self._warm.clear()
+            else:
+                self._warm = {k: v for k, v in self._warm.items() if k[0] != key}
+            self._last = None
+
+    def stats(self):
+        with self._lock:
+            return {"fits": self.fits, "reused": self.reused, "warm": len(self._warm)}
+
+    # ---- one ROI -------------------------------------------------
+
+    def _initial(self, x, y, peaks):
+        n  = len(x)
+        b0 = float(min(y[0], y[-1]))
+        b1 = float((y[-1] - y[0]) / max(1, n - 1))
+        if not peaks:
+            peaks = [float(x[int(np.argmax(y))])]
+        width = max(MIN_SIGMA, n / (6.0 * len(peaks)))
+        p = [b0, b1]
+        for mu in peaks:
+            k   = int(np.clip(round(mu - x[0]), 0, n - 1))
+            amp = max(1.0, float(y[k]) - (b0 + b1 * k))
+            p  += [amp, float(mu), width]
+        return np.array(p, dtype=float), len(peaks)
+
+    def _bounds(self, x, k, step):
+        lo, hi = [-np.inf, -np.inf], [np.inf, np.inf]
+        for _ in range(k):
+            lo += [0.0, float(x[0]), MIN_SIGMA]
+            hi += [np.inf, float(x[-1]), max(MIN_SIGMA * 2, float(len(x)))]
+            if step:
+                lo.append(0.0)
+                hi.append(np.inf)
+        return np.array(lo), np.array(hi)
+
+    def _fit_one(self, y_all, key, i0, i1, peaks, model):
+        n      = len(y_all)
+        i0, i1 = max(0, i0), min(n - 1, i1)
+        step   = model == "step"
+        result = {"key": key, "i0": i0, "i1": i1, "model": model, "ok": False, "peaks": []}
+
+        k_req = len(peaks) if peaks else 1
+        if i1 - i0 + 1 < 3 * k_req + 3:
+            result["error"] = "ROI too narrow"
+            return result
+
+        x = np.arange(i0, i1 + 1, dtype=float)
+        y = y_all[i0:i1 + 1]
+        p0, k = self._initial(x, y, peaks)
+        m     = _Model(x, y, k, step)
+        if step:
+            p0 = np.insert(p0.reshape(-1), [2 + 3 * (j + 1) for j in range(k)], 0.0)
+
+        wkey = (key, model, k)
+        lo, hi = self._bounds(x, k, step)
+        with self._lock:
+            warm = self._warm.get(wkey)
+        if warm is not None and len(warm) == len(p0) and np.all(warm >= lo) and np.all(warm <= hi):
+            p0 = warm
+        p0 = np.clip(p0, lo + 1e-9 * (np.isfinite(lo)), hi - 1e-9 * (np.isfinite(hi)))
+
+        try:
+            fit = least_squares(m.residuals, p0, jac=m.jacobian, bounds=(lo, hi),
+                                method="trf", x_scale="jac", max_nfev=MAX_NFEV)
+        except Exception as e:
+            logger.warning(f"👆 ROI fit {i0}-{i1} failed: {e}")
+            result["error"] = str(e)
+            return result
+
+        p    = fit.x
+        dof  = max(1, len(x) - len(p))
+        chi2 = float(np.sum(fit.fun ** 2))
+        red  = chi2 / dof
+        try:
+            cov = np.linalg.pinv(fit.jac.T @ fit.jac) * max(1.0, red)
+        except np.linalg.LinAlgError:
+            cov = np.full((len(p), len(p)), np.nan)
+        err = np.sqrt(np.clip(np.diag(cov), 0, None))
+
+        with self._lock:
+            self.fits += 1
+            self._warm[wkey] = p.copy()
+
+        (b0, b1), pk = m.split(p)
+        per = m.per
+        for j, q in enumerate(pk):
+            c      = 2 + j * per
+            A, mu, s = q[0], q[1], q[2]
+            area   = A * s * SQRT_2PI
+            var_a  = (s * SQRT_2PI) ** 2 * cov[c, c] + (A * SQRT_2PI) ** 2 * cov[c + 2, c + 2] \
+                     + 2 * (2 * math.pi) * A * s * cov[c, c + 2]
+            result["peaks"].append({
+                "amplitude":    float(A),
+                "centroid":     float(mu),
+                "centroid_err": float(err[c + 1]),
+                "sigma":        float(s),
+                "sigma_err":    float(err[c + 2]),
+                "fwhm":         float(s * FWHM_SIGMA),
+                "fwhm_err":     float(err[c + 2] * FWHM_SIGMA),
+                "area":         float(area),
+                "area_err":     float(math.sqrt(max(0.0, var_a))),
+                "step":         float(q[3]) if step else 0.0,
+            })
+        result.update(ok=bool(fit.success), background=[float(b0), float(b1)],
+                      chi2_red=float(red), nfev=int(fit.nfev))
+        return result
+
+
+# Shared fitter (keeps warm starts between UI refreshes)
+fitter = PeakFitter()
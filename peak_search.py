@@ -0,0 +1,121 @@
+# peak_search.py
+#
+# Peak search for 2D spectra, computed in one pass and cached.
+#
+# search() smooths the spectrum, runs find_peaks once and peak_widths once
+# (reusing the prominences find_peaks already has), then reports each peak
+# that passes the width filter with its channel, centroid, FWHM, prominence
+# and net area. Results are cached per spectrum version and parameters; the
+# version is a digest of the counts unless the caller passes one, so a click
+# or redraw on an unchanged spectrum is a dictionary lookup.
+
+import hashlib
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+from scipy.signal import find_peaks, peak_widths
+
+CACHE_SIZE = 16
+DISTANCE   = 30         # minimum channels between peaks (as before)
+
+
+def spectrum_version(y):
+    """Content digest of a spectrum, used as cache key when no version is given."""
+    a = np.ascontiguousarray(y, dtype=float)
+    return hashlib.blake2b(a.tobytes(), digest_size=16).hexdigest()
+
+
+def _net_area(y, i0, i1):
+    """Counts in [i0, i1] above a straight line between the two edge channels."""
+    yr = y[i0:i1 + 1]
+    if len(yr) < 2:
+        return float(np.nansum(yr))
+    bkg = np.linspace(yr[0], yr[-1], len(yr))
+    return float(np.nansum(yr - bkg))
+
+
+class PeakSearch:
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = int(cache_size)
+        self._cache     = OrderedDict()
+        self._lock      = threading.Lock()
+        self.hits       = 0
+        self.misses     = 0
+
+    def search(self, y_values, prominence, min_width, smoothing_window=3, version=None):
+        """
+        List of peak dicts (index, centroid, fwhm, prominence, area, i0, i1)
+        in channel order. Cached: do not modify the returned dicts.
+        """
+        y   = np.asarray(y_values, dtype=float)
+        key = (version if version is not None else spectrum_version(y),
+               len(y), float(prominence), float(min_width), int(smoothing_window))
+
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return hit
+
+        result = self._compute(y, prominence, min_width, int(smoothing_window))
+
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = result
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    def _compute(self, y, prominence, min_width, window):
+        if len(y) < window or window < 1:
+            return []
+        smoothed = np.convolve(y, np.ones(window) / window, mode="valid")
+        peaks, props = find_peaks(smoothed, prominence=prominence, distance=DISTANCE)
+        if not len(peaks):
+            return []
+
+        prom = props["prominences"]
+        widths, _, _, _ = peak_widths(
+            smoothed, peaks, rel_height=0.5,
+            prominence_data=(prom, props["left_bases"], props["right_bases"]),
+        )
+
+        offset = (window - 1) // 2      # smoothed index -> channel
+        n      = len(y)
+        x      = np.arange(n, dtype=float)
+        out    = []
+        for p, w, pr in zip(peaks, widths, prom):
+            if w < min_width:
+                continue
+            ch   = int(p) + offset
+            half = max(1, int(round(w)))
+            i0   = max(0, ch - half)
+            i1   = min(n - 1, ch + half)
+            seg  = y[i0:i1 + 1]
+            tot  = float(np.nansum(seg))
+            out.append({
+                "index":      ch,
+                "centroid":   float(np.nansum(x[i0:i1 + 1] * seg) / tot) if tot > 0 else float(ch),
+                "fwhm":       round(float(w), 1),
+                "prominence": float(pr),
+                "area":       _net_area(y, i0, i1),
+                "i0":         i0,
+                "i1":         i1,
+            })
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "cached": len(self._cache)}
+
+
+# Shared engine for the spectrum tab and peak_finder()
+engine = PeakSearch()
@@ -0,0 +1,158 @@
+# persistence.py
+#
+# One save pipeline for every device path (audio pulsecatcher, MAX
+# dispatcher, Teensy poller).
+#
+# Recorders hand over a save job (a callable with its data already bound)
+# under a key, normally the file it writes. submit() only takes a lock and
+# never does I/O, so acquisition threads are not held up by JSON encoding,
+# compression or fsync.
+#
+#   - per-key debouncing: a key is not saved more often than min_interval;
+#     a newer job for a key that is still waiting replaces it (merged)
+#   - bounded: at most max_pending keys wait at once, further non-priority
+#     jobs are dropped and counted
+#   - priority=True (used on stop) runs the job ahead of everything else,
+#     and flush() runs all pending jobs now and waits for them and for the
+#     atomic writes in checkpoint.service to finish
+
+import time
+import threading
+
+import checkpoint
+from shared import logger
+
+MAX_PENDING  = 32
+MIN_INTERVAL = 5.0      # seconds between saves of the same key
+
+
+class SaveService:
+
+    def __init__(self, max_pending=MAX_PENDING, min_interval=MIN_INTERVAL):
+        self.max_pending  = int(max_pending)
+        self.min_interval = float(min_interval)
+        self._cond        = threading.Condition()
+        self._jobs        = {}      # key -> {"fn", "due", "priority"}
+        self._last_run    = {}      # key -> monotonic start of last run
+        self._running     = None
+        self._thread      = None
+        self._last_ms     = {}
+        self.submitted    = 0
+        self.merged       = 0
+        self.dropped      = 0
+        self.completed    = 0
+        self.failed       = 0
+        self.max_depth    = 0
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True, name="SaveService")
+            self._thread.start()
+
+    def submit(self, key, fn, priority=False, min_interval=None):
+        """Queue fn() to run for `key`. Returns False if the job was dropped."""
+        now = time.monotonic()
+        gap = self.min_interval if min_interval is None else float(min_interval)
+        with self._cond:
+            self.submitted += 1
+            job = self._jobs.get(key)
+            if job is not None:
+                self.merged     += 1
+                job["fn"]        = fn
+                if priority:
+                    job["priority"] = True
+                    job["due"]      = now
+            else:
+                if len(self._jobs) >= self.max_pending and not priority:
+                    self.dropped += 1
+                    logger.warning(f"👆 save queue full ({len(self._jobs)}), dropped save for {key}")
+                    return False
+                due = now if priority else max(now, self._last_run.get(key, 0.0) + gap)
+                self._jobs[key] = {"fn": fn, "due": due, "priority": bool(priority)}
+                self.max_depth  = max(self.max_depth, len(self._jobs))
+            self._ensure_thread()
+            self._cond.notify_all()
+        return True
+
+    def flush(self, timeout=30.0):
+        """Run every pending job now and wait until they and their file writes are done."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            now = time.monotonic()
+            for job in self._jobs.values():
+                job["due"]      = now
+                job["priority"] = True
+            self._cond.notify_all()
+            while self._jobs or self._running is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    logger.warning(f"👆 save flush timed out ({len(self._jobs)} pending)")
+                    return False
+                self._cond.wait(left)
+            logger.info(f"   ✅ saves flushed: {self.completed} done, {self.merged} merged, "
+                        f"{self.dropped} dropped, max queue {self.max_depth}")
+        return checkpoint.service.flush(max(0.1, deadline - time.monotonic()))
+
+    def _next_job(self):
+        """Pick the job to run next. Caller holds the lock."""
+        if not self._jobs:
+            return None, None
+        key = min(self._jobs, key=lambda k: (not self._jobs[k]["priority"], self._jobs[k]["due"]))
+        return key, self._jobs[key]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    key, job = self._next_job()
+                    if job is None:
+                        self._cond.wait()
+                        continue
+                    wait = job["due"] - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                del self._jobs[key]
+                self._running       = key
+                self._last_run[key] = time.monotonic()
+
+            t0 = time.perf_counter()
+            ok = True
+            try:
+                job["fn"]()
+            except Exception as e:
+                ok = False
+                logger.error(f"  ❌ save job {key} failed: {e}", exc_info=True)
+            ms = (time.perf_counter() - t0) * 1000.0
+
+            with self._cond:
+                self._running      = None
+                self._last_ms[key] = ms
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed    += 1
+                self._cond.notify_all()
+
+    def depth(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "depth":     len(self._jobs),
+                "max_depth": self.max_depth,
+                "running":   self._running,
+                "submitted": self.submitted,
+                "merged":    self.merged,
+                "dropped":   self.dropped,
+                "completed": self.completed,
+                "failed":    self.failed,
+                "last_ms":   dict(self._last_ms),
+                "writes":    checkpoint.service.stats(),
+            }
+
+
+# Single service shared by all device paths
+service = SaveService()
@@ -13,7 +13,12 @@ import struct
 import functions as fn
 import gps_main  # at top of file is better, but ok here for first test
 import save
+import persistence
+import recovery
+import waterfall_store
+import pyramid
 
+from functools import partial
 from shared import logger
 
 # Function reads audio stream and finds pulses then outputs time, pulse height, and distortion
@@ -41,6 +46,7 @@ def pulsecatcher(mode, run_flag, run_flag_lock):
         chunk_size      = shared.chunk_size
         threshold       = (shared.threshold * int(shared.bin_size))
         tolerance       = shared.tolerance
+        compression     = int(shared.compression)
         bin_size        = int(shared.bin_size)
         max_counts      = shared.max_counts
         sample_length   = shared.sample_length
@@ -62,7 +68,7 @@ def pulsecatcher(mode, run_flag, run_flag_lock):
         shared.counts          = 0
         shared.dropped_counts  = 0
         shared.histogram       = [0] * bins
-        shared.count_history   = []
+        shared.count_history.clear()
         shared.histogram_hmp   = [] 
 
     # Fixed variables
@@ -101,9 +107,43 @@ def pulsecatcher(mode, run_flag, run_flag_lock):
         
         with shared.write_lock: shared.doing = f"[ERROR] Device not selected: {e}"
 
-    save_queue  = queue.Queue()
-    save_thread = threading.Thread(target=save_data, args=(save_queue,))
-    save_thread.start()
+    save_queue  = queue.Queue()   # mode 3 rows from fn.update_mode_3_data()
+    store       = None            # waterfall_store, opened on the first row
+
+    # Resume an interrupted run: carry on from its last checkpoint
+    resumed = recovery.take(filename, mode)
+    if resumed:
+        state = recovery.load_spectrum(filename, bins)
+        if state is not None and mode == 3:
+            store, _ = recovery.reopen_store(filename, bins)
+        if state is None or (mode == 3 and store is None):
+            # a fresh run would delete the CPS file and overwrite the store
+            logger.error(f"  ❌ Resume of {filename} failed, recording not started (files left as they were)")
+            try:
+                stream.close()
+            except Exception:
+                pass
+            p.terminate()
+            with shared.write_lock:
+                shared.run_flag.clear()
+                shared.save_done.set()
+            return
+        full_histogram  = state["histogram"]
+        last_histogram  = full_histogram.copy()
+        local_counts    = state["counts"]
+        last_count      = local_counts
+        dropped_counts  = state["dropped_counts"]
+        local_elapsed   = state["elapsed"]
+        t0              = state["dt_start"]
+        time_start      = time.time() - local_elapsed
+        with shared.write_lock:
+            shared.counts          = local_counts
+            shared.elapsed         = local_elapsed
+            shared.dropped_counts  = dropped_counts
+            shared.histogram       = full_histogram.copy()
+
+    recovery.begin(filename, mode, device, resumed=resumed)
+    pyramid.primary.reset(full_histogram, compression)
     
     # Main pulsecatcher while loop
     while shared.run_flag.is_set() and local_counts < max_counts and local_elapsed <= max_seconds:
@@ -184,7 +224,9 @@ def pulsecatcher(mode, run_flag, run_flag_lock):
                 shared.spec_notes       = spec_notes
                 shared.dropped_counts   = dropped_counts
                 if mode in (2, 4):
-                    shared.histogram    = full_histogram.copy()  
+                    # shown at the selected resolution, recorded at ours
+                    pyramid.primary.update(full_histogram)
+                    shared.histogram    = pyramid.primary.level(shared.compression) or full_histogram.copy()
                 shared.count_history.append(counts_per_sec)
 
             interval_counter, last_histogram = fn.update_mode_3_data(
@@ -212,39 +254,29 @@ def pulsecatcher(mode, run_flag, run_flag_lock):
             )
 
 
+            # rows only go into the store's memory buffer here; they reach
+            # disk with the next spectrum save
+            store = append_hmp_rows(save_queue, store, filename, device, t0, t_interval,
+                                    [coeff_3, coeff_2, coeff_1])
+
             last_count = local_counts
             time_last_save = time_this_save
             local_count_history.append(counts_per_sec)
 
         # Save spectrum file every 30 seconds or on STOP
         if time_this_save - time_last_save_time >= 30 or not shared.run_flag.is_set():
-            queue_save_data(
-                save_queue,
-                {
-                    't0': t0,
-                    't1': t1,
-                    'bins': bins,
-                    'local_counts': local_counts,
-                    'dropped_counts': dropped_counts,
-                    'local_elapsed': local_elapsed,
-                    'coeff_1': coeff_1,
-                    'coeff_2': coeff_2,
-                    'coeff_3': coeff_3,
-                    'device': device,
-                    'location': '',
-                    'spec_notes': spec_notes,
-                    'local_count_history': local_count_history
-                },
-                full_histogram,
-                filename
-            )
+            queue_save_data(filename, device, full_histogram, local_counts, dropped_counts,
+                            local_elapsed, [coeff_1, coeff_2, coeff_3], spec_notes, t0, t1, store)
 
             time_last_save_time = time_this_save
             time.sleep(0)
 
-    # Save and exit
-    save_queue.put(None)
-    save_thread.join()
+    # Save and exit: final save jumps the queue and is on disk before we return
+    queue_save_data(filename, device, full_histogram, local_counts, dropped_counts,
+                    local_elapsed, [coeff_1, coeff_2, coeff_3], spec_notes, t0,
+                    datetime.datetime.now(), store, final=True)
+    persistence.service.flush()
+    recovery.finish(filename, mode)
     p.terminate()  # Closes stream when done
 
     with shared.write_lock:
@@ -254,67 +286,45 @@ def pulsecatcher(mode, run_flag, run_flag_lock):
 
     #======================================================================================
 
-def queue_save_data(save_queue, meta, full_histogram, filename):
-    data = meta.copy()
-    data["filename"] = filename
-    data["full_histogram"] = full_histogram.copy()
-    save_queue.put(data)
-
-# Function to save data in a separate thread
-def save_data(save_queue):
-    while True:
-        data = save_queue.get()
-        if data is None:
-            break
-        t0                  = data['t0']
-        t1                  = data['t1']
-        bins                = int(data['bins'])
-        local_counts        = data['local_counts']
-        dropped_counts      = data['dropped_counts']
-        local_elapsed       = data['local_elapsed']
-        coeff_1             = data['coeff_1']
-        coeff_2             = data['coeff_2']
-        coeff_3             = data['coeff_3']
-        device              = data['device']
-        location            = data['location']
-        spec_notes          = data['spec_notes']
-        local_count_history = data['local_count_history']
-        gps                 = data.get('gps')
-
-        if 'filename' in data and 'full_histogram' in data:
-                    filename        = data['filename']
-                    full_histogram  = data['full_histogram']
-                    save.save_histogram_json(
-                        filename=filename,
-                        device=device,
-                        histogram=full_histogram,
-                        counts=local_counts,
-                        dropped_counts=dropped_counts,
-                        elapsed=local_elapsed,
-                        coeff_1=coeff_1,
-                        coeff_2=coeff_2,
-                        coeff_3=coeff_3,
-                        spec_notes=spec_notes,
-                        dt_start=t0,
-                        dt_now=t1,
-                    )
-                    save.save_count_history_csv(filename)
-
-        if 'filename' in data and 'histogram_rows' in data:
-            filename       = data['filename']
-            histogram_rows = data['histogram_rows']
-            gps_rows       = data['gps_rows']
-            save.save_histogram_hmp_json(
-                filename=filename,
-                histogram_rows=histogram_rows,
-                gps_rows=gps_rows,
-                counts=local_counts,
-                elapsed=local_elapsed,
-                coeffs=[coeff_3, coeff_2, coeff_1],
-                dt_start=t0,
-                dt_now=t1,
+def append_hmp_rows(save_queue, store, filename, device, t0, t_interval, coeffs):
+    """Move rows queued by fn.update_mode_3_data() into the waterfall store."""
+    while not save_queue.empty():
+        data = save_queue.get_nowait()
+        if 'last_minute' not in data:
+            continue
+        if store is None:
+            store = waterfall_store.WaterfallStore(
+                filename,
                 device=device,
+                coeffs=coeffs,
+                dt_start=t0,
+                t_interval=t_interval,
             )
+        store.append(data['last_minute'], data.get('gps'))
+    return store
+
+def queue_save_data(filename, device, full_histogram, counts, dropped_counts,
+                    elapsed, coeffs, spec_notes, t0, t1, store, final=False):
+    """Hand a spectrum save (plus 3D checkpoint) to the save service."""
+    if store is not None:
+        store.cut(counts, elapsed, t1)
+    persistence.service.submit(f"{filename}.json", partial(
+        save.save_recording,
+        store=store,
+        final=final,
+        filename=filename,
+        device=device,
+        histogram=full_histogram.copy(),
+        counts=counts,
+        dropped_counts=dropped_counts,
+        elapsed=elapsed,
+        coeff_1=coeffs[0],
+        coeff_2=coeffs[1],
+        coeff_3=coeffs[2],
+        spec_notes=spec_notes,
+        dt_start=t0,
+        dt_now=t1,
+    ), priority=final)
 
 
 
@@ -0,0 +1,243 @@
+# pyramid.py
+#
+# Multi-resolution spectrum pyramid.
+#
+# A SpectrumPyramid holds one spectrum at every BIN_OPTIONS compression that
+# can be derived from its finest (base) resolution: each level is the next
+# finer level reshaped and summed in pairs (a partial last bin is kept, as in
+# the recorders' own compression). update() takes a new base histogram and
+# adds only the changed channels to every level, so a live spectrum keeps all
+# levels current for the cost of its new counts.
+#
+# switch() changes the displayed resolution of the primary and comparison
+# spectra in shared without a reload: it swaps in the stored level and
+# rescales the calibration to the new channel width. Resolutions finer than
+# the recorded base are not available (switch() returns False), and neither
+# is a running recording whose recorder does not feed the pyramid. ROIs,
+# calibration points and coefficients are always rescaled from the values
+# they had before the first switch, so switching back and forth is exact.
+
+import threading
+
+import numpy as np
+
+import shared
+
+from shared import logger, BIN_OPTIONS
+
+COMPRESSIONS = sorted(int(c) for _, c in BIN_OPTIONS)
+
+
+def _rebin(a, k):
+    """Sum every k channels (zero-padding a partial last bin)."""
+    if k == 1:
+        return a.copy()
+    pad = (-len(a)) % k
+    if pad:
+        a = np.concatenate((a, np.zeros(pad, dtype=a.dtype)))
+    return a.reshape(-1, k).sum(axis=1)
+
+
+def scale_coeffs(coeffs, from_compression, to_compression):
+    """
+    Calibration [c1, c2, c3] (x^2 first) for channels of another compression.
+    Channel x at compression c covers device channels c*x .. c*x + c - 1, so
+    x_from = k * x_to + (k - 1) / 2 with k = to / from (bin centres line up).
+    """
+    a, b, c = (float(v) for v in coeffs)
+    k = float(to_compression) / float(from_compression)
+    d = (k - 1.0) / 2.0
+    return [a * k * k, (2.0 * a * d + b) * k, a * d * d + b * d + c]
+
+
+def _scale_channels(from_compression, to_compression):
+    """(i0, i1) -> (i0, i1) mapping of inclusive ROI channel ranges."""
+    f, t = int(from_compression), int(to_compression)
+    if t >= f:
+        k = t // f
+        return lambda i0, i1: (int(i0) // k, int(i1) // k)
+    m = f // t
+    return lambda i0, i1: (int(i0) * m, int(i1) * m + m - 1)
+
+
+class SpectrumPyramid:
+
+    def __init__(self):
+        self._lock   = threading.Lock()
+        self.base    = None       # compression of the finest level
+        self.source  = None       # compression the spectrum is saved at
+        self._levels = {}         # compression -> int64 array
+
+    def reset(self, histogram, compression, source=None):
+        """
+        Rebuild every level from `histogram` recorded at `compression`.
+        `source` is the compression of the file it is saved to, if different.
+        """
+        base = np.rint(np.nan_to_num(np.asarray(histogram, dtype=float))).astype(np.int64)
+        compression = max(1, int(compression))
+        levels = {compression: base}
+        prev_c = compression
+        for c in COMPRESSIONS:
+            if c <= compression or c % prev_c:
+                continue
+            levels[c] = _rebin(levels[prev_c], c // prev_c)
+            prev_c = c
+        with self._lock:
+            self.base, self._levels = compression, levels
+            self.source = int(source) if source else compression
+
+    def update(self, histogram):
+        """New base histogram; only changed channels are propagated upwards."""
+        new = np.rint(np.nan_to_num(np.asarray(histogram, dtype=float))).astype(np.int64)
+        with self._lock:
+            base = self.base
+            old  = self._levels.get(base) if base is not None else None
+        if old is None or len(old) != len(new):
+            self.reset(new, base or 1, self.source)
+            return
+
+        delta = new - old
+        nz    = np.flatnonzero(delta)
+        if not len(nz):
+            return
+        dv = delta[nz]
+        with self._lock:
+            for c, level in self._levels.items():
+                np.add.at(level, nz // (c // base), dv)
+
+    def level(self, compression):
+        """Spectrum (list) at this compression, or None if it is not available."""
+        with self._lock:
+            a = self._levels.get(int(compression))
+            return a.tolist() if a is not None else None
+
+    def available(self):
+        with self._lock:
+            return sorted(self._levels)
+
+    def matches(self, histogram, compression):
+        """True if the level at `compression` holds exactly `histogram`."""
+        with self._lock:
+            a = self._levels.get(int(compression))
+        return a is not None and len(a) == len(histogram) and np.array_equal(a, histogram)
+
+    def clear(self):
+        with self._lock:
+            self.base, self.source, self._levels = None, None, {}
+
+
+def file_coeffs(coeffs, view_compression):
+    """Calibration shown at `view_compression`, rescaled to the primary's saved resolution."""
+    source = primary.source
+    if not source or int(source) == int(view_compression):
+        return [float(c) for c in coeffs]
+    return scale_coeffs(coeffs, view_compression, source)
+
+
+# Spectra shown in tab 2
+primary    = SpectrumPyramid()
+comparison = SpectrumPyramid()
+
+
+def _current_compression(histogram, bins_abs, fallback):
+    """Compression implied by the histogram length (file loads may not set it)."""
+    n = len(histogram)
+    if n and bins_abs and bins_abs % n == 0:
+        return bins_abs // n
+    return max(1, int(fallback or 1))
+
+
+_CALIB_BINS = [f"calib_bin_{n}" for n in range(1, 6)]
+
+# values before the first switch, rescaled from on every switch after it:
+# {"state": what switch() last wrote, "compression", "coeffs", "rois", "calib",
+#  "compression_2", "coeffs_2"}
+_origin = {}
+
+
+def _view_state():
+    """Channel-dependent values in shared (call under write_lock)."""
+    return (
+        len(shared.histogram or []),
+        len(getattr(shared, "histogram_2", None) or []),
+        (shared.coeff_1, shared.coeff_2, shared.coeff_3),
+        tuple((pk['i0'], pk['i1']) for pk in getattr(shared, "peak_list", None) or []),
+        tuple(getattr(shared, name, 0) for name in _CALIB_BINS),
+        (getattr(shared, "comp_coeff_1", 0), getattr(shared, "comp_coeff_2", 0),
+         getattr(shared, "comp_coeff_3", 0)),
+    )
+
+
+def switch(compression):
+    """
+    Show the primary (and comparison) spectrum at `compression` from their
+    pyramids. Returns False, leaving shared untouched, when there is no
+    primary spectrum, it was recorded at a coarser resolution, or it is being
+    recorded by a device that does not feed the pyramid.
+    """
+    global _origin
+    compression = int(compression)
+    with shared.write_lock:
+        bins_abs = int(getattr(shared, "bins_abs", 0) or 0)
+        hist     = list(shared.histogram or [])
+        cur      = _current_compression(hist, bins_abs, shared.compression)
+        if not hist or not (any(hist) or primary.matches(hist, cur)):
+            return False              # nothing recorded or loaded yet
+
+        if not primary.matches(hist, cur):
+            if shared.run_flag.is_set():
+                # the recorder would overwrite the view on its next tick
+                logger.warning(f"👆 {shared.device_type} recording cannot be re-binned while running")
+                return False
+            primary.reset(hist, cur)          # replaced since the last build
+        view = primary.level(compression)
+        if view is None:
+            logger.warning(f"👆 {len(hist)} bin spectrum cannot be shown at compression {compression}")
+            return False
+
+        hist_2 = list(getattr(shared, "histogram_2", None) or [])
+        cur_2  = _current_compression(hist_2, bins_abs, getattr(shared, "compression_2", 1)) if hist_2 else 1
+
+        # anything changed since the last switch (new spectrum, ROIs or
+        # calibration) becomes the new origin
+        if _origin.get("state") != _view_state():
+            _origin = {
+                "compression":   cur,
+                "coeffs":        [shared.coeff_1, shared.coeff_2, shared.coeff_3],
+                "rois":          [(pk['i0'], pk['i1']) for pk in getattr(shared, "peak_list", None) or []],
+                "calib":         [float(getattr(shared, name, 0) or 0) for name in _CALIB_BINS],
+                "compression_2": cur_2,
+                "coeffs_2":      [getattr(shared, "comp_coeff_1", 0), getattr(shared, "comp_coeff_2", 0),
+                                  getattr(shared, "comp_coeff_3", 0)],
+            }
+        base = _origin["compression"]
+
+        shared.histogram   = view
+        shared.bins        = len(view)
+        shared.compression = compression
+        shared.coeff_1, shared.coeff_2, shared.coeff_3 = scale_coeffs(_origin["coeffs"], base, compression)
+
+        # ROIs and calibration points are in channels of the origin view
+        to_view = _scale_channels(base, compression)
+        for pk, (i0, i1) in zip(getattr(shared, "peak_list", None) or [], _origin["rois"]):
+            pk['i0'], pk['i1'] = to_view(i0, i1)
+        k, d = compression / base, (compression / base - 1.0) / 2.0
+        for name, x in zip(_CALIB_BINS, _origin["calib"]):
+            if x:
+                setattr(shared, name, (x - d) / k)
+
+        if hist_2:
+            if not comparison.matches(hist_2, cur_2):
+                comparison.reset(hist_2, cur_2)
+            view_2 = comparison.level(compression)
+            if view_2 is not None:
+                shared.histogram_2   = view_2
+                shared.bins_2        = len(view_2)
+                shared.compression_2 = compression
+                shared.comp_coeff_1, shared.comp_coeff_2, shared.comp_coeff_3 = scale_coeffs(
+                    _origin["coeffs_2"], _origin["compression_2"], compression)
+
+        _origin["state"] = _view_state()
+
+    logger.info(f"   ✅ Spectrum re-binned to compression {compression} ({len(view)} bins)")
+    return True
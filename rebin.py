@@ -0,0 +1,128 @@
+# rebin.py
+#
+# Count-conserving rebinning between energy grids.
+#
+# A spectrum recorded with one calibration and bin count is mapped onto
+# another grid by splitting each source bin's counts over the target bins it
+# overlaps, in proportion to the overlapping energy width. The weights form a
+# sparse (target, source) matrix that depends only on the two grids, so it is
+# built once per (source calibration, target grid) pair and every later
+# projection is one sparse mat-vec.
+#
+# Grids come from the bin edges of calibration.Calibration. When either
+# calibration is missing or not monotonic, both spectra are placed on the
+# device channel grid instead (channel x at compression c spans device
+# channels c*x .. c*x + c), which still lines up spectra of different bin
+# counts.
+
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+from scipy import sparse
+
+import calibration
+
+CACHE_SIZE = 8
+
+
+def overlap_matrix(src_edges, dst_edges):
+    """
+    Sparse (len(dst)-1, len(src)-1) matrix of overlap weights: entry (j, i) is
+    the fraction of source bin i that lies in target bin j. Both edge arrays
+    must be increasing. Counts outside the target range are dropped.
+    """
+    s = np.asarray(src_edges, dtype=float)
+    d = np.asarray(dst_edges, dtype=float)
+    n, m = len(s) - 1, len(d) - 1
+    if n < 1 or m < 1:
+        return sparse.csr_matrix((max(m, 0), max(n, 0)))
+
+    lo   = np.clip(np.searchsorted(d, s[:-1], side="right") - 1, 0, m - 1)
+    hi   = np.clip(np.searchsorted(d, s[1:], side="left") - 1, 0, m - 1)
+    span = np.maximum(hi - lo + 1, 0)
+
+    src  = np.repeat(np.arange(n), span)
+    dst  = np.repeat(lo, span) + (np.arange(span.sum()) - np.repeat(np.cumsum(span) - span, span))
+
+    width   = s[1:] - s[:-1]
+    overlap = np.minimum(s[1:][src], d[1:][dst]) - np.maximum(s[:-1][src], d[:-1][dst])
+    w       = np.where(width[src] > 0, np.maximum(overlap, 0.0) / np.where(width[src] > 0, width[src], 1.0), 0.0)
+    keep    = w > 0
+    return sparse.csr_matrix((w[keep], (dst[keep], src[keep])), shape=(m, n))
+
+
+def _channel_edges(bins, compression):
+    c = max(1, int(compression))
+    return np.arange(int(bins) + 1, dtype=float) * c
+
+
+def _energy_edges(coeffs, bins):
+    """Bin edges in keV, or None if the calibration is unusable for rebinning."""
+    if coeffs is None or not all(np.isfinite(coeffs)) or not any(coeffs):
+        return None
+    cal = calibration.for_coeffs(coeffs, bins)
+    if not cal.increasing or not np.all(np.diff(cal.edges) > 0):
+        return None
+    return cal.edges
+
+
+class Rebinner:
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = int(cache_size)
+        self._lock      = threading.Lock()
+        self._cache     = OrderedDict()
+
+    def matrix(self, src_bins, src_coeffs, src_compression, dst_bins, dst_coeffs, dst_compression):
+        """Cached overlap matrix from the source grid to the target grid."""
+        key = (int(src_bins), tuple(float(c) for c in src_coeffs), int(src_compression),
+               int(dst_bins), tuple(float(c) for c in dst_coeffs), int(dst_compression))
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                self._cache.move_to_end(key)
+                return hit
+
+        src = _energy_edges(src_coeffs, src_bins)
+        dst = _energy_edges(dst_coeffs, dst_bins)
+        if src is None or dst is None:
+            src = _channel_edges(src_bins, src_compression)
+            dst = _channel_edges(dst_bins, dst_compression)
+        M = overlap_matrix(src, dst)
+
+        with self._lock:
+            self._cache[key] = M
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return M
+
+    def project(self, y, src_coeffs, src_compression, dst_bins, dst_coeffs, dst_compression):
+        """Spectrum `y` on the target grid (float array of dst_bins)."""
+        y = np.nan_to_num(np.asarray(y, dtype=float))
+        if not len(y) or not dst_bins:
+            return np.zeros(int(dst_bins))
+        M = self.matrix(len(y), src_coeffs, src_compression, dst_bins, dst_coeffs, dst_compression)
+        return M @ y
+
+
+# Shared rebinner (keeps the matrices between UI ticks)
+rebinner = Rebinner()
+
+
+def live_time_scale(elapsed, elapsed_2):
+    """Factor bringing a spectrum of elapsed_2 seconds to elapsed seconds."""
+    return float(elapsed) / max(float(elapsed_2), 1e-9)
+
+
+def subtract(y, elapsed, coeffs, compression, y2, elapsed_2, coeffs_2, compression_2):
+    """
+    Background subtraction on the grid of `y`: returns (net, background) where
+    background is y2 rebinned to y's grid and scaled to y's live time, and
+    net = max(y - background, 0).
+    """
+    y   = np.nan_to_num(np.asarray(y, dtype=float))
+    bkg = rebinner.project(y2, coeffs_2, compression_2, len(y), coeffs, compression)
+    bkg *= live_time_scale(elapsed, elapsed_2)
+    return np.maximum(y - bkg, 0.0), bkg
@@ -0,0 +1,333 @@
+# recorder_daemon.py
+#
+# Headless recorder for MAX, PRO and Teensy devices (no Qt, no display).
+#
+#   python recorder_daemon.py station.json
+#   curl http://127.0.0.1:8765/status
+#   curl -X POST http://127.0.0.1:8765/stop
+#
+# Config file (JSON), every key optional:
+#
+#   {
+#     "device_type": "MAX",                 # MAX | PRO | TEENSY (default: settings.json)
+#     "mode":        2,                     # 2 = spectrum, 3 = waterfall, 4 = PRO coincidence
+#     "filename":    "station_%Y%m%d_%H%M", # strftime codes allowed, resolved per run
+#     "resume":      true,                  # continue an interrupted run of the same file
+#     "repeat":      false,                 # start the next run when one reaches its limits
+#     "settings":    {"device_port": "/dev/ttyUSB0", "max_seconds": 3600},
+#     "status":      {"host": "127.0.0.1", "port": 8765}
+#   }
+#
+# Settings start from the GUI's settings.json and "settings" overrides any
+# SETTINGS_SCHEMA key for this process only (settings.json is not written).
+# Recording goes through functions.start_recording, so the same recorder
+# threads write the same NPES / _hmp files, checkpoints and run markers as
+# the GUI. shared is imported with IMPULSEQT_HEADLESS set, so Qt is never
+# loaded; pyaudio is only needed for PRO.
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+
+os.environ.setdefault("IMPULSEQT_HEADLESS", "1")    # shared: no Qt for the data paths
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import shared
+import functions
+import recovery
+import persistence
+
+from shared import logger
+
+DEVICE_TYPES   = ("MAX", "PRO", "TEENSY")
+MODES          = (2, 3, 4)
+DEFAULT_HOST   = "127.0.0.1"
+DEFAULT_PORT   = 8765
+SAVE_WAIT      = 10.0        # s to wait for the recorder's final save
+
+# Teensy link, as opened by tab1_teensy
+TEENSY_BAUD    = 2_000_000
+TEENSY_TIMEOUT = 0.5
+
+
+def load_config(path):
+    """Config dict from a JSON file, with defaults filled in."""
+    with open(path, "r", encoding="utf-8") as f:
+        cfg = json.load(f)
+    if not isinstance(cfg, dict):
+        raise ValueError("config must be a JSON object")
+
+    status = cfg.get("status") or {}
+    return {
+        "device_type": str(cfg.get("device_type") or "").upper(),
+        "mode":        int(cfg.get("mode", 2)),
+        "filename":    str(cfg.get("filename") or ""),
+        "resume":      bool(cfg.get("resume", True)),
+        "repeat":      bool(cfg.get("repeat", False)),
+        "settings":    dict(cfg.get("settings") or {}),
+        "host":        str(status.get("host", DEFAULT_HOST)),
+        "port":        int(status.get("port", DEFAULT_PORT)),
+    }
+
+
+def _base_name(filename):
+    """Name without .json / _hmp, as tab3 does for 3D runs."""
+    base = filename.strip()
+    if base.lower().endswith(".json"):
+        base = base[:-5]
+    if base.lower().endswith("_hmp"):
+        base = base[:-4]
+    return base
+
+
+def _open_teensy(port):
+    import serial
+    ser = serial.Serial(
+        port,
+        baudrate      = TEENSY_BAUD,
+        bytesize      = 8,
+        parity        = "N",
+        stopbits      = 1,
+        timeout       = TEENSY_TIMEOUT,
+        write_timeout = 0.5,
+    )
+    with shared.write_lock:
+        shared.teensy_serial = ser
+    logger.info(f"   ✅ daemon Teensy connected on {port}")
+    return ser
+
+
+class Recorder:
+
+    def __init__(self, cfg):
+        self.cfg      = cfg
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self.thread   = None
+        self.state    = "idle"          # idle | recording | saving | stopped | error
+        self.filename = ""
+        self.runs     = 0
+        self.started  = None
+        self.error    = ""
+
+    # ---- status --------------------------------------------------
+
+    def status(self):
+        with self._lock:
+            out = {
+                "state":    self.state,
+                "filename": self.filename,
+                "runs":     self.runs,
+                "started":  self.started,
+                "error":    self.error,
+                "mode":     self.cfg["mode"],
+                "repeat":   self.cfg["repeat"],
+            }
+        with shared.write_lock:
+            out.update({
+                "device_type":    shared.device_type,
+                "running":        shared.run_flag.is_set(),
+                "counts":         int(shared.counts or 0),
+                "cps":            int(shared.cps or 0),
+                "elapsed":        int(shared.elapsed or 0),
+                "dropped_counts": int(shared.dropped_counts or 0),
+                "max_counts":     int(shared.max_counts),
+                "max_seconds":    int(shared.max_seconds),
+                "compression":    int(shared.compression),
+            })
+        return out
+
+    def _set(self, **kw):
+        with self._lock:
+            for k, v in kw.items():
+                setattr(self, k, v)
+
+    # ---- control -------------------------------------------------
+
+    def stop(self):
+        """Stop the current run (it saves as usual) and do not start another."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        logger.info("👆 daemon stop requested")
+        functions.stop_recording()
+
+    def _start_run(self):
+        mode        = self.cfg["mode"]
+        device_type = self.cfg["device_type"]
+        filename    = _base_name(datetime.now().strftime(self.cfg["filename"]))
+        rec_mode    = 3 if mode == 3 else 2
+
+        with shared.write_lock:
+            shared.filename = filename
+            if mode == 3:
+                shared.histogram_hmp.clear()
+                shared.gps_hmp.clear()
+
+        info = recovery.interrupted(filename, rec_mode)
+        if info is not None:
+            if self.cfg["resume"]:
+                logger.info(f"   ✅ daemon resuming {filename} (started {info.get('started', '?')})")
+                recovery.request(filename, rec_mode)
+            else:
+                logger.warning(f"👆 daemon {filename} was interrupted, starting over")
+
+        self._set(state="recording", filename=filename, started=datetime.now().isoformat(timespec="seconds"), error="")
+        thread = functions.start_recording(mode, device_type)
+        if thread is None:
+            raise RuntimeError(f"{device_type} recording did not start")
+        self.thread = thread
+        with self._lock:
+            self.runs += 1
+        return thread
+
+    def run(self):
+        """Record until stopped (or once, unless repeat is set). Returns an exit code."""
+        while not self._stop.is_set():
+            try:
+                thread = self._start_run()
+            except Exception as e:
+                logger.error(f"  ❌ daemon start failed: {e}")
+                self._set(state="error", error=str(e))
+                return 1
+
+            while thread.is_alive():
+                thread.join(timeout=0.5)
+
+            self._set(state="saving")
+            if self.cfg["device_type"] != "MAX":
+                shared.save_done.wait(SAVE_WAIT)
+            persistence.service.flush()
+            logger.info(f"   ✅ daemon run {self.runs} finished: {self.filename}")
+
+            if not self.cfg["repeat"]:
+                break
+            time.sleep(0.5)
+
+        functions.stop_recording()
+        self._set(state="stopped")
+        return 0
+
+
+def make_server(recorder, host, port):
+    """HTTP status endpoint: GET /status, POST /stop."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/") in ("", "/status"):
+                self._reply(200, recorder.status())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path.rstrip("/") == "/stop":
+                recorder.stop()
+                self._reply(200, recorder.status())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def log_message(self, fmt, *args):
+            logger.debug(f"daemon http {self.address_string()} {fmt % args}")
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Headless ImpulseQt recorder (no Qt)")
+    ap.add_argument("config",                       help="JSON config file")
+    ap.add_argument("--port",     type=int,         help="status port (overrides config, 0 = off)")
+    ap.add_argument("--no-app-settings", action="store_true",
+                                                    help="start from defaults instead of settings.json")
+    args = ap.parse_args(argv)
+
+    try:
+        cfg = load_config(args.config)
+    except Exception as e:
+        logger.error(f"  ❌ daemon cannot read {args.config}: {e}")
+        return 1
+    if args.port is not None:
+        cfg["port"] = args.port
+
+    if args.no_app_settings:
+        shared.from_settings({})
+    else:
+        shared.load_settings()
+    unknown = shared.apply_settings(cfg["settings"])
+    if unknown:
+        logger.warning(f"👆 daemon ignoring unknown settings: {', '.join(unknown)}")
+
+    with shared.write_lock:
+        if cfg["device_type"]:
+            shared.device_type = cfg["device_type"]
+        cfg["device_type"] = shared.device_type
+        if not cfg["filename"]:
+            cfg["filename"] = shared.filename
+        port_str = shared.device_port
+
+    if cfg["device_type"] not in DEVICE_TYPES:
+        logger.error(f"  ❌ daemon unsupported device_type: {cfg['device_type']}")
+        return 1
+    if cfg["mode"] not in MODES or (cfg["mode"] == 4 and cfg["device_type"] != "PRO"):
+        logger.error(f"  ❌ daemon unsupported mode {cfg['mode']} for {cfg['device_type']}")
+        return 1
+    if cfg["filename"].startswith("lib/"):
+        logger.error("  ❌ daemon can't write to the lib/ directory")
+        return 1
+
+    if cfg["device_type"] == "TEENSY":
+        try:
+            _open_teensy(port_str)
+        except Exception as e:
+            logger.error(f"  ❌ daemon Teensy connect failed on {port_str!r}: {e}")
+            return 1
+
+    recorder = Recorder(cfg)
+    server   = None
+    if cfg["port"]:
+        try:
+            server = make_server(recorder, cfg["host"], cfg["port"])
+        except OSError as e:
+            logger.error(f"  ❌ daemon status port {cfg['host']}:{cfg['port']}: {e}")
+            return 1
+        threading.Thread(target=server.serve_forever, daemon=True, name="daemon-status").start()
+        logger.info(f"   ✅ daemon status on http://{cfg['host']}:{cfg['port']}/status")
+
+    # stop from a thread: the handler may interrupt code holding write_lock
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: threading.Thread(target=recorder.stop, daemon=True).start())
+
+    logger.info(f"   ✅ daemon {cfg['device_type']} mode {cfg['mode']} -> {cfg['filename']}")
+    try:
+        code = recorder.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        ser = shared.teensy_serial
+        if ser is not None:
+            try:
+                ser.close()
+            except Exception:
+                pass
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+# recovery.py
+#
+# Resume a recording that did not stop cleanly (crash, power loss, USB drop).
+#
+# Every recorder writes a small run marker when it starts and removes it
+# after its final save:
+#
+#   {filename}.run        2D spectrum (modes 2 and 4)
+#   {filename}_hmp.run    3D waterfall (mode 3)
+#
+# A marker that is still there when the same name is started again means the
+# last run was interrupted. The Start buttons then offer to resume; when the
+# user accepts, request() flags the name and the recorder calls take() to pick
+# it up, reloads the last checkpoint (histogram, counts, elapsed, CPS history,
+# waterfall rows) and keeps accumulating on top of it. If that checkpoint
+# cannot be used the recorder does not start at all, so a fresh run never
+# overwrites the files of the one the user asked to continue.
+
+import os
+import json
+import threading
+
+from pathlib import Path
+from datetime import datetime
+
+import shared
+import checkpoint
+import jsonio
+import waterfall_store
+from shared import logger
+
+_TS_FMT     = "%Y-%m-%dT%H:%M:%S+00:00"
+_lock       = threading.Lock()
+_requested  = set()
+
+
+def _kind(mode):
+    return "3d" if int(mode) == 3 else "2d"
+
+def marker_path(filename, mode, folder=None):
+    sfx = "_hmp.run" if _kind(mode) == "3d" else ".run"
+    return Path(folder or shared.USER_DATA_DIR) / f"{filename}{sfx}"
+
+def _data_path(filename, mode, folder=None):
+    if _kind(mode) == "3d":
+        return waterfall_store.jsonl_path(filename, folder)
+    return Path(folder or shared.USER_DATA_DIR) / f"{filename}.json"
+
+def _parse_ts(s):
+    try:
+        return datetime.strptime(s, _TS_FMT)
+    except (TypeError, ValueError):
+        return None
+
+
+# ------------------------------------------------------------
+# Run markers
+# ------------------------------------------------------------
+def begin(filename, mode, device="", resumed=False, folder=None):
+    """
+    Mark a run as in progress. A fresh run also removes the CPS file of an
+    earlier recording with the same name, which would otherwise be appended to.
+    """
+    folder = Path(folder or shared.USER_DATA_DIR)
+    if not resumed:
+        try:
+            os.remove(folder / f"{filename}_cps.csv")
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"👆 Could not remove old CPS file for {filename}: {e}")
+
+    info = {
+        "filename": filename,
+        "mode":     int(mode),
+        "device":   str(device),
+        "pid":      os.getpid(),
+        "started":  datetime.now().strftime(_TS_FMT),
+        "resumed":  bool(resumed),
+    }
+    try:
+        checkpoint.write_atomic(marker_path(filename, mode, folder), json.dumps(info))
+    except Exception as e:
+        logger.warning(f"👆 Could not write run marker for {filename}: {e}")
+
+def finish(filename, mode, folder=None):
+    """Clean stop: the final save is on disk, nothing to resume."""
+    try:
+        os.remove(marker_path(filename, mode, folder))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"👆 Could not remove run marker for {filename}: {e}")
+
+def interrupted(filename, mode, folder=None):
+    """
+    Marker contents if the last run of `filename` stopped without a clean
+    finish and left a checkpoint to resume from, else None.
+    """
+    path = marker_path(filename, mode, folder)
+    if not path.exists() or not _data_path(filename, mode, folder).exists():
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        info = {}
+    # our own run that is still going is not interrupted
+    if info.get("pid") == os.getpid() and shared.run_flag.is_set():
+        return None
+    return info
+
+
+# ------------------------------------------------------------
+# Resume requests (UI -> recorder thread)
+# ------------------------------------------------------------
+def request(filename, mode):
+    with _lock:
+        _requested.add((filename, _kind(mode)))
+
+def requested(filename, mode):
+    with _lock:
+        return (filename, _kind(mode)) in _requested
+
+def take(filename, mode):
+    """True once if a resume was requested for this name and mode."""
+    with _lock:
+        key = (filename, _kind(mode))
+        if key in _requested:
+            _requested.discard(key)
+            return True
+        return False
+
+
+# ------------------------------------------------------------
+# Loading the last checkpoint
+# ------------------------------------------------------------
+def load_spectrum(filename, bins=None, folder=None):
+    """
+    Last saved 2D state as a dict (histogram, counts, dropped_counts, elapsed,
+    dt_start, spec_notes), with the CPS history reloaded into
+    shared.count_history. None if there is nothing usable.
+    """
+    folder = Path(folder or shared.USER_DATA_DIR)
+    path   = folder / f"{filename}.json"
+    try:
+        data = jsonio.load(path)
+        if data.get("schemaVersion") == "NPESv2":
+            data = data["data"][0]
+        res = data["resultData"]
+        es  = res["energySpectrum"]
+        histogram = [int(v) for v in es.get("spectrum", [])]
+    except Exception as e:
+        logger.error(f"  ❌ Resume: could not read {path.name}: {e}")
+        return None
+
+    if bins is not None and len(histogram) != int(bins):
+        logger.error(f"  ❌ Resume: {path.name} has {len(histogram)} channels, recording uses {bins}")
+        return None
+
+    n_cps = 0
+    cps   = folder / f"{filename}_cps.csv"
+    if cps.exists():
+        n_cps = shared.count_history.load_csv(cps)
+    else:
+        shared.count_history.clear()
+
+    state = {
+        "histogram":      histogram,
+        "counts":         int(es.get("validPulseCount", sum(histogram)) or 0),
+        "dropped_counts": int(es.get("droppedPulseCount", es.get("droppedPulseCounts", 0)) or 0),
+        "elapsed":        int(es.get("measurementTime", 0) or 0),
+        "dt_start":       _parse_ts(res.get("startTime")) or datetime.now(),
+        "spec_notes":     data.get("sampleInfo", {}).get("note", ""),
+    }
+    logger.info(f"   ✅ Resuming {filename}: {state['counts']} counts, "
+                f"{state['elapsed']} s, {n_cps} CPS samples")
+    return state
+
+def reopen_store(filename, bins=None, folder=None):
+    """
+    Reopen the 3D store after its last checkpoint. Returns (store, checkpoint
+    dict) and refills the UI rings with the newest rows, or (None, {}) if the
+    store is unusable or was recorded with a channel count other than bins.
+    """
+    store, ck = waterfall_store.WaterfallStore.reopen(filename, folder, bins)
+    if store is None:
+        return None, {}
+
+    with shared.write_lock:
+        ring_len = getattr(shared, "ring_len_hmp", 3600)
+    rows, gps = waterfall_store.tail_rows(store.path, ring_len)
+    with shared.write_lock:
+        if hasattr(shared.histogram_hmp, "extend"):
+            shared.histogram_hmp.extend(rows)
+        if hasattr(getattr(shared, "gps_hmp", None), "extend"):
+            shared.gps_hmp.extend(gps)
+
+    logger.info(f"   ✅ Resuming {store.filename}: {store.rows} rows, "
+                f"{ck.get('validPulseCount', 0)} counts, {ck.get('measurementTime', 0)} s")
+    return store, ck
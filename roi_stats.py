@@ -0,0 +1,173 @@
+# roi_stats.py
+#
+# ROI statistics for spectra and waterfall rows.
+#
+# roi_table() computes gross, net, centroid, FWHM and resolution for every
+# ROI of a spectrum in one call: sums and first moments come from cumulative
+# sums (two lookups per ROI) and the half-maximum crossings are found with
+# one vectorised scan over all ROI channels, so the cost does not grow with
+# a Python loop per ROI.
+#
+# roi_sums() does the same prefix-sum trick per row for a 2D (rows, bins)
+# block, and roi_sums_rows() applies it in chunks to a list of rows (dense
+# lists or SparseRow), for the 3D map and CSV exports, optionally above the
+# SNIP background (snip.py).
+#
+# ROIs are inclusive channel ranges (i0, i1); they are clamped to the
+# spectrum and swapped if reversed.
+
+import numpy as np
+
+import snip
+import waterfall_store
+
+CHUNK_ROWS = 512
+
+
+def _clamp(rois, n):
+    r  = np.asarray(rois, dtype=np.int64).reshape(-1, 2)
+    r  = np.clip(r, 0, max(0, n - 1))
+    return r.min(axis=1), r.max(axis=1)
+
+
+def range_sums(y, rois):
+    """Counts in each inclusive range of a 1D spectrum."""
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    if not len(y) or not len(rois):
+        return np.zeros(len(rois))
+    i0, i1 = _clamp(rois, len(y))
+    cs = np.concatenate(([0.0], np.cumsum(y)))
+    return cs[i1 + 1] - cs[i0]
+
+
+def _fwhm(y, i0, i1):
+    """
+    FWHM in channels per ROI by linear interpolation of the first rising and
+    last falling half-maximum crossing inside the ROI (NaN if either is missing).
+    """
+    lengths = i1 - i0 + 1
+    seg     = np.repeat(np.arange(len(i0)), lengths)
+    starts  = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    pos     = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    idx     = i0[seg] + pos
+
+    peak = np.maximum.reduceat(np.append(y, -np.inf), np.column_stack((i0, i1 + 1)).ravel())[::2]
+    half = 0.5 * peak
+    h    = half[seg]
+
+    cur  = y[idx]
+    prev = y[np.maximum(idx - 1, 0)]
+    has_prev = pos >= 1
+    up   = has_prev & (prev < h) & (h <= cur)     # rising crossing between k-1 and k
+    down = has_prev & (cur < h) & (h <= prev)     # falling crossing between k-1 and k
+
+    fwhm = np.full(len(i0), np.nan)
+
+    first_up = np.full(len(i0), -1)
+    s, k = np.unique(seg[up], return_index=True)
+    first_up[s] = idx[up][k]
+
+    last_down = np.full(len(i0), -1)
+    s_rev, k_rev = np.unique(seg[down][::-1], return_index=True)
+    last_down[s_rev] = idx[down][::-1][k_rev]
+
+    ok = (first_up >= 0) & (last_down >= 0)
+    if ok.any():
+        L, R, hh = first_up[ok], last_down[ok], half[ok]
+        xL = (L - 1) + (hh - y[L - 1]) / np.maximum(1e-12, y[L] - y[L - 1])
+        xR = R - (hh - y[R]) / np.maximum(1e-12, y[R - 1] - y[R])
+        fwhm[ok] = np.abs(xR - xL)
+    return fwhm
+
+
+def roi_table(y, rois, coeffs=None):
+    """
+    Statistics for all ROIs of a spectrum. Returns a dict of arrays, one entry
+    per ROI: i0, i1, gross, net (above a straight line between the edge
+    channels), centroid (channel), fwhm (channels), energy, fwhm_energy and
+    resolution (%). With coeffs ([c1, c2, c3], x^2 first) energies are
+    calibrated, otherwise they are in channels.
+    """
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    n = len(y)
+    empty = np.zeros(0)
+    if not n or not len(rois):
+        return {k: empty for k in ("i0", "i1", "gross", "net", "centroid", "fwhm",
+                                   "energy", "fwhm_energy", "resolution")}
+
+    i0, i1 = _clamp(rois, n)
+    x   = np.arange(n, dtype=float)
+    cs  = np.concatenate(([0.0], np.cumsum(y)))
+    cxs = np.concatenate(([0.0], np.cumsum(x * y)))
+
+    width = (i1 - i0 + 1).astype(float)
+    gross = cs[i1 + 1] - cs[i0]
+    net   = gross - width * (y[i0] + y[i1]) / 2.0
+
+    moment   = cxs[i1 + 1] - cxs[i0]
+    centroid = np.where(gross > 0, moment / np.where(gross > 0, gross, 1.0), (i0 + i1) / 2.0)
+
+    fwhm = _fwhm(y, i0, i1)
+    energy, fwhm_energy, resolution = calibrate(centroid, fwhm, coeffs)
+
+    return {
+        "i0": i0, "i1": i1, "gross": gross, "net": net, "centroid": centroid,
+        "fwhm": fwhm, "energy": energy, "fwhm_energy": fwhm_energy, "resolution": resolution,
+    }
+
+
+def calibrate(centroid, fwhm, coeffs=None):
+    """(energy, fwhm_energy, resolution %) for channel centroids and FWHMs."""
+    centroid = np.asarray(centroid, dtype=float)
+    fwhm     = np.asarray(fwhm, dtype=float)
+    if coeffs is not None and any(np.isfinite(coeffs)):
+        a, b, _ = coeffs
+        energy = np.polyval(coeffs, centroid)
+        if a or b:
+            slope = 2 * a * centroid + b
+        else:
+            slope = np.polyval(coeffs, centroid + 1) - energy
+        fwhm_energy = np.abs(slope) * fwhm
+    else:
+        energy, fwhm_energy = centroid, fwhm
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        resolution = np.where(energy > 0, fwhm_energy / energy * 100.0, np.nan)
+    return energy, fwhm_energy, resolution
+
+
+def roi_sums(block, rois):
+    """Counts per row inside each ROI for a (rows, bins) block, shape (rows, len(rois))."""
+    block = np.asarray(block)
+    out = np.zeros((block.shape[0], len(rois)), dtype=np.int64)
+    if not len(rois) or not block.size:
+        return out
+    i0, i1 = _clamp(rois, block.shape[1])
+    if np.issubdtype(block.dtype, np.floating):
+        cs = np.zeros((block.shape[0], block.shape[1] + 1))
+        np.cumsum(block, axis=1, out=cs[:, 1:])
+        return np.rint(cs[:, i1 + 1] - cs[:, i0]).astype(np.int64)
+    cs = np.zeros((block.shape[0], block.shape[1] + 1), dtype=np.int64)
+    np.cumsum(block, axis=1, dtype=np.int64, out=cs[:, 1:])
+    return cs[:, i1 + 1] - cs[:, i0]
+
+
+def roi_sums_rows(rows, rois, bins=None, chunk=CHUNK_ROWS, net=False):
+    """
+    roi_sums() over a list of rows (lists or SparseRow), densified a chunk at a
+    time. With net=True each row's SNIP background is subtracted first.
+    """
+    rows = list(rows)
+    out  = np.zeros((len(rows), len(rois)), dtype=np.int64)
+    if not rows or not len(rois):
+        return out
+    if bins is None:
+        bins = max((len(r) for r in rows if r is not None), default=0)
+    if not bins:
+        return out
+    for a in range(0, len(rows), chunk):
+        block = waterfall_store.dense_matrix(rows[a:a + chunk], bins)
+        if net:
+            block = snip.net(block, cached=False)
+        out[a:a + len(block)] = roi_sums(block, rois)
+    return out
@@ -2,11 +2,13 @@
 import os
 import json
 import shared
+import checkpoint
+import jsonio
 from shared import USER_DATA_DIR, logger, run_flag
 
 def save_histogram_json(filename, device, histogram, counts, dropped_counts,
                          elapsed, coeff_1, coeff_2, coeff_3, spec_notes,
-                         dt_start, dt_now):
+                         dt_start, dt_now, from_shared=True, wait=False):
     """
     Full rewrite each save cycle — correct here, since histogram is a
     fixed-size array (shared.bins channels) regardless of recording
@@ -15,14 +17,23 @@ def save_histogram_json(filename, device, histogram, counts, dropped_counts,
     `device` should already include any serial number the caller wants
     shown (e.g. "MAX12345" or "PRO-A1"); save.py doesn't resolve that
     itself, to avoid importing shproto.
+
+    from_shared=False keeps the caller's device/elapsed and takes bins from
+    the histogram, for recorders that are not the shared single device
+    (shproto.engine instances).
     """
     try:
         with shared.write_lock:
-            bins    = shared.bins
-            sn      = shared.serial_number
-            device  = shared.device
-            elapsed = shared.elapsed
             gps_fix = dict(shared.last_gps_fix) if getattr(shared, "last_gps_fix", None) else None
+            if from_shared:
+                bins    = shared.bins
+                sn      = shared.serial_number
+                device  = shared.device
+                elapsed = shared.elapsed
+
+        if not from_shared:
+            bins = len(histogram)
+            sn   = ""
 
 
         location = ""
@@ -62,8 +73,8 @@ def save_histogram_json(filename, device, histogram, counts, dropped_counts,
         }
 
         json_path = os.path.join(shared.USER_DATA_DIR, f"{filename}.json")
-        with open(json_path, "w") as f:
-            json.dump(data, f, separators=(",", ":"))
+        payload   = jsonio.encode(json.dumps(data, separators=(",", ":")), "json")
+        checkpoint.service.submit(json_path, payload, wait=wait)
 
         #shared.logger.info(f"   ✅ Spectrum saved to {json_path} ")
 
@@ -71,39 +82,43 @@ def save_histogram_json(filename, device, histogram, counts, dropped_counts,
         shared.logger.error(f"  ❌ Failed to save spectrum: {e} ")
 
 
-def save_count_history_csv(filename):
+def save_recording(store=None, final=False, **spectrum):
     """
-    Append-only. Writes only the CPS values recorded since the last call,
-    using shared.count_history_saved_index as the bookmark. Safe to call
-    at any cadence, from either device's save cycle.
+    One save-service job for a recording: spectrum JSON, the CPS values since
+    the last save, then the 3D store snapshots (closed and exported when
+    final). The caller cuts the store (store.cut) on its own thread when it
+    submits the job. `spectrum` takes the save_histogram_json() arguments.
     """
-    try:
-        with shared.write_lock:
-            start_index = shared.count_history_saved_index
-            new_entries = list(shared.count_history[start_index:])
-            shared.count_history_saved_index = len(shared.count_history)
+    save_histogram_json(**spectrum)
+    save_count_history_csv(spectrum["filename"])
+    if store is not None:
+        if final:
+            store.close()
+        else:
+            store.flush()
 
-        if not new_entries:
-            return
 
+def save_count_history_csv(filename):
+    """
+    Append-only. Writes only the CPS values recorded since the last call
+    (shared.count_history keeps the bookmark). Once on disk, older values
+    may be dropped from RAM and are read back from this file on demand.
+    Safe to call at any cadence, from either device's save cycle.
+    """
+    try:
         cps_path = os.path.join(shared.USER_DATA_DIR, f"{filename}_cps.csv")
-        file_exists = os.path.exists(cps_path)
-
-        with open(cps_path, "a", newline="") as f:
-            if not file_exists:
-                f.write("second,cps\n")
-            for i, cps_val in enumerate(new_entries):
-                f.write(f"{start_index + i},{cps_val}\n")
+        shared.count_history.save_csv(cps_path)
 
         #shared.logger.info(f"   ✅ CPS appended to {cps_path} ")
 
     except Exception as e:
         shared.logger.error(f"  ❌ Failed to append CPS history: {e} ")
 
-def save_histogram_hmp_json(filename, histogram_rows, gps_rows, counts, elapsed, coeffs, dt_start, dt_now, device):
+def save_histogram_hmp_json(filename, histogram_rows, gps_rows, counts, elapsed, coeffs, dt_start, dt_now, device, sn=None, wait=False):
     try:
-        with shared.write_lock:
-            sn = shared.serial_number
+        if sn is None:
+            with shared.write_lock:
+                sn = shared.serial_number
 
         device_name = f"{device}{sn}"
         compressed_bins = len(histogram_rows[0]) if histogram_rows else 0
@@ -129,8 +144,8 @@ def save_histogram_hmp_json(filename, histogram_rows, gps_rows, counts, elapsed,
         }
 
         file_path = os.path.join(shared.USER_DATA_DIR, f"{filename}_hmp.json")
-        with open(file_path, "w") as wjf:
-            json.dump(data, wjf, separators=(",", ":"))
+        payload   = jsonio.encode(json.dumps(data, separators=(",", ":")), "hmp")
+        checkpoint.service.submit(file_path, payload, wait=wait)
 
         #shared.logger.info(f"   ✅ Saving HMP JSON: {file_path}")
 
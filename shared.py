@@ -11,11 +11,11 @@ import threading
 from os import getenv
 from pathlib import Path
 from threading import Lock, Event
-from qt_compat import QStandardPaths
 
 from default_settings import DEFAULT_SETTINGS
 
 from collections import deque
+from cps_history import CountHistory
 
 # latest GPS fix snapshot (dict) or None
 last_gps_fix = None
@@ -68,8 +68,26 @@ BIN_OPTIONS = [("128 Bins", 64),("256 Bins", 32), ("512 Bins", 16), ("1024 Bins"
 
 APP_NAME = "ImpulseQt"
 
+def _app_data_location():
+    """
+    Qt's AppDataLocation (no application name is set when shared is imported).
+    Headless tools (IMPULSEQT_HEADLESS=1) and installs without Qt get the same
+    folder without importing Qt.
+    """
+    if not getenv("IMPULSEQT_HEADLESS"):
+        try:
+            from qt_compat import QStandardPaths
+            return Path(QStandardPaths.writableLocation(QStandardPaths.AppDataLocation))
+        except ImportError:
+            pass
+    if platform.system() == "Darwin":
+        return Path.home() / "Library" / "Application Support"
+    if platform.system() == "Windows":
+        return Path(getenv("APPDATA") or Path.home() / "AppData" / "Roaming")
+    return Path(getenv("XDG_DATA_HOME") or Path.home() / ".local" / "share")
+
 # AppData for internal use (not user-visible)
-DATA_DIR = Path(QStandardPaths.writableLocation(QStandardPaths.AppDataLocation)) / APP_NAME
+DATA_DIR = _app_data_location() / APP_NAME
 
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 # User-accessible data directory (e.g., saved spectra)
@@ -216,7 +234,7 @@ elapsed = 0
 elapsed_2 = 0
 elapsed_hmp = 0
 dropped_counts = 0
-count_history = []
+count_history = CountHistory()   # 1 Hz CPS, bounded in RAM (see cps_history.py)
 rolling_interval = 60
 t_interval = 1
 max_counts = 0
@@ -266,7 +284,6 @@ tempcal_table = []
 
 # --- Other ---
 serial_number = 0
-count_history_saved_index = 0
 cached_device_info = None
 cached_device_info_ts = 0.0
 flags_selected = ""
@@ -290,6 +307,29 @@ tab3_ymax      = 100
 tab3_smooth_on  = True
 tab3_smooth_win = 5
 
+# File compression: "none", "gzip" or "lzma" (see jsonio.py)
+compress_json       = "none"
+compress_json_level = 6
+compress_hmp        = "none"
+compress_hmp_level  = 6
+
+# .wfb waterfall maps are a cache (see waterfall_mmap.py); the least recently
+# used ones are removed once the cache is larger than this
+wfb_cache_mb        = 4096
+
+# ROI table peak fits: "none", "linear" or "step" background (see peak_fit.py)
+roi_fit_model       = "none"
+
+# ROI net counts: "linear" (edge to edge) or "snip" background (see snip.py)
+roi_background      = "linear"
+snip_iterations     = 24
+snip_smoothing      = 0
+
+# Whole-spectrum nuclide identification (see nuclide_id.py)
+nuclide_id            = False
+nuclide_id_resolution = 7.0
+nuclide_id_xray       = False
+
 
 # -------------------------------
 # Settings Keys & Persistence
@@ -398,6 +438,18 @@ SETTINGS_SCHEMA = {
     "tab3_smooth_win": {"type": "int", "default": 3},
     "theme": {"type": "str", "default": "dark"},
     "isotope_key": {"type": "str", "default": ""},
+    "compress_json": {"type": "str", "default": "none"},
+    "compress_json_level": {"type": "int", "default": 6},
+    "compress_hmp": {"type": "str", "default": "none"},
+    "compress_hmp_level": {"type": "int", "default": 6},
+    "wfb_cache_mb": {"type": "int", "default": 4096},
+    "roi_fit_model": {"type": "str", "default": "none"},
+    "roi_background": {"type": "str", "default": "linear"},
+    "snip_iterations": {"type": "int", "default": 24},
+    "snip_smoothing": {"type": "int", "default": 0},
+    "nuclide_id": {"type": "bool", "default": False},
+    "nuclide_id_resolution": {"type": "float", "default": 7.0},
+    "nuclide_id_xray": {"type": "bool", "default": False},
 }
 
 def read_flag_data(path):
@@ -426,6 +478,23 @@ def to_settings():
 
 
 
+def _convert(expected_type, raw_value):
+    # Type conversion based on schema
+    if expected_type == "int":
+        return int(raw_value)
+    elif expected_type == "float":
+        return float(raw_value)
+    elif expected_type == "bool":
+        return bool(raw_value)
+    elif expected_type == "str":
+        return str(raw_value)
+    elif expected_type == "list":
+        return list(raw_value)
+    elif expected_type == "dict":
+        return dict(raw_value)
+    return raw_value  # Fallback, unknown type
+
+
 def from_settings(settings: dict):
     if not isinstance(settings, dict):
         logger.error("  ❌ shared settings is not a dictionary.")
@@ -438,21 +507,7 @@ def from_settings(settings: dict):
         raw_value = settings.get(key, default_value)
 
         try:
-            # Type conversion based on schema
-            if expected_type == "int":
-                value = int(raw_value)
-            elif expected_type == "float":
-                value = float(raw_value)
-            elif expected_type == "bool":
-                value = bool(raw_value)
-            elif expected_type == "str":
-                value = str(raw_value)
-            elif expected_type == "list":
-                value = list(raw_value)
-            elif expected_type == "dict":
-                value = dict(raw_value)
-            else:
-                value = raw_value  # Fallback, unknown type
+            value = _convert(expected_type, raw_value)
 
             globals()[key] = value  # Assign as simple variable
             SETTINGS[key] = value   # Optional: keep in SETTINGS dict too
@@ -463,6 +518,28 @@ def from_settings(settings: dict):
             SETTINGS[key] = default_value
 
 
+def apply_settings(settings: dict):
+    """
+    Set only the keys present in `settings` (converted as in from_settings),
+    leaving every other setting as it is. Returns the unknown keys.
+    """
+    unknown = []
+    for key, raw_value in (settings or {}).items():
+        meta = SETTINGS_SCHEMA.get(key)
+        if meta is None:
+            unknown.append(key)
+            continue
+        try:
+            value = _convert(meta["type"], raw_value)
+        except Exception as e:
+            logger.error(f"   ❌ shared Failed to set '{key}' as {meta['type']} Error: {e}")
+            continue
+        with write_lock:
+            globals()[key] = value
+            SETTINGS[key] = value
+    return unknown
+
+
 def load_settings():
     try:
         with open(SETTINGS_FILE, "r") as f:
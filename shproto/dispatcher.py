@@ -1,984 +1,141 @@
 # shproto.dispatcher.py
+#
+# Single-device MAX dispatcher used by the UI.
+#
+# The serial loop, packet handling and the 2D/3D recorders live in
+# shproto.engine.MaxEngine; this module runs them on one shared engine
+# (publish=True). The old module globals (histogram, cps, command,
+# spec_stopflag, inf_str, ...) are aliases of that engine's attributes, so
+# existing readers and writers keep working and there is one implementation.
 
 import sys
-import threading
-import time
 import json
-import binascii
-import re
-import serial
-import shproto
-import shproto.port
-import logging
+import time
+import types
 import os
-import platform
-import shared
-import gps_main
-import save
-
-from threading import Event
-from struct import *
-from datetime import datetime
-from collections import deque
-from array import array
-from shared import USER_DATA_DIR, logger, run_flag
-
-max_bins            = 8192
-stopflag            = 0
-stopflag_lock       = threading.Lock()
-spec_stopflag       = 0
-spec_stopflag_lock  = threading.Lock()
-histogram           = [0] * max_bins
-histogram_lock      = threading.Lock()
-command             = ""
-command_lock        = threading.Lock()
-cps                 = 0
-cps_lock            = threading.Lock()
-calibration_updated = 0
-calibration_lock    = threading.Lock()
-_start_lock         = threading.Lock()
-_TIME_SCALE         = 1
-# ---- local elapsed timer (host based) ----
-_elapsed_lock       = threading.Lock()
-_elapsed_accum      = 0.0       # seconds accumulated while stopped or between runs
-_elapsed_start_host = None      # perf_counter() when running, else None
-_elapsed_running    = False     # True while "started"
-_elapsed_last_push  = 0.0       # last time we pushed shared.elapsed
-# CPS from full-spectrum (between STATs)
-_hist_delta_since_stat = 0      # sum of bin deltas since last STAT
-
-pkts01              = 0
-pkts03              = 0
-pkts04              = 0
-total_pkts          = 0
-dropped             = 0
-dropped_by_cmd      = {}
-PACKET_NAMES = {
-    shproto.MODE_HISTOGRAM: "HISTOGRAM",
-    shproto.MODE_TEXT: "TEXT",
-    shproto.MODE_STAT: "STAT",
-    shproto.MODE_PULSE: "PULSE",
+import threading
+import shproto
+import shproto.pulses
+
+from shproto.engine import MaxEngine, PACKET_NAMES, MAX_BINS
+from shared import USER_DATA_DIR, logger
+
+max_bins    = MAX_BINS
+_start_lock = threading.Lock()
+
+# The UI's engine
+engine = MaxEngine(publish=True)
+
+# module attribute -> engine attribute
+_ALIASES = {
+    "histogram":               "histogram",
+    "histogram_lock":          "histogram_lock",
+    "raw_hist":                "raw_hist",
+    "total_time":              "total_time",
+    "cpu_load":                "cpu_load",
+    "cps":                     "cps",
+    "cps_lock":                "cps_lock",
+    "cps_total_counts":        "cps_total_counts",
+    "lost_impulses":           "lost_impulses",
+    "calibration":             "calibration",
+    "calibration_lock":        "calibration_lock",
+    "calibration_updated":     "calibration_updated",
+    "inf_str":                 "inf_str",
+    "serial_number":           "serial_number",
+    "count_history":           "count_history",
+    "pkts01":                  "pkts01",
+    "pkts03":                  "pkts03",
+    "pkts04":                  "pkts04",
+    "total_pkts":              "total_pkts",
+    "dropped":                 "dropped",
+    "dropped_by_cmd":          "dropped_by_cmd",
+    "stat_prev_tt":            "stat_prev_tt",
+    "counts":                  "counts",
+    "last_counts":             "last_counts",
+    "stopflag":                "stopflag",
+    "spec_stopflag":           "spec_stopflag",
+    "command_lock":            "command_lock",
+    "_stat_tick":              "stat_tick",
+    "_stat_version":           "stat_version",
+    "_hist_delta_since_stat":  "hist_delta_since_stat",
+    "_histogram_version":      "histogram_version",
+    "_histogram_row_complete": "histogram_row_complete",
+    "_histogram_covered":      "histogram_covered",
+    "_histogram_cov_count":    "histogram_cov_count",
+    "_expect_cal":             "expect_cal",
+    "_last_cmd_sent":          "last_cmd_sent",
+    "_dispatcher_thread":      "_thread",
 }
-total_time          = 0
-cpu_load            = 0
-lost_impulses       = 0
-last_counts         = 0
-stat_prev_tt        = None
-count_history       = []
-serial_number       = ""
-calibration         = [0., 1., 0., 0., 0.]
-inf_str             = ''
-
-_hist_delta_since_stat = 0
-_dispatcher_thread  = None
-_dispatcher_started = False
-
-_histogram_version      = 0
-_histogram_row_complete = threading.Event()
-_histogram_offset_sum   = 0  # helps track packet coverage
-
-_stat_tick = threading.Event()   # device 1 Hz heartbeat
-_stat_version = 0                # increments each MODE_STAT
-
-# If you added coverage tracking too, define them here as well:
-_histogram_covered = bytearray(8192)  # per-bin coverage for current frame
-_histogram_cov_count = 0
-
-_expect_cal = False
-_last_cmd_sent = ""
-
-
-# ---- dispatcher runtime state (initialized once) ------------------
-
-_runtime_init = False   # module-private guard
-
-def _init_runtime():
-    global _runtime_init,raw_hist, cps_total_counts, stat_prev_tt, _hist_delta_since_stat
-
-    if _runtime_init:
-        return
-
-    raw_hist = array('I', [0]) * max_bins
-    cps_total_counts = 0
-    _runtime_init = True
-
-
-def _elapsed_now_seconds() -> float:
-    """Compute total elapsed seconds using host monotonic clock."""
-    with _elapsed_lock:
-        total = _elapsed_accum
-
-        if _elapsed_running and _elapsed_start_host is not None:
-            total += (time.perf_counter() - _elapsed_start_host)
-
-        return total
 
-def _elapsed_push_if_needed(period=0.25):
-    """Publish shared.elapsed as an integer, throttled (default 4 Hz)."""
-    global _elapsed_last_push
-    now = time.perf_counter()
 
-    if (now - _elapsed_last_push) >= period:
-        val = int(_elapsed_now_seconds())
+class _DispatcherModule(types.ModuleType):
+    """Forwards the legacy module globals to the shared engine."""
 
-        if shared.run_flag.is_set():
-            with shared.write_lock:
-                shared.elapsed = val
+    def __getattr__(self, name):
+        if name in _ALIASES:
+            return getattr(engine, _ALIASES[name])
+        if name == "command":
+            return engine.pending_command()
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-        _elapsed_last_push = now
-
-
-def _elapsed_start():
-    """Start/resume the local elapsed counter."""
-    with _elapsed_lock:
-        if not _elapsed_running:
-            _elapsed_start_host = time.perf_counter()
-            # assign to outer name
-            globals()['_elapsed_start_host'] = _elapsed_start_host
-            globals()['_elapsed_running']    = True
-
-def _elapsed_stop():
-    """Stop/pause the local elapsed counter."""
-    with _elapsed_lock:
-        if _elapsed_running and _elapsed_start_host is not None:
-            elapsed = time.perf_counter() - _elapsed_start_host
-            globals()['_elapsed_accum'] = _elapsed_accum + elapsed
+    def __setattr__(self, name, value):
+        if name in _ALIASES:
+            setattr(engine, _ALIASES[name], value)
+        elif name == "command":
+            if value:
+                engine.send(value)
+        else:
+            super().__setattr__(name, value)
 
-        globals()['_elapsed_start_host'] = None
-        globals()['_elapsed_running']    = False
 
-def _elapsed_reset():
-    """Reset to zero; if running, keep running from now."""
-    with _elapsed_lock:
-        globals()['_elapsed_accum'] = 0.0
-        if _elapsed_running:
-            globals()['_elapsed_start_host'] = time.perf_counter()
-        # also push 0 immediately
-    with shared.write_lock:
-        shared.elapsed = 0
+sys.modules[__name__].__class__ = _DispatcherModule
 
 
 def ensure_running(sn=None):
-
-    global _dispatcher_started, _dispatcher_thread
-
     with _start_lock:
-        # If a thread exists and is alive, we're done.
-        if _dispatcher_thread is not None and _dispatcher_thread.is_alive():
-            return _dispatcher_thread
-
-        # Defensive reset if the old thread died
-        _dispatcher_started = False
-
-        _dispatcher_thread = threading.Thread(
-            target=start,
-            kwargs={'sn': sn},
-            daemon=True,
-            name="DispatcherThread",
-        )
-
-        _dispatcher_thread.start()
-
-        _dispatcher_started = True
-
-        # Optional tiny pause; not required, but keeps existing behavior.
+        if engine.is_alive():
+            return engine._thread
+        thread = engine.start(sn)
         time.sleep(0.05)
-
-        return _dispatcher_thread
+        return thread
 
 # ==========================================================
 # NANO Communicator function
 #===========================================================
 
 def start(sn=None):
-
-    global _stat_version, _stat_tick, _histogram_covered, _histogram_cov_count, serial_number
-
-    logger.info("   🚀 Dispatcher started")
-    
-    _init_runtime()
-
-    READ_BUFFER = 16384 
-
-    with shproto.dispatcher.stopflag_lock:
-
-        globals()['stopflag'] = 0
-
-    port_str = getattr(shared, "device_port", None)  # e.g. "COM7"
-    nano     = shproto.port.connectdevice(sn=sn, port_str=port_str)
-
-    if not nano:
-        logger.error("[ERROR] ❌ Failed to connect to MAX ")
-        return
-
-    # ---- moved here (after connect) ----
-    nano.timeout = 0.1
-
-    if platform.system() == "Windows":
-        try:
-            nano.set_buffer_size(rx_size=131072, tx_size=16384)
-            logger.info("   ✅ Windows serial buffers enlarged")
-        except Exception as e:
-            logger.warning("👆 Could not enlarge Windows serial buffers: %s", e)
-
-    nano.flushInput()
-    nano.flushOutput()
-
-    logger.info("   ✅ MAX connected successfully")
-    response = shproto.packet()
-
-    # Track whether the CSV file has been initialized
-    pulse_file_initialized = False
-
-    csv_file_path = os.path.join(USER_DATA_DIR, "_max-pulse-shape.csv")  # hoisted for safety
-
-    noted_timeout = False
-    byte_misses = 0
-
-    _last_loop_mark = time.perf_counter()   
-
-    while not stopflag:
-
-        _elapsed_push_if_needed(period=0.95)
-
-        # send any pending text command
-        if shproto.dispatcher.command:
-            # grab-and-clear under lock
-            with shproto.dispatcher.command_lock:
-                local_cmd = shproto.dispatcher.command
-                shproto.dispatcher.command = ""
-
-            logger.info(f"   ✅ Dispatched command: {local_cmd!r} ")
-
-            # Local host timers (still forward to device too; remove if device handles them)
-            if   local_cmd == "-sta": _elapsed_start()
-            elif local_cmd == "-sto": _elapsed_stop()
-            elif local_cmd == "-rst":
-                _elapsed_reset()
-                shproto.dispatcher.clear()
-
-            # IMPORTANT: send the command EXACTLY as provided (no CR/LF, no lowercasing)
-            tx = shproto.packet()
-            tx.cmd = shproto.MODE_TEXT
-            tx.start()
-            for b in local_cmd.encode("ascii", "strict"):
-                tx.add(b)
-            tx.stop()
-
-            shproto.dispatcher._last_cmd_sent = local_cmd
-            shproto.dispatcher._expect_cal = (local_cmd.strip().lower() == "-cal")
-
-            try:
-                nano.write(tx.payload)
-                logger.info(f"   ✅ Sent command: {local_cmd!r}")
-            except Exception as e:
-                logger.error(f"❌ Failed to write command {local_cmd!r}: {e}")
-
-
-            # Debug what we actually put on the wire (first 64 bytes)
-            try:
-                import binascii
-                logger.debug("  🐞 TX payload (hex): " + binascii.hexlify(tx.payload[:64]).decode())
-                logger.debug(f"  🐞 TX ascii: {local_cmd!r} (len={len(local_cmd)})")
-            except Exception:
-                pass
-
-        # blocking read with timeout; returns b'' on timeout
-        _gap_before_read = time.perf_counter() - _last_loop_mark   
-        if _gap_before_read > 1.0:                                  
-            logger.warning(                                          
-                " ⚠️ LOOP STALL before read(): %.2fs elapsed since previous iteration",  
-                _gap_before_read,                                     
-            )                                                         
-
-        _read_start = time.perf_counter()   
-
-        try:
-            waiting = nano.in_waiting
-
-            # If the receive queue starts growing, log it.
-            if waiting > 32768:
-                logger.warning(
-                    "⚠️ SERIAL BACKLOG: %d bytes waiting in receive buffer",
-                    waiting,
-                )
-
-            if waiting > 0:
-                rx = nano.read(min(waiting, 8192))
-            else:
-                rx = nano.read(1)
-
-        except serial.SerialException as e:
-            logger.warning(
-                "👆 Serial read failed, likely disconnected or busy: %s",
-                e,
-            )
-            break
-        
-        _read_dur = time.perf_counter() - _read_start   
-        if _read_dur > 1.0:                                
-            logger.warning(                                 
-                " ⚠️ READ() BLOCKED: nano.read() took %.2fs (nano.timeout=%.2f) bytes_returned=%d",  
-                _read_dur, nano.timeout, len(rx) if rx else 0,   
-            )                                                  
-
-        _last_loop_mark = time.perf_counter()   
-
-        if not rx:
-            continue  # silent: normal timeout / no bytes yet
-
-        for b in rx:
-            response.read(b)
-
-            if response.dropped:
-                cmd = response.cmd
-
-                shproto.dispatcher.dropped += 1
-                shproto.dispatcher.total_pkts += 1
-
-                shproto.dispatcher.dropped_by_cmd[cmd] = (
-                    shproto.dispatcher.dropped_by_cmd.get(cmd, 0) + 1
-                )
-
-                packet_name = shproto.dispatcher.PACKET_NAMES.get(
-                    cmd,
-                    f"UNKNOWN_0x{cmd:02X}",
-                )
-
-                logger.warning(
-                    "⚠️ CRC failure: type=%s cmd=0x%02X dropped_for_cmd=%d "
-                    "dropped_total=%d",
-                    packet_name,
-                    cmd,
-                    shproto.dispatcher.dropped_by_cmd[cmd],
-                    shproto.dispatcher.dropped,
-                    len(response.raw_data),
-                )
-
-                response.clear()
-                continue
-
-            if not response.ready:
-                continue
-
-            shproto.dispatcher.total_pkts += 1
-
-
-            # ===========================================================================
-            # MODE_TEXT
-            # ===========================================================================
-            if response.cmd == shproto.MODE_TEXT:
-                shproto.dispatcher.pkts03 += 1
-                try:
-                    raw_bytes = bytes(response.payload)  # DO NOT SLICE
-                    resp_text = raw_bytes.decode("ascii", errors="replace")
-
-                    # Preserve original line structure; trim only the very last empty line if present
-                    lines = resp_text.splitlines()
-                    if lines and lines[-1] == "":
-                        lines = lines[:-1]
-
-                    # Publish to UI: first non-empty line
-                    first_non_empty = next((ln for ln in lines if ln.strip()), "")
-                    with shared.write_lock:
-                        shared.last_text = resp_text
-                        shared.max_serial_output = first_non_empty
-
-                    # ACK detection
-                    if any(ln.strip().lower() == "ok" for ln in lines):
-                        logger.info("   ✅ ok ")
-
-                    # --- CRC + calibration load (minimal change with sentinel guard) ---
-                    if len(lines) >= 11:
-                        b_str = "".join(lines[0:10])
-                        crc_calc = binascii.crc32(b_str.encode("ascii")) & 0xFFFFFFFF
-
-                        crc_str = lines[10].strip()  # device's CRC line
-
-                        last_cmd = getattr(shproto.dispatcher, "_last_cmd_sent", "?")
-
-                        # skip compare if device reports a sentinel/no-CRC
-                        if crc_str.upper() in ("FFFFFFFF", "00000000"):
-                            logger.info("   ✅ Device reports no CAL CRC (got %r); skipping compare (after cmd=%r)",
-                                         crc_str, getattr(shproto.dispatcher, "_last_cmd_sent", "?"))
-                        else:
-                            try:
-                                crc_dev = int(crc_str, 16)
-                            except ValueError:
-                                logger.info("👆 CAL: no CRC provided by device (sentinel %s) — skipping validation (cmd=%r)", crc_str, last_cmd)
-
-                            else:
-                                if crc_calc == crc_dev:
-                                    with shproto.dispatcher.calibration_lock:
-                                        shproto.dispatcher.calibration[0] = unpack('d', int((lines[0] + lines[1]), 16).to_bytes(8, 'little'))[0]
-                                        shproto.dispatcher.calibration[1] = unpack('d', int((lines[2] + lines[3]), 16).to_bytes(8, 'little'))[0]
-                                        shproto.dispatcher.calibration[2] = unpack('d', int((lines[4] + lines[5]), 16).to_bytes(8, 'little'))[0]
-                                        shproto.dispatcher.calibration[3] = unpack('d', int((lines[6] + lines[7]), 16).to_bytes(8, 'little'))[0]
-                                        shproto.dispatcher.calibration[4] = unpack('d', int((lines[8] + lines[9]), 16).to_bytes(8, 'little'))[0]
-                                        shproto.dispatcher.calibration_updated = 1
-                                    logger.info(f"   ✅ Got calibration: {shproto.dispatcher.calibration} ")
-                                else:
-                                    logger.error("  ❌ Wrong crc for calibration values got: %08x expected: %08x (after cmd=%r)",
-                                        crc_dev, crc_calc, getattr(shproto.dispatcher, "_last_cmd_sent", "?"),
-                                    )
-
-                    # VERSION blob (unchanged)
-                    if re.search(r'^VERSION', resp_text):
-                        shproto.dispatcher.inf_str = resp_text
-                        logger.info("   ✅ Got MAX settings ")
-
-                    # Serial number detection:
-                    sn = None
-                    # primary: line 40 if available
-                    if len(lines) >= 40 and lines[39].strip():
-                        cand = lines[39].strip()
-                        if re.fullmatch(r"\d{6,12}", cand):  # adjust width if your SN length differs
-                            sn = cand
-                    # fallback: scan from bottom for a pure digits line (6–12)
-                    if sn is None:
-                        for ln in reversed(lines):
-                            tok = ln.strip()
-                            if re.fullmatch(r"\d{6,12}", tok):
-                                sn = tok
-                                break
-                    if sn:
-                        serial_number = sn
-                        with shared.write_lock:
-                            shared.serial_number = sn
-                        logger.info(f"   ✅ Found MAX serial # {serial_number} ")
-
-
-                except Exception as e:
-                    logger.warning(f"👆 MODE_TEXT decode issue: {e}")
-
-                response.clear()
-
-
-
-            # ===========================================================================
-            # MODE_HISTOGRAM
-            # ===========================================================================
-            elif response.cmd == shproto.MODE_HISTOGRAM:
-                shproto.dispatcher.pkts01 += 1
-                pl = response.payload
-                if len(pl) < 2:
-                    response.clear()
-                    continue
-
-                offset = (pl[0] & 0xFF) | ((pl[1] & 0xFF) << 8)
-                data   = pl[2:]
-                count  = len(data) // 4
-
-                # Start-of-frame heuristic
-                if offset == 0:
-                    shproto.dispatcher._histogram_cov_count = 0
-                    shproto.dispatcher._histogram_covered[:] = b"\x00" * 8192
-
-                rhist = shproto.dispatcher.raw_hist
-
-                with shproto.dispatcher.histogram_lock:
-                    hlist = shproto.dispatcher.histogram
-
-                    for i in range(count):
-                        idx = offset + i
-                        if idx >= 8192:
-                            break
-
-                        # coverage bookkeeping (unique bins only)
-                        if shproto.dispatcher._histogram_covered[idx] == 0:
-                            shproto.dispatcher._histogram_covered[idx] = 1
-                            shproto.dispatcher._histogram_cov_count += 1
-
-                        base = i * 4
-                        new_val = (
-                            (data[base + 0]) |
-                            (data[base + 1] << 8) |
-                            (data[base + 2] << 16) |
-                            (data[base + 3] << 24)
-                        ) & 0x7FFFFFFF
-
-                        old_val = rhist[idx]
-                        if new_val != old_val:
-                            delta = int(new_val) - int(old_val)
-                            if delta < 0:
-                                delta = 0
-                            rhist[idx] = new_val
-                            hlist[idx] = new_val
-                            shproto.dispatcher.cps_total_counts += delta
-                            shproto.dispatcher._hist_delta_since_stat += delta
-
-                # frame complete only when we truly covered all bins
-                if shproto.dispatcher._histogram_cov_count >= 8192:
-                    shproto.dispatcher._histogram_version += 1
-                    shproto.dispatcher._histogram_row_complete.set()
-                    # optional: clear here if something consumes it
-                    # shproto.dispatcher._histogram_row_complete.clear()
-
-                response.clear()
-
-
-            # ===========================================================================
-            # MODE_PULSE
-            # ===========================================================================
-            elif response.cmd == shproto.MODE_PULSE:
-                pulse_data = []
-
-                # Extract pulse data from the payload (16-bit values)
-                for i in range(0, len(response.payload), 2):
-                    if i + 1 < len(response.payload):
-                        value = (response.payload[i + 1] << 8) | response.payload[i]
-                        pulse_data.append(value)
-
-                if pulse_data:
-                    pulse_data = pulse_data[:-1]  # Remove last item if needed
-
-                    with shared.write_lock:
-                        shared.max_pulse_shape = pulse_data
-
-                # Open the CSV file only once per script execution
-                if not pulse_file_initialized:
-                    file_exists = os.path.isfile(csv_file_path)
-                    with open(csv_file_path, "a+", buffering=1) as fd_pulses:
-                        if not file_exists:
-                            header = ",".join(map(str, range(len(pulse_data)))) + "\n"
-                            fd_pulses.write(header)
-                    pulse_file_initialized = True
-
-                # Append the pulse data as a new row
-                with open(csv_file_path, "a", buffering=1) as fd_pulses:
-                    fd_pulses.write(",".join(map(str, pulse_data)) + "\n")
-
-                response.clear()
-
-            # ===========================================================================
-            # MODE_STAT
-            # ===========================================================================
-            elif response.cmd == shproto.MODE_STAT:
-                shproto.dispatcher.pkts04 += 1
-
-                payload = response.payload
-                if len(payload) < 6:
-                    response.clear()
-                    continue
-
-                # 1) Parse device counters
-                total_time_raw = (payload[0] & 0xFF) | \
-                                 ((payload[1] & 0xFF) << 8) | \
-                                 ((payload[2] & 0xFF) << 16) | \
-                                 ((payload[3] & 0xFF) << 24)
-
-                shproto.dispatcher.total_time = total_time_raw
-                shproto.dispatcher.cpu_load   = (payload[4] & 0xFF) | ((payload[5] & 0xFF) << 8)
-
-                curr_tt = total_time_raw * _TIME_SCALE
-                prev_tt = shproto.dispatcher.stat_prev_tt
-
-                # 2) First STAT: establish baseline, don’t compute CPS yet
-                if prev_tt is None:
-                    shproto.dispatcher.stat_prev_tt = curr_tt
-                    shproto.dispatcher._hist_delta_since_stat = 0
-
-                # 3) Subsequent STATs: CPS = (new counts since last STAT) / (device seconds elapsed)
-                else:
-                    dt = curr_tt - prev_tt
-
-                    # Only log abnormal STAT timing
-                    if dt <= 0 or dt > 2.0:
-                        logger.warning(
-                            "STAT anomaly: raw=%d curr=%.3f prev=%.3f dt=%.3f delta=%d",
-                            total_time_raw,
-                            curr_tt,
-                            prev_tt,
-                            dt,
-                            shproto.dispatcher._hist_delta_since_stat,
-                        )
-
-                    if dt <= 0:
-                        dt = 1.0  # safety fallback
-
-                    cps_int = int(round(shproto.dispatcher._hist_delta_since_stat / dt))
-
-                    if shproto.dispatcher._histogram_cov_count < 8192:
-                        logger.warning(
-                            " ⚠️ INCOMPLETE FRAME at STAT: covered=%d/8192 delta=%d dt=%.3f cps=%d dropped_total=%d",
-                            shproto.dispatcher._histogram_cov_count,
-                            shproto.dispatcher._hist_delta_since_stat,
-                            dt,
-                            cps_int,
-                            shproto.dispatcher.dropped,
-                        )
-
-
-                    with shared.write_lock:
-                        shared.cps = cps_int
-                        shared.count_history.append(cps_int)
-
-                    shproto.dispatcher.stat_prev_tt = curr_tt
-                    shproto.dispatcher._hist_delta_since_stat = 0
-
-                # 4) Heartbeat for process_01/process_02 (wake them once per STAT)
-                _stat_version += 1
-                _stat_tick.set()
-
-                response.clear()
-
-
-    nano.close()
+    """Blocking serial loop of the shared engine."""
+    engine.run(sn)
 
 # ========================================================
 # 2D Histogram and cps
 # ========================================================
 def process_01(filename, compression, device, t_interval):
-    logger.info(f'   ✅ process_01({filename}) ')
-
-    global counts, last_counts
-    counts       = 0
-    last_counts  = 0
-    elapsed      = 0
-    tt           = 0 # device seconds; default 0 in case no STAT is received
-    max_bins     = 8192
-    spec_notes   = ""
-
-    et_start     = time.time()
-    et_start_fix = et_start
-    dt_start     = datetime.fromtimestamp(et_start)
-
-    with shared.write_lock:
-        compression = shared.compression
-        max_counts  = shared.max_counts
-        max_seconds = shared.max_seconds
-
-    compressed_bins = int(max_bins / compression)
-
-    # Working buffers
-    hst      = [0] * max_bins
-    compressed_histogram = [0] * compressed_bins
-
-    # Drive by device STAT
-    last_stat_version = -1
-    stats_since_save  = 0
-    timeout_logged = False
-
-
-    while True:
-        # Stop checks first
-        if spec_stopflag or stopflag:
-            logger.info("   ✅ process_01: stop signal ")
-            break
-        if counts >= max_counts or elapsed > max_seconds:
-            logger.info("   ✅ process_01: stop condition (counts or time)")
-            break
-
-        # === Wait for device STAT (1 Hz) ===
-        if not _stat_tick.wait(timeout=max(2.0, t_interval + 0.5)):
-            if not timeout_logged:
-                
-                logger.warning(
-                    "👆 process_01 STAT timeout: "
-                    "stat_version=%d last_stat_version=%d "
-                    "device_time=%s accumulated_delta=%d "
-                    "dispatcher_alive=%s",
-                    _stat_version,
-                    last_stat_version,
-                    total_time,
-                    _hist_delta_since_stat,
-                    bool(
-                        _dispatcher_thread is not None
-                        and _dispatcher_thread.is_alive()
-                    ),
-                )
-
-                timeout_logged = True
-            continue
-
-        timeout_logged = False
-
-
-        # De-dupe STATs using version
-        stat_v = _stat_version
-        if stat_v == last_stat_version:
-            _stat_tick.clear()
-            continue
-        last_stat_version = stat_v
-        _stat_tick.clear()
-
-        # === Atomic snapshot after STAT ===
-        with histogram_lock:
-            hst = histogram.copy()
-            tt  = total_time  # device time ticks, seconds on your scale
-
-        # Compress to requested channels
-        compressed_histogram = [sum(hst[i:i + compression]) for i in range(0, max_bins, compression)]
-        counts   = sum(compressed_histogram)
-
-        # Publish to UI (device-synchronous)
-        with shared.write_lock:
-            shared.counts    = counts
-            shared.histogram = compressed_histogram
-            # keep shared.elapsed tied to device seconds if you want:
-            shared.elapsed   = int(tt)
-
-        # Bookkeeping
-        stats_since_save += 1
-        last_counts = counts
-        elapsed     = int(time.time() - et_start_fix)  # host elapsed; UI elapsed is tt above
-
-        # === Periodic save (about once per minute of STATs) ===
-        if stats_since_save >= 60 or spec_stopflag or stopflag:
-            dt_now = datetime.fromtimestamp(time.time())
-            # pull coeffs/spec_notes under lock for consistency
-            with shared.write_lock:
-                coeff_1 = shared.coeff_1
-                coeff_2 = shared.coeff_2
-                coeff_3 = shared.coeff_3
-                spec_notes = shared.spec_notes
-                # if you prefer device seconds in file:
-                elapsed_for_file = int(tt)
-
-            save_histogram_json(
-                filename=filename,
-                device=device,
-                histogram=compressed_histogram,
-                counts=counts,
-                elapsed=elapsed_for_file,
-                coeffs=[coeff_3, coeff_2, coeff_1],
-                spec_notes=spec_notes,
-                dt_start=dt_start,
-                dt_now=dt_now
-            )
-            stats_since_save = 0
-
-    # Final save on exit
-    compressed_histogram = [sum(hst[i:i + compression]) for i in range(0, max_bins, compression)]
-    counts   = sum(compressed_histogram)
-    dt_now   = datetime.fromtimestamp(time.time())
-    with shared.write_lock:
-        coeff_1 = shared.coeff_1
-        coeff_2 = shared.coeff_2
-        coeff_3 = shared.coeff_3
-        spec_notes = shared.spec_notes
-        elapsed_for_file = int(tt)  # device seconds
-    save_histogram_json(
-        filename=filename,
-        device=device,
-        histogram=compressed_histogram,
-        counts=counts,
-        elapsed=elapsed_for_file,
-        coeffs=[coeff_3, coeff_2, coeff_1],
-        spec_notes=spec_notes,
-        dt_start=dt_start,
-        dt_now=dt_now
-    )
-
-    # send -sto and clear run flag
-    stop()
-    with shared.write_lock:
-        shared.run_flag.clear()
-    return
-
-
+    engine.record_2d(filename, compression, device, t_interval)
 
 # ========================================================
 # 3D WATERFALL
 # ========================================================
-
 def process_02(filename, compression3d, device, t_interval):
-    logger.info(f'   ✅ Received cmd ({filename}) ')
-
-    global counts, last_counts, histogram_hmp
-
-    et_start    = time.time()
-    counts      = 0
-    last_counts = 0
-
-    # full history for JSON saves
-    hst3d           = []
-    gps_hmp_full    = []
-    max_bins        = 8192
-    compressed_bins = int(max_bins / compression3d)
-    last_hst        = [0] * compressed_bins
-
-    # If your STAT is 1 Hz, saving every 60 rows ≈ once per minute.
-    SAVE_EVERY_ROWS = 60
-
-    # --- load shared settings, prep ring buffer, set run flag ---
-    with shared.write_lock:
-        shared.run_flag.set()
-        t_interval  = int(shared.t_interval)      # seconds between spectrum rows
-        max_counts  = int(shared.max_counts)
-        max_seconds = int(shared.max_seconds)
-        # NPES expects [c3,c2,c1]; your internal is [c1,c2,c3]; we pass NPES order into saver
-        coeffs      = [shared.coeff_3, shared.coeff_2, shared.coeff_1]
-
-        RING_LEN = max(60, getattr(shared, "ring_len_hmp", 3600))  # e.g. 1 hr @ 1 Hz
-        if not isinstance(getattr(shared, "histogram_hmp", None), deque):
-            shared.histogram_hmp = deque(maxlen=RING_LEN)
-        else:
-            shared.histogram_hmp.clear()
-
-    dt_start = datetime.fromtimestamp(et_start)
-
-    last_stat_version = -1
-    rows_since_save   = 0
-
-    def _save_checkpoint():
-        try:
-            dt_now = datetime.fromtimestamp(time.time())
-            save.save_histogram_hmp_json(
-                filename       = filename,
-                histogram_rows = hst3d,
-                gps_rows       = gps_hmp_full,
-                counts         = counts,
-                elapsed        = int(shproto.dispatcher.total_time * _TIME_SCALE),
-                coeffs         = coeffs,
-                dt_start       = dt_start,
-                dt_now         = dt_now,
-                device         = device
-            )
-        except Exception as e:
-            logger.error(f"❌ Failed to save JSON checkpoint: {e}", exc_info=True)
-
-    try:
-        while True:
-            # external stop?
-            if shproto.dispatcher.spec_stopflag or shproto.dispatcher.stopflag:
-                logger.info("   ✅ process_02 received stop signal ")
-                break
-
-            # wait for next STAT tick (device says “new data ready”)
-            if not shproto.dispatcher._stat_tick.wait(timeout=max(2.0, t_interval + 0.5)):
-                logger.warning("👆 process_02: STAT wait timeout")
-                continue
-
-            # dedupe STAT by version
-            stat_v = shproto.dispatcher._stat_version
-            if stat_v == last_stat_version:
-                shproto.dispatcher._stat_tick.clear()
-                continue
-            last_stat_version = stat_v
-            shproto.dispatcher._stat_tick.clear()
-
-            # 1) snapshot device state
-            with shproto.dispatcher.histogram_lock:
-                hst = shproto.dispatcher.histogram.copy()
-                tt  = shproto.dispatcher.total_time  # device seconds, monotonic
-
-            # 2) compress and compute delta row
-            compressed_histogram = [sum(hst[i:i+compression3d]) for i in range(0, max_bins, compression3d)]
-            counts   = sum(compressed_histogram)
-            this_hst = [a - b for a, b in zip(compressed_histogram, last_hst)]
-            last_hst = compressed_histogram
-
-            # 3) stop conditions (now that counts & tt are known)
-            if counts >= max_counts or tt >= max_seconds:
-                _elapsed_stop()
-                shproto.dispatcher.stopflag = True
-                logger.info("   ✅ Stop condition met (counts or time) ")
-                break
-
-            # 4) publish latest row to UI ring buffer and update stats
-            hst3d.append(this_hst)
-            rows_since_save += 1
-
-            with shared.write_lock:
-                shared.counts  = counts
-                shared.elapsed = int(tt)
-
-                # histogram ring exists already
-                shared.histogram_hmp.append(this_hst)
-
-                # gps ring matches histogram ring
-                if not isinstance(getattr(shared, "gps_hmp", None), deque):
-                    shared.gps_hmp = deque(maxlen=getattr(shared, "ring_len_hmp", 3600))
-                else:
-                    # only clear at run start, not here
-                    pass
-
-                fix = getattr(shared, "last_gps_fix", None)
-                ok = isinstance(fix, dict) and fix.get("fix") and (fix.get("lat") is not None) and (fix.get("lon") is not None)
-
-                row = {"lat": fix.get("lat") if ok else None,
-                       "lon": fix.get("lon") if ok else None,
-                       "t": int(tt)}
-                
-                shared.gps_hmp.append(row)
-                gps_hmp_full.append(row)
-
-            # 5) periodic JSON checkpoint
-            if rows_since_save >= SAVE_EVERY_ROWS:
-                _save_checkpoint()
-                rows_since_save = 0
-
-            last_counts = counts
-
-    except Exception as e:
-        logger.error(f"❌ process_02 crashed: {e}", exc_info=True)
-    finally:
-        # ensure UI sees stopped state in ALL exit paths
-        with shared.write_lock:
-            shared.run_flag.clear()
-        # optional: reset dispatcher flags so next run starts clean
-        shproto.dispatcher.spec_stopflag = False
-        shproto.dispatcher.stopflag      = False
-        # final save
-        _save_checkpoint()
-        logger.info("   ✅ process_02 stopped; shared.run_flag=False")
+    engine.record_3d(filename, compression3d, device, t_interval)
 
 
 # This process is used for sending commands to the Nano device
 def process_03(cmd):
-
     ensure_running()
-
-    with shproto.dispatcher.command_lock:
-
-        shproto.dispatcher.command = cmd
-
+    engine.send(cmd)
     logger.info(f"   📨 Queued command: {cmd!r}")
 
 
-
 def clear():
+    engine.clear()
 
-    with shproto.dispatcher.histogram_lock:
-        shproto.dispatcher.stat_prev_tt             = None
-        shproto.dispatcher._hist_delta_since_stat   = 0
-        shproto.dispatcher.histogram                = [0] * max_bins
-        shproto.dispatcher.pkts01                   = 0
-        shproto.dispatcher.pkts03                   = 0
-        shproto.dispatcher.pkts04                   = 0
-        shproto.dispatcher.total_pkts               = 0
-        shproto.dispatcher.cpu_load                 = 0
-        shproto.dispatcher.cps                      = 0
-        shproto.dispatcher.total_time               = 0
-        shproto.dispatcher.lost_impulses            = 0
-        shproto.dispatcher.total_pulse_width        = 0
-        shproto.dispatcher.dropped                  = 0
-        shproto.dispatcher.dropped_by_cmd.clear()
-        shproto.dispatcher.cps_total_counts         = 0
 
-    with shared.write_lock:
-        shared.cps           = 0
-        shared.histogram     = [0] * max_bins
-        shared.count_history      = []
-
-
-def save_histogram_json(filename, device, histogram, counts, elapsed, coeffs, spec_notes, dt_start, dt_now):
-    save.save_histogram_json(
-        filename=filename,
-        device=device,
-        histogram=histogram,
-        counts=counts,
-        dropped_counts=0,
-        elapsed=elapsed,
-        coeff_1=coeffs[0],
-        coeff_2=coeffs[1],
-        coeff_3=coeffs[2],
-        spec_notes=spec_notes,
-        dt_start=dt_start,
-        dt_now=dt_now,
-    )
-    save.save_count_history_csv(filename)
+def export_pulse_csv(path=None):
+    """Write the logged MAX pulses to CSV (defaults to the old _max-pulse-shape.csv)."""
+    if path is None:
+        path = os.path.join(USER_DATA_DIR, "_max-pulse-shape.csv")
+    return shproto.pulses.sink.export_csv(path)
 
 def load_json_data(file_path):
     logger.info(f'   ✅ dispatcher.load_json_data({file_path}) ')
@@ -1006,13 +163,4 @@ def load_json_data(file_path):
         }
 
 def stop():
-    global spec_stopflag
-    try:
-        process_03("-sto")
-    except Exception as e:
-        logger.error(f"  ❌ dispatcher.stop(): {e} ")
-    with spec_stopflag_lock:
-        spec_stopflag = 1
-
-
-
+    engine.stop()
@@ -0,0 +1,424 @@
+# shproto/emulator.py
+#
+# Pseudo-terminal GS-MAX emulator for load testing (Linux/macOS only).
+#
+#   python -m shproto.emulator --cps 20000 --frame-rate 4 --crc-errors 0.01
+#
+# Prints the slave pty path (e.g. /dev/pts/7). Put that in shared.device_port
+# (or pass it as port_str to shproto.port.connectdevice) and the dispatcher
+# will talk to the emulator exactly like it talks to a real MAX.
+
+import os
+import sys
+import tty
+import time
+import math
+import bisect
+import random
+import select
+import struct
+import logging
+import argparse
+import binascii
+import threading
+
+import shproto
+
+logger = logging.getLogger(__name__)
+
+CHANNELS        = 8192
+CHUNK_CHANNELS  = 256       # 2 + 256*4 = 1026 bytes payload, worst case 2x escaped < BUFFER_SIZE
+# Largest chunk whose packet fits BUFFER_SIZE with every byte escaped:
+# 0xFF 0xFE + 2 * (cmd + 2 offset + 4n + 2 crc) + finish = 13 + 8n bytes
+MAX_CHUNK       = (shproto.BUFFER_SIZE - 14) // 8
+DEFAULT_SN      = "24080001"
+DEFAULT_CAL     = (0.0, 0.37, 0.0, 0.0, 0.0)   # 5 doubles, same layout as dispatcher.calibration
+
+
+# ------------------------------------------------------------
+# Histogram content generators
+# ------------------------------------------------------------
+def shape_peaks(channels=CHANNELS):
+    """Exponential continuum plus a couple of gaussian photopeaks."""
+    shape = []
+    for ch in range(channels):
+        y  = 40.0 * math.exp(-ch / 900.0)
+        y += 25.0 * math.exp(-0.5 * ((ch - 1790) / 38.0) ** 2)   # ~662 keV at 0.37 keV/ch
+        y += 8.0  * math.exp(-0.5 * ((ch - 3950) / 60.0) ** 2)   # ~1461 keV
+        shape.append(y)
+    return shape
+
+def shape_flat(channels=CHANNELS):
+    return [1.0] * channels
+
+def shape_from_json(path, channels=CHANNELS):
+    """Use the spectrum of an existing NPESv2 .json (plain or compressed) as the histogram shape."""
+    import jsonio       # pulls in shared; only needed for --shape <file>
+    data = jsonio.load(path)
+    spec = data["data"][0]["resultData"]["energySpectrum"]["spectrum"]
+    spec = [float(v) for v in spec][:channels]
+    if len(spec) < channels:
+        # stretch short spectra (e.g. 1024 bins) over the full channel range
+        step  = channels / max(1, len(spec))
+        spec  = [spec[min(len(spec) - 1, int(ch / step))] for ch in range(channels)]
+    return spec
+
+SHAPES = {
+    "peaks": shape_peaks,
+    "flat":  shape_flat,
+}
+
+
+# ------------------------------------------------------------
+# Emulator
+# ------------------------------------------------------------
+class MaxEmulator:
+    """
+    Opens a pty pair and answers shproto commands on the master side.
+
+    cps             counts added per second while running (-sta)
+    frame_rate      full 8192 channel frames per second, 0 = as fast as the host reads
+    chunk           channels per MODE_HISTOGRAM packet (at most MAX_CHUNK)
+    crc_error_rate  probability that a packet is sent with a bad CRC
+    drop_rate       probability that a packet is never sent
+    shape           list of channel weights, or a callable returning one
+    """
+
+    def __init__(self, cps=1000, frame_rate=1.0, chunk=CHUNK_CHANNELS,
+                 crc_error_rate=0.0, drop_rate=0.0, shape=None,
+                 serial_number=DEFAULT_SN, calibration=DEFAULT_CAL,
+                 stat_interval=1.0, seed=None):
+
+        self.cps            = max(0.0, float(cps))
+        self.frame_rate     = max(0.0, float(frame_rate))
+        self.chunk          = max(1, min(int(chunk), MAX_CHUNK))
+        self.crc_error_rate = max(0.0, min(1.0, float(crc_error_rate)))
+        self.drop_rate      = max(0.0, min(1.0, float(drop_rate)))
+        self.serial_number  = str(serial_number)
+        self.calibration    = tuple(float(c) for c in calibration)
+        self.stat_interval  = float(stat_interval)
+
+        self._rng = random.Random(seed)
+
+        if callable(shape):
+            shape = shape()
+        if shape is None:
+            shape = shape_peaks()
+        self._set_shape(shape)
+
+        self.histogram  = [0] * CHANNELS
+        self.total_time = 0        # device seconds while running
+        self.running    = False
+
+        self._lock      = threading.Lock()
+        self._stop      = threading.Event()
+        self._thread    = None
+        self._master    = None
+        self._slave     = None
+        self.port       = None
+
+        # counters for the test harness
+        self.sent_packets   = 0
+        self.sent_bytes     = 0
+        self.sent_frames    = 0
+        self.crc_injected   = 0
+        self.dropped        = 0
+        self.commands       = []
+        self.write_blocked_s = 0.0
+
+    # ---- shape / counts ----------------------------------------
+
+    def _set_shape(self, shape):
+        shape = [max(0.0, float(v)) for v in shape][:CHANNELS]
+        shape += [0.0] * (CHANNELS - len(shape))
+        total = sum(shape) or 1.0
+        # cumulative distribution for sampling
+        cdf, acc = [], 0.0
+        for v in shape:
+            acc += v / total
+            cdf.append(acc)
+        self._cdf = cdf
+
+    def _add_counts(self, n):
+        if n <= 0:
+            return
+        cdf  = self._cdf
+        hist = self.histogram
+        rnd  = self._rng.random
+        for _ in range(n):
+            idx = bisect.bisect_left(cdf, rnd())
+            if idx >= CHANNELS:
+                idx = CHANNELS - 1
+            hist[idx] = (hist[idx] + 1) & 0x7FFFFFFF
+
+    # ---- pty lifecycle -----------------------------------------
+
+    def open(self):
+        """Create the pty pair and return the slave path."""
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._master = master
+        self._slave  = slave          # keep open so master never sees EIO
+        self.port    = os.ttyname(slave)
+        return self.port
+
+    def start(self):
+        if self._master is None:
+            self.open()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="MaxEmulator")
+        self._thread.start()
+        logger.info(f"   ✅ MAX emulator listening on {self.port}")
+        return self.port
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+        for fd in (self._master, self._slave):
+            try:
+                if fd is not None:
+                    os.close(fd)
+            except OSError:
+                pass
+        self._master = self._slave = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "port":            self.port,
+                "running":         self.running,
+                "total_time":      self.total_time,
+                "sent_packets":    self.sent_packets,
+                "sent_bytes":      self.sent_bytes,
+                "sent_frames":     self.sent_frames,
+                "crc_injected":    self.crc_injected,
+                "dropped":         self.dropped,
+                "write_blocked_s": round(self.write_blocked_s, 3),
+            }
+
+    # ---- packet building ---------------------------------------
+
+    def _packet(self, cmd, payload):
+        """Frame a packet, optionally with a corrupted CRC. Returns bytes or None when dropped."""
+        if self.drop_rate and self._rng.random() < self.drop_rate:
+            with self._lock:
+                self.dropped += 1
+            return None
+
+        pkt = shproto.packet()
+        pkt.cmd = cmd
+        pkt.start()
+        for b in payload:
+            pkt.add(b)
+
+        if self.crc_error_rate and self._rng.random() < self.crc_error_rate:
+            # bad CRC with valid framing, so the receiver reports it as a CRC failure
+            crc = pkt.crc ^ 0x5A5A
+            pkt.add(crc & 0xFF)
+            pkt.add(crc >> 8)
+            pkt.payload.append(shproto.SHPROTO_FINISH)
+            with self._lock:
+                self.crc_injected += 1
+        else:
+            pkt.stop()
+
+        return bytes(pkt.payload)
+
+    def _write(self, data):
+        """Write everything, waiting on the pty like a device waiting on a full FTDI buffer."""
+        if not data:
+            return
+        view = memoryview(data)
+        while view and not self._stop.is_set():
+            t0 = time.perf_counter()
+            _, w, _ = select.select([], [self._master], [], 0.1)
+            if not w:
+                self.write_blocked_s += time.perf_counter() - t0
+                self._poll_commands(0)
+                continue
+            try:
+                n = os.write(self._master, view)
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                logger.warning(f"👆 emulator write failed: {e}")
+                self._stop.set()
+                return
+            view = view[n:]
+            with self._lock:
+                self.sent_bytes += n
+        with self._lock:
+            self.sent_packets += 1
+
+    def _send(self, cmd, payload):
+        self._write(self._packet(cmd, payload))
+
+    def _send_text(self, text):
+        self._send(shproto.MODE_TEXT, text.encode("ascii", errors="replace"))
+
+    def _send_histogram_frame(self):
+        hist = self.histogram
+        for offset in range(0, CHANNELS, self.chunk):
+            n = min(self.chunk, CHANNELS - offset)
+            payload = struct.pack("<H", offset) + struct.pack(f"<{n}I", *hist[offset:offset + n])
+            self._send(shproto.MODE_HISTOGRAM, payload)
+            if self._stop.is_set():
+                return
+        with self._lock:
+            self.sent_frames += 1
+
+    def _send_stat(self):
+        cpu_load = 120 + self._rng.randint(0, 30)
+        self._send(shproto.MODE_STAT, struct.pack("<IH", self.total_time & 0xFFFFFFFF, cpu_load))
+
+    # ---- text replies ------------------------------------------
+
+    def _calibration_text(self):
+        lines = []
+        for c in self.calibration:
+            n = int.from_bytes(struct.pack("d", c), "little")
+            h = f"{n:016X}"
+            lines += [h[:8], h[8:]]
+        crc = binascii.crc32("".join(lines).encode("ascii")) & 0xFFFFFFFF
+        lines.append(f"{crc:08X}")
+        return "\n".join(lines) + "\n"
+
+    def _inf_text(self):
+        return (
+            "VERSION 12.18 EMU\n"
+            "RISE 11\nFALL 27\nNOISE 10\nF 1000000\nMAX 8192\nHYST 2\nMODE 0\n"
+            "STEP 1\nt 40\nPOT 64\nPOT2 64\nT1 25.0\nT2 25.0\nT3 25.0\n"
+            "Prise 0\nSrise 0\nPfall 0\nSfall 0\nTC off\nTCpot 0\nTin 25.0\n"
+            "Tout 25.0\nTP 0\nPileUp 0\nPileUpThr 0\n"
+            f"{self.serial_number}\n"
+        )
+
+    def _handle_command(self, cmd):
+        cmd = cmd.strip()
+        self.commands.append(cmd)
+        logger.info(f"   ✅ emulator got command {cmd!r}")
+
+        if cmd == "-inf":
+            self._send_text(self._inf_text())
+        elif cmd == "-cal":
+            self._send_text(self._calibration_text())
+        elif cmd == "-sta":
+            self.running = True
+            self._send_text("ok\n")
+        elif cmd == "-sto":
+            self.running = False
+            self._send_text("ok\n")
+        elif cmd == "-rst":
+            self.histogram  = [0] * CHANNELS
+            self.total_time = 0
+            self._send_text("ok\n")
+        else:
+            self._send_text("ok\n")
+
+    def _poll_commands(self, timeout):
+        r, _, _ = select.select([self._master], [], [], timeout)
+        if not r:
+            return
+        try:
+            data = os.read(self._master, 4096)
+        except OSError:
+            return
+        for b in data:
+            self._rx.read(b)
+            if self._rx.dropped:
+                self._rx.clear()
+                continue
+            if self._rx.ready:
+                if self._rx.cmd == shproto.MODE_TEXT:
+                    # payload still carries the two CRC bytes
+                    text = bytes(self._rx.payload[:-2]).decode("ascii", errors="replace")
+                    self._handle_command(text)
+                self._rx.clear()
+
+    # ---- main loop ---------------------------------------------
+
+    def _run(self):
+        self._rx = shproto.packet()
+
+        t_last_stat  = time.perf_counter()
+        t_last_frame = 0.0
+        t_last_count = t_last_stat
+        frac         = 0.0
+
+        while not self._stop.is_set():
+            now = time.perf_counter()
+
+            # counts accumulate in small steps so frames are never stale
+            if self.running:
+                want  = self.cps * (now - t_last_count) + frac
+                n     = int(want)
+                frac  = want - n
+                self._add_counts(n)
+            t_last_count = now
+
+            if now - t_last_stat >= self.stat_interval:
+                t_last_stat += self.stat_interval
+                if self.running:
+                    self.total_time += 1
+                self._send_stat()
+
+            period = (1.0 / self.frame_rate) if self.frame_rate > 0 else 0.0
+            if self.running and now - t_last_frame >= period:
+                t_last_frame = now
+                self._send_histogram_frame()
+                timeout = 0
+            else:
+                timeout = 0.01
+
+            self._poll_commands(timeout)
+
+
+# ------------------------------------------------------------
+# CLI
+# ------------------------------------------------------------
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="GS-MAX shproto emulator on a pseudo-terminal")
+    ap.add_argument("--cps",        type=float, default=1000.0, help="counts per second added while running")
+    ap.add_argument("--frame-rate", type=float, default=1.0,    help="full histogram frames per second (0 = unthrottled)")
+    ap.add_argument("--chunk",      type=int,   default=CHUNK_CHANNELS, help="channels per histogram packet")
+    ap.add_argument("--crc-errors", type=float, default=0.0,    help="probability of a bad CRC per packet")
+    ap.add_argument("--drop",       type=float, default=0.0,    help="probability of dropping a packet")
+    ap.add_argument("--shape",      default="peaks",            help="peaks, flat or path to an NPESv2 .json")
+    ap.add_argument("--sn",         default=DEFAULT_SN,         help="serial number reported by -inf")
+    ap.add_argument("--seed",       type=int,   default=None)
+    ap.add_argument("--autostart",  action="store_true",        help="start counting without waiting for -sta")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    shape = SHAPES[args.shape]() if args.shape in SHAPES else shape_from_json(args.shape)
+
+    emu = MaxEmulator(
+        cps=args.cps,
+        frame_rate=args.frame_rate,
+        chunk=args.chunk,
+        crc_error_rate=args.crc_errors,
+        drop_rate=args.drop,
+        shape=shape,
+        serial_number=args.sn,
+        seed=args.seed,
+    )
+    port = emu.start()
+    emu.running = args.autostart
+    print(port, flush=True)
+
+    try:
+        while True:
+            time.sleep(5)
+            logger.info(f"   📊 {emu.stats()}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emu.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
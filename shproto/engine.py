@@ -0,0 +1,1044 @@
+# shproto/engine.py
+#
+# MAX serial engine, one instance per GS-MAX.
+#
+# MaxEngine owns everything the serial loop touches for one device (port,
+# thread, raw histogram, STAT heartbeat, counters, calibration, link metrics,
+# pulse sink) and records 2D spectra (record_2d) or 3D waterfalls
+# (record_3d) from it.
+#
+# The single-device UI runs on shproto.dispatcher.engine, created with
+# publish=True: it connects to shared.device_port, publishes cps, text,
+# elapsed time and the live spectrum to shared, feeds the display pyramid and
+# uses the module-wide link metrics and pulse sink. shproto.dispatcher's old
+# module globals are aliases of its attributes.
+#
+# Further engines (detector arrays) live in the registry below, keyed by
+# serial number. They publish nothing to shared and save {filename}_{sn}.
+#
+# Don't open the same port from two engines.
+
+import os
+import re
+import time
+import platform
+import binascii
+import threading
+
+from array import array
+from struct import unpack
+from functools import partial
+from collections import deque
+from datetime import datetime
+
+import serial
+import shproto
+import shproto.port
+import shproto.metrics
+import shproto.pulses
+import shared
+import save
+import persistence
+import recovery
+import waterfall_store
+import pyramid
+
+from cps_history import CountHistory
+from shared import USER_DATA_DIR, logger
+
+MAX_BINS        = 8192
+READ_CHUNK      = 8192
+SAVE_EVERY_ROWS = 60         # STATs between checkpoints (about once a minute)
+_TIME_SCALE     = 1
+
+PACKET_NAMES = {
+    shproto.MODE_HISTOGRAM: "HISTOGRAM",
+    shproto.MODE_TEXT:      "TEXT",
+    shproto.MODE_STAT:      "STAT",
+    shproto.MODE_PULSE:     "PULSE",
+}
+
+
+class MaxEngine:
+
+    def __init__(self, sn=None, port_str=None, ring_len=3600, publish=False):
+        self.sn          = str(sn) if sn else ""
+        self.port_str    = port_str
+        self.key         = self.sn or str(port_str or "")
+        self.publish     = bool(publish)
+        self.max_bins    = MAX_BINS
+
+        # device state
+        self.histogram           = [0] * MAX_BINS
+        self.raw_hist            = array('I', [0]) * MAX_BINS
+        self.histogram_lock      = threading.Lock()
+        self.total_time          = 0
+        self.cpu_load            = 0
+        self.cps                 = 0
+        self.cps_lock            = threading.Lock()
+        self.cps_total_counts    = 0
+        self.lost_impulses       = 0
+        self.calibration         = [0., 1., 0., 0., 0.]
+        self.calibration_lock    = threading.Lock()
+        self.calibration_updated = 0
+        self.inf_str             = ""
+        self.last_text           = ""
+        self.serial_number       = ""
+        self.count_history       = CountHistory()
+
+        # packet counters
+        self.pkts01              = 0
+        self.pkts03              = 0
+        self.pkts04              = 0
+        self.total_pkts          = 0
+        self.dropped             = 0
+        self.dropped_by_cmd      = {}
+
+        # STAT heartbeat (1 Hz) and frame coverage
+        self.stat_tick              = threading.Event()
+        self.stat_version           = 0
+        self.stat_prev_tt           = None
+        self.hist_delta_since_stat  = 0
+        self.histogram_version      = 0
+        self.histogram_row_complete = threading.Event()
+        self.histogram_covered      = bytearray(MAX_BINS)
+        self.histogram_cov_count    = 0
+
+        # text commands
+        self.command_lock        = threading.Lock()
+        self._commands           = deque()
+        self.last_cmd_sent       = ""
+        self.expect_cal          = False
+
+        # loop and recording control
+        self.stopflag            = 0        # ends the serial loop
+        self.spec_stopflag       = 0        # ends the current recording
+        self.counts              = 0
+        self.last_counts         = 0
+        self.recording           = False
+        self._start_lock         = threading.Lock()
+        self._thread             = None
+        self._rec_thread         = None
+
+        # host elapsed timer
+        self._elapsed_lock       = threading.Lock()
+        self._elapsed_accum      = 0.0
+        self._elapsed_start_host = None
+        self._elapsed_running    = False
+        self._elapsed_last_push  = 0.0
+
+        # waterfall rows of engines that don't publish to shared
+        self.rows                = deque(maxlen=max(60, int(ring_len)))
+        self.rows_lock           = threading.Lock()
+
+        self.metrics = shproto.metrics.metrics if publish else shproto.metrics.ProtocolMetrics()
+        self.pulses  = shproto.pulses.sink     if publish else shproto.pulses.PulseSink()
+
+    # ---- lifecycle ---------------------------------------------
+
+    def start(self, sn=None):
+        """Run the serial loop in a thread (no-op while it is alive)."""
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self._thread
+            name = "DispatcherThread" if self.publish else f"MaxEngine-{self.key}"
+            self._thread = threading.Thread(target=self.run, kwargs={"sn": sn}, daemon=True, name=name)
+            self._thread.start()
+            return self._thread
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def close(self):
+        """End the recording and the serial loop."""
+        self.stop_recording()
+        self.stopflag = 1
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            self._thread = None
+
+    def send(self, cmd):
+        """Queue a text command (-sta, -sto, -rst, -inf, -cal ...)."""
+        self._commands.append(cmd)
+
+    def pending_command(self):
+        return self._commands[0] if self._commands else ""
+
+    def stop(self):
+        """Stop counting on the device and end the current recording."""
+        try:
+            if self.publish:
+                self.start()        # the shared engine reconnects to deliver -sto
+            self.send("-sto")
+        except Exception as e:
+            logger.error(f"  ❌ dispatcher.stop(): {e} ")
+        self.spec_stopflag = 1
+
+    def clear(self):
+        with self.histogram_lock:
+            self.stat_prev_tt          = None
+            self.hist_delta_since_stat = 0
+            self.histogram             = [0] * MAX_BINS
+            self.raw_hist              = array('I', [0]) * MAX_BINS
+            self.pkts01                = 0
+            self.pkts03                = 0
+            self.pkts04                = 0
+            self.total_pkts            = 0
+            self.cpu_load              = 0
+            self.total_time            = 0
+            self.lost_impulses         = 0
+            self.dropped               = 0
+            self.dropped_by_cmd.clear()
+            self.cps_total_counts      = 0
+        with self.cps_lock:
+            self.cps = 0
+        self.count_history.clear()
+        with self.rows_lock:
+            self.rows.clear()
+
+        if self.publish:
+            with shared.write_lock:
+                shared.cps       = 0
+                shared.histogram = [0] * MAX_BINS
+                shared.count_history.clear()
+
+    def snapshot(self):
+        """(histogram copy, device seconds) taken under the instance lock."""
+        with self.histogram_lock:
+            return list(self.histogram), self.total_time
+
+    # ---- host elapsed timer ------------------------------------
+
+    def _elapsed_now(self):
+        with self._elapsed_lock:
+            total = self._elapsed_accum
+            if self._elapsed_running and self._elapsed_start_host is not None:
+                total += time.perf_counter() - self._elapsed_start_host
+            return total
+
+    def _elapsed_push_if_needed(self, period=0.25):
+        """Publish shared.elapsed as an integer, throttled."""
+        now = time.perf_counter()
+        if now - self._elapsed_last_push >= period:
+            if self.publish and shared.run_flag.is_set():
+                val = int(self._elapsed_now())
+                with shared.write_lock:
+                    shared.elapsed = val
+            self._elapsed_last_push = now
+
+    def _elapsed_start(self):
+        with self._elapsed_lock:
+            if not self._elapsed_running:
+                self._elapsed_start_host = time.perf_counter()
+                self._elapsed_running    = True
+
+    def _elapsed_stop(self):
+        with self._elapsed_lock:
+            if self._elapsed_running and self._elapsed_start_host is not None:
+                self._elapsed_accum += time.perf_counter() - self._elapsed_start_host
+            self._elapsed_start_host = None
+            self._elapsed_running    = False
+
+    def _elapsed_reset(self):
+        with self._elapsed_lock:
+            self._elapsed_accum = 0.0
+            if self._elapsed_running:
+                self._elapsed_start_host = time.perf_counter()
+        if self.publish:
+            with shared.write_lock:
+                shared.elapsed = 0
+
+    # ---- serial loop -------------------------------------------
+
+    def run(self, sn=None):
+        """Serial loop (blocking); returns when stopflag is set or the port fails."""
+        logger.info(f"   🚀 Dispatcher started {self.key}")
+        self.stopflag = 0
+
+        port_str = getattr(shared, "device_port", None) if self.publish else self.port_str
+        nano     = shproto.port.connectdevice(sn=sn or self.sn or None, port_str=port_str)
+        if not nano:
+            logger.error(f"[ERROR] ❌ Failed to connect to MAX {self.key}")
+            return
+
+        nano.timeout = 0.1
+        if platform.system() == "Windows":
+            try:
+                nano.set_buffer_size(rx_size=131072, tx_size=16384)
+                logger.info("   ✅ Windows serial buffers enlarged")
+            except Exception as e:
+                logger.warning("👆 Could not enlarge Windows serial buffers: %s", e)
+
+        nano.flushInput()
+        nano.flushOutput()
+        logger.info(f"   ✅ MAX connected successfully {self.key}")
+
+        link = self.metrics
+        link.reset()
+
+        # Pulses go to a buffered binary log; CSV only via export_pulse_csv()
+        suffix = "" if self.publish else f"_{self.key}"
+        self.pulses.configure(os.path.join(USER_DATA_DIR, f"_max-pulse-shape{suffix}.bin"))
+
+        response   = shproto.packet()
+        last_mark  = time.perf_counter()
+
+        while not self.stopflag:
+            self._elapsed_push_if_needed(period=0.95)
+            self._flush_commands(nano)
+
+            gap = time.perf_counter() - last_mark
+            if gap > 1.0:
+                logger.warning(" ⚠️ LOOP STALL before read(): %.2fs elapsed since previous iteration", gap)
+            link.record_loop_gap(gap)
+
+            t0 = time.perf_counter()
+            try:
+                waiting = nano.in_waiting
+                if waiting > 32768:
+                    logger.warning("⚠️ SERIAL BACKLOG: %d bytes waiting in receive buffer", waiting)
+                rx = nano.read(min(waiting, READ_CHUNK)) if waiting > 0 else nano.read(1)
+            except serial.SerialException as e:
+                logger.warning("👆 Serial read failed, likely disconnected or busy: %s", e)
+                break
+
+            read_s = time.perf_counter() - t0
+            link.record_read(read_s)
+            if read_s > 1.0:
+                logger.warning(" ⚠️ READ() BLOCKED: nano.read() took %.2fs (nano.timeout=%.2f) bytes_returned=%d",
+                               read_s, nano.timeout, len(rx) if rx else 0)
+            last_mark = time.perf_counter()
+
+            if not rx:
+                continue  # normal timeout / no bytes yet
+            link.record_bytes(len(rx), waiting)
+
+            for b in rx:
+                response.read(b)
+
+                if response.dropped:
+                    cmd = response.cmd
+                    self.dropped    += 1
+                    self.total_pkts += 1
+                    link.record_crc_failure(cmd)
+                    self.dropped_by_cmd[cmd] = self.dropped_by_cmd.get(cmd, 0) + 1
+                    logger.warning("⚠️ CRC failure: type=%s cmd=0x%02X dropped_for_cmd=%d dropped_total=%d",
+                                   PACKET_NAMES.get(cmd, f"UNKNOWN_0x{cmd:02X}"), cmd,
+                                   self.dropped_by_cmd[cmd], self.dropped)
+                    response.clear()
+                    continue
+
+                if not response.ready:
+                    continue
+
+                self.total_pkts += 1
+                link.record_packet(response.cmd)
+                try:
+                    if response.cmd == shproto.MODE_TEXT:
+                        self.pkts03 += 1
+                        self._handle_text(bytes(response.payload).decode("ascii", errors="replace"))
+                    elif response.cmd == shproto.MODE_HISTOGRAM:
+                        self.pkts01 += 1
+                        self._handle_histogram(response.payload)
+                    elif response.cmd == shproto.MODE_PULSE:
+                        self.pulses.push(response.payload)
+                    elif response.cmd == shproto.MODE_STAT:
+                        self.pkts04 += 1
+                        self._handle_stat(response.payload)
+                except Exception as e:
+                    logger.warning(f"👆 packet 0x{response.cmd:02X} error: {e}")
+                response.clear()
+
+        self.pulses.close()
+        nano.close()
+        logger.info(f"   ✅ MAX {self.key} closed")
+
+    def _flush_commands(self, nano):
+        while self._commands:
+            with self.command_lock:
+                if not self._commands:
+                    return
+                cmd = self._commands.popleft()
+            logger.info(f"   ✅ Dispatched command: {cmd!r} ")
+
+            # Local host timers (the device gets the command too)
+            if cmd == "-sta":
+                self._elapsed_start()
+            elif cmd == "-sto":
+                self._elapsed_stop()
+            elif cmd == "-rst":
+                self._elapsed_reset()
+                self.clear()
+
+            # send the command exactly as given (no CR/LF, no lowercasing)
+            tx = shproto.packet()
+            tx.cmd = shproto.MODE_TEXT
+            tx.start()
+            for b in cmd.encode("ascii", "strict"):
+                tx.add(b)
+            tx.stop()
+
+            self.last_cmd_sent = cmd
+            self.expect_cal    = (cmd.strip().lower() == "-cal")
+            try:
+                nano.write(tx.payload)
+                logger.info(f"   ✅ Sent command: {cmd!r}")
+                logger.debug("  🐞 TX payload (hex): " + binascii.hexlify(tx.payload[:64]).decode())
+            except Exception as e:
+                logger.error(f"❌ Failed to write command {cmd!r}: {e}")
+
+    def _handle_text(self, resp_text):
+        # Preserve line structure; trim only a trailing empty line
+        lines = resp_text.splitlines()
+        if lines and lines[-1] == "":
+            lines = lines[:-1]
+
+        self.last_text = resp_text
+        if self.publish:
+            first_non_empty = next((ln for ln in lines if ln.strip()), "")
+            with shared.write_lock:
+                shared.last_text         = resp_text
+                shared.max_serial_output = first_non_empty
+
+        if any(ln.strip().lower() == "ok" for ln in lines):
+            logger.info("   ✅ ok ")
+
+        # CRC + calibration load
+        if len(lines) >= 11:
+            crc_calc = binascii.crc32("".join(lines[0:10]).encode("ascii")) & 0xFFFFFFFF
+            crc_str  = lines[10].strip()
+            if crc_str.upper() in ("FFFFFFFF", "00000000"):
+                logger.info("   ✅ Device reports no CAL CRC (got %r); skipping compare (after cmd=%r)",
+                            crc_str, self.last_cmd_sent)
+            else:
+                try:
+                    crc_dev = int(crc_str, 16)
+                except ValueError:
+                    logger.info("👆 CAL: no CRC provided by device (sentinel %s) — skipping validation (cmd=%r)",
+                                crc_str, self.last_cmd_sent)
+                else:
+                    if crc_calc == crc_dev:
+                        with self.calibration_lock:
+                            for i in range(5):
+                                self.calibration[i] = unpack(
+                                    'd', int(lines[2 * i] + lines[2 * i + 1], 16).to_bytes(8, 'little'))[0]
+                            self.calibration_updated = 1
+                        logger.info(f"   ✅ Got calibration: {self.calibration} ")
+                    else:
+                        logger.error("  ❌ Wrong crc for calibration values got: %08x expected: %08x (after cmd=%r)",
+                                     crc_dev, crc_calc, self.last_cmd_sent)
+
+        if re.search(r'^VERSION', resp_text):
+            self.inf_str = resp_text
+            logger.info("   ✅ Got MAX settings ")
+
+        # Serial number: line 40 if present, else the last all-digit line
+        sn = None
+        if len(lines) >= 40 and re.fullmatch(r"\d{6,12}", lines[39].strip()):
+            sn = lines[39].strip()
+        if sn is None:
+            for ln in reversed(lines):
+                tok = ln.strip()
+                if re.fullmatch(r"\d{6,12}", tok):
+                    sn = tok
+                    break
+        if sn:
+            self.serial_number = sn
+            if self.publish:
+                with shared.write_lock:
+                    shared.serial_number = sn
+            logger.info(f"   ✅ Found MAX serial # {sn} ")
+
+    def _handle_histogram(self, pl):
+        if len(pl) < 2:
+            return
+        offset = (pl[0] & 0xFF) | ((pl[1] & 0xFF) << 8)
+        data   = pl[2:]
+        count  = len(data) // 4
+
+        # start-of-frame heuristic
+        if offset == 0:
+            self.histogram_cov_count = 0
+            self.histogram_covered[:] = b"\x00" * MAX_BINS
+
+        covered = self.histogram_covered
+        with self.histogram_lock:
+            rhist = self.raw_hist
+            hlist = self.histogram
+            for i in range(count):
+                idx = offset + i
+                if idx >= MAX_BINS:
+                    break
+                if not covered[idx]:
+                    covered[idx] = 1
+                    self.histogram_cov_count += 1
+                base = i * 4
+                new_val = (data[base] | (data[base + 1] << 8) |
+                           (data[base + 2] << 16) | (data[base + 3] << 24)) & 0x7FFFFFFF
+                old_val = rhist[idx]
+                if new_val != old_val:
+                    delta = max(0, int(new_val) - int(old_val))
+                    rhist[idx] = new_val
+                    hlist[idx] = new_val
+                    self.cps_total_counts      += delta
+                    self.hist_delta_since_stat += delta
+
+        # frame complete only when every bin was covered
+        if self.histogram_cov_count >= MAX_BINS:
+            self.histogram_version += 1
+            self.histogram_row_complete.set()
+
+    def _handle_stat(self, payload):
+        if len(payload) < 6:
+            return
+        total_time_raw = ((payload[0] & 0xFF) | ((payload[1] & 0xFF) << 8) |
+                          ((payload[2] & 0xFF) << 16) | ((payload[3] & 0xFF) << 24))
+        self.total_time = total_time_raw
+        self.cpu_load   = (payload[4] & 0xFF) | ((payload[5] & 0xFF) << 8)
+
+        curr_tt = total_time_raw * _TIME_SCALE
+        prev_tt = self.stat_prev_tt
+
+        if prev_tt is None:
+            # first STAT: baseline only
+            self.stat_prev_tt          = curr_tt
+            self.hist_delta_since_stat = 0
+        else:
+            # CPS = new counts since the last STAT / device seconds elapsed
+            dt = curr_tt - prev_tt
+            if dt <= 0 or dt > 2.0:
+                logger.warning("STAT anomaly: raw=%d curr=%.3f prev=%.3f dt=%.3f delta=%d",
+                               total_time_raw, curr_tt, prev_tt, dt, self.hist_delta_since_stat)
+            if dt <= 0:
+                dt = 1.0
+            cps_int = int(round(self.hist_delta_since_stat / dt))
+
+            self.metrics.record_coverage(self.histogram_cov_count, MAX_BINS)
+            if self.histogram_cov_count < MAX_BINS:
+                logger.warning(" ⚠️ INCOMPLETE FRAME at STAT: covered=%d/8192 delta=%d dt=%.3f cps=%d dropped_total=%d",
+                               self.histogram_cov_count, self.hist_delta_since_stat, dt, cps_int, self.dropped)
+
+            with self.cps_lock:
+                self.cps = cps_int
+            if self.publish:
+                with shared.write_lock:
+                    shared.cps = cps_int
+                    shared.count_history.append(cps_int)
+            else:
+                self.count_history.append(cps_int)
+
+            self.stat_prev_tt          = curr_tt
+            self.hist_delta_since_stat = 0
+
+        # heartbeat for the recorders (once per STAT)
+        self.stat_version += 1
+        self.stat_tick.set()
+
+    # ---- recording ---------------------------------------------
+
+    def _file_name(self, filename):
+        """Recordings of registry engines carry the serial number."""
+        if self.publish:
+            return filename
+        tag = self.serial_number or re.sub(r"[^\w.-]+", "_", self.key).strip("_")
+        return f"{filename}_{tag}"
+
+    def _device_name(self, device):
+        return device if self.publish else f"{device}{self.serial_number}"
+
+    def _next_stat(self, t_interval):
+        """Wait for a STAT; returns the STAT version, or None on timeout."""
+        if not self.stat_tick.wait(timeout=max(2.0, t_interval + 0.5)):
+            return None
+        v = self.stat_version
+        self.stat_tick.clear()
+        return v
+
+    def _save_2d(self, name, device, histogram, counts, elapsed, coeffs, spec_notes, dt_start, dt_now, wait=False):
+        """coeffs in NPES order [c3, c2, c1]."""
+        save.save_histogram_json(
+            filename=name,
+            device=self._device_name(device),
+            histogram=histogram,
+            counts=counts,
+            dropped_counts=0 if self.publish else self.dropped,
+            elapsed=elapsed,
+            coeff_1=coeffs[0],
+            coeff_2=coeffs[1],
+            coeff_3=coeffs[2],
+            spec_notes=spec_notes,
+            dt_start=dt_start,
+            dt_now=dt_now,
+            from_shared=self.publish,
+            wait=wait,
+        )
+        if self.publish:
+            save.save_count_history_csv(name)
+
+    def _open_link_log(self, name, resumed=False):
+        """Log the per-second link metrics of this run to {name}_link.csv as it goes."""
+        self.metrics.open_log(os.path.join(USER_DATA_DIR, f"{name}_link.csv"), append=resumed)
+
+    def _flush_link_log(self, name):
+        persistence.service.submit(f"{name}_link.csv", self.metrics.flush_log)
+
+    def _resume_failed(self, name):
+        """Resume was asked for but the checkpoint is unusable: do not record over it."""
+        logger.error(f"  ❌ Resume of {name} failed, recording not started (files left as they were)")
+        self.send("-sto")
+        if self.publish:
+            with shared.write_lock:
+                shared.run_flag.clear()
+
+    def record_2d(self, filename, compression, device, t_interval, coeffs=None,
+                  max_counts=None, max_seconds=None):
+        """
+        2D spectrum driven by the device STAT (blocking). The shared engine
+        takes compression, limits and calibration from shared; other engines
+        use the arguments (coeffs in NPES order [c3, c2, c1]).
+        """
+        name = self._file_name(filename)
+        logger.info(f'   ✅ process_01({name}) ')
+
+        self.counts      = 0
+        self.last_counts = 0
+        elapsed          = 0
+        tt               = 0       # device seconds; 0 until a STAT arrives
+        spec_notes       = ""
+
+        et_start = time.time()
+        dt_start = datetime.fromtimestamp(et_start)
+
+        if self.publish:
+            with shared.write_lock:
+                compression = shared.compression
+                max_counts  = shared.max_counts
+                max_seconds = shared.max_seconds
+        else:
+            max_counts  = max_counts or float("inf")
+            max_seconds = max_seconds or float("inf")
+        compression     = max(1, int(compression))
+        compressed_bins = MAX_BINS // compression
+
+        hst                  = [0] * MAX_BINS
+        compressed_histogram = [0] * compressed_bins
+
+        # Resumed run: the device was reset on start, so its histogram and
+        # time are added on top of the last checkpoint
+        base_histogram = [0] * compressed_bins
+        base_elapsed   = 0
+        resumed = recovery.take(name, 2)
+        if resumed:
+            state = recovery.load_spectrum(name, compressed_bins)
+            if state is None:
+                self._resume_failed(name)
+                return
+            base_histogram = state["histogram"]
+            base_elapsed   = state["elapsed"]
+            dt_start       = state["dt_start"]
+        recovery.begin(name, 2, device, resumed=resumed)
+        self._open_link_log(name, resumed)
+
+        if self.publish:
+            # full device resolution for the display pyramid; a resumed run
+            # only has its checkpoint at the recorded compression
+            pyramid_base = compression if resumed else 1
+            pyramid.primary.reset(base_histogram if resumed else hst, pyramid_base, source=compression)
+
+        def _coeffs():
+            if not self.publish:
+                return list(coeffs or [0, 1, 0])
+            with shared.write_lock:
+                c1, c2, c3 = pyramid.scale_coeffs(
+                    [shared.coeff_1, shared.coeff_2, shared.coeff_3], shared.compression, compression)
+            return [c3, c2, c1]
+
+        def _submit(final=False):
+            dt_now = datetime.fromtimestamp(time.time())
+            if self.publish:
+                with shared.write_lock:
+                    notes = shared.spec_notes
+            else:
+                notes = spec_notes
+            # handed to the save service; the data thread never waits on disk
+            persistence.service.submit(f"{name}.json", partial(
+                self._save_2d,
+                name=name,
+                device=device,
+                histogram=compressed_histogram,
+                counts=self.counts,
+                elapsed=base_elapsed + int(tt),
+                coeffs=_coeffs(),
+                spec_notes=notes,
+                dt_start=dt_start,
+                dt_now=dt_now,
+            ), priority=final)
+            if not final:
+                self._flush_link_log(name)
+
+        last_stat_version = -1
+        stats_since_save  = 0
+        timeout_logged    = False
+
+        self.recording = True
+        while True:
+            if self.spec_stopflag or self.stopflag:
+                logger.info("   ✅ process_01: stop signal ")
+                break
+            if self.counts >= max_counts or elapsed > max_seconds:
+                logger.info("   ✅ process_01: stop condition (counts or time)")
+                break
+
+            v = self._next_stat(t_interval)
+            if v is None:
+                if not timeout_logged:
+                    logger.warning("👆 process_01 STAT timeout: stat_version=%d last_stat_version=%d "
+                                   "device_time=%s accumulated_delta=%d dispatcher_alive=%s",
+                                   self.stat_version, last_stat_version, self.total_time,
+                                   self.hist_delta_since_stat, self.is_alive())
+                    timeout_logged = True
+                continue
+            timeout_logged = False
+            if v == last_stat_version:
+                continue
+            last_stat_version = v
+
+            # atomic snapshot after STAT
+            with self.histogram_lock:
+                hst = self.histogram.copy()
+                tt  = self.total_time
+
+            compressed_histogram = [b + sum(hst[i:i + compression])
+                                    for b, i in zip(base_histogram, range(0, MAX_BINS, compression))]
+            self.counts = sum(compressed_histogram)
+
+            if self.publish:
+                pyramid.primary.update(compressed_histogram if resumed else hst)
+                with shared.write_lock:
+                    shared.counts    = self.counts
+                    shared.histogram = pyramid.primary.level(shared.compression) or compressed_histogram
+                    shared.elapsed   = base_elapsed + int(tt)
+
+            stats_since_save += 1
+            self.last_counts  = self.counts
+            elapsed           = base_elapsed + int(time.time() - et_start)   # host elapsed
+
+            if stats_since_save >= SAVE_EVERY_ROWS:
+                _submit()
+                stats_since_save = 0
+
+        # final save on exit
+        compressed_histogram = [b + sum(hst[i:i + compression])
+                                for b, i in zip(base_histogram, range(0, MAX_BINS, compression))]
+        self.counts = sum(compressed_histogram)
+        _submit(final=True)
+        persistence.service.flush()
+        recovery.finish(name, 2)
+        self.metrics.close_log()
+
+        # send -sto and clear run flag
+        self.stop()
+        self.recording = False
+        if self.publish:
+            with shared.write_lock:
+                shared.run_flag.clear()
+        logger.info(f"   ✅ process_01 saved {name}")
+
+    def record_3d(self, filename, compression3d, device, t_interval, coeffs=None,
+                  max_counts=None, max_seconds=None):
+        """
+        3D waterfall, one delta row per STAT (blocking). Rows go to the
+        append-only store and to shared.histogram_hmp (shared engine) or
+        self.rows.
+        """
+        name = self._file_name(filename)
+        logger.info(f'   ✅ process_02({name}) ')
+
+        et_start         = time.time()
+        self.counts      = 0
+        self.last_counts = 0
+        compression3d    = max(1, int(compression3d))
+        last_hst         = [0] * (MAX_BINS // compression3d)
+
+        if self.publish:
+            with shared.write_lock:
+                shared.run_flag.set()
+                t_interval  = int(shared.t_interval)
+                max_counts  = int(shared.max_counts)
+                max_seconds = int(shared.max_seconds)
+                coeffs      = [shared.coeff_3, shared.coeff_2, shared.coeff_1]   # NPES order
+                ring_len    = max(60, getattr(shared, "ring_len_hmp", 3600))
+                if not isinstance(getattr(shared, "histogram_hmp", None), deque):
+                    shared.histogram_hmp = deque(maxlen=ring_len)
+                else:
+                    shared.histogram_hmp.clear()
+                if not isinstance(getattr(shared, "gps_hmp", None), deque):
+                    shared.gps_hmp = deque(maxlen=ring_len)
+        else:
+            t_interval  = max(1, int(t_interval))
+            max_counts  = max_counts or float("inf")
+            max_seconds = max_seconds or float("inf")
+            coeffs      = list(coeffs or [0, 1, 0])
+            with self.rows_lock:
+                self.rows.clear()
+
+        dt_start          = datetime.fromtimestamp(et_start)
+        last_stat_version = -1
+        rows_since_save   = 0
+
+        # append-only: each checkpoint writes only the rows since the last one;
+        # a resumed run appends after the last checkpoint of the interrupted one
+        store, ck = None, {}
+        resumed   = recovery.take(name, 3)
+        if resumed:
+            store, ck = recovery.reopen_store(name, MAX_BINS // compression3d)
+            if store is None:
+                self._resume_failed(name)
+                return
+        base_counts  = int(ck.get("validPulseCount", 0) or 0)
+        base_elapsed = int(ck.get("measurementTime", 0) or 0)
+        if not resumed:
+            store = waterfall_store.WaterfallStore(
+                name, device=device, coeffs=coeffs, dt_start=dt_start, t_interval=t_interval,
+                sn=None if self.publish else self.serial_number,
+            )
+        recovery.begin(name, 3, device, resumed=resumed)
+        self._open_link_log(name, resumed)
+
+        def _save_checkpoint(final=False):
+            # cut the buffered rows with the counts that go with them here;
+            # the save service only writes the snapshot
+            dt_now  = datetime.fromtimestamp(time.time())
+            elapsed = base_elapsed + int(self.total_time * _TIME_SCALE)
+            store.cut(counts=self.counts, elapsed=elapsed, dt_now=dt_now)
+            persistence.service.submit(
+                f"{store.filename}_hmp.jsonl",
+                store.close if final else store.flush,
+                priority=final,
+            )
+            if final:
+                persistence.service.flush()
+            else:
+                self._flush_link_log(name)
+
+        self.recording = True
+        try:
+            while True:
+                if self.spec_stopflag or self.stopflag:
+                    logger.info("   ✅ process_02 received stop signal ")
+                    break
+
+                v = self._next_stat(t_interval)
+                if v is None:
+                    logger.warning("👆 process_02: STAT wait timeout")
+                    continue
+                if v == last_stat_version:
+                    continue
+                last_stat_version = v
+
+                # 1) snapshot device state
+                with self.histogram_lock:
+                    hst = self.histogram.copy()
+                    tt  = self.total_time
+
+                # 2) compress and compute the delta row
+                compressed_histogram = [sum(hst[i:i + compression3d]) for i in range(0, MAX_BINS, compression3d)]
+                self.counts = base_counts + sum(compressed_histogram)
+                this_hst = waterfall_store.SparseRow.from_dense(
+                    [a - b for a, b in zip(compressed_histogram, last_hst)]
+                )
+                last_hst = compressed_histogram
+
+                # 3) stop conditions
+                if self.counts >= max_counts or base_elapsed + tt >= max_seconds:
+                    self._elapsed_stop()
+                    if self.publish:
+                        self.stopflag = True
+                    logger.info("   ✅ Stop condition met (counts or time) ")
+                    break
+
+                # 4) publish the row with its GPS fix
+                rows_since_save += 1
+                with shared.write_lock:
+                    fix = getattr(shared, "last_gps_fix", None)
+                    ok  = isinstance(fix, dict) and fix.get("fix") and \
+                          fix.get("lat") is not None and fix.get("lon") is not None
+                    row = {"lat": fix.get("lat") if ok else None,
+                           "lon": fix.get("lon") if ok else None,
+                           "t":   base_elapsed + int(tt)}
+                    if self.publish:
+                        shared.counts  = self.counts
+                        shared.elapsed = base_elapsed + int(tt)
+                        shared.histogram_hmp.append(this_hst)
+                        shared.gps_hmp.append(row)
+                if not self.publish:
+                    with self.rows_lock:
+                        self.rows.append(this_hst)
+
+                store.append(this_hst, row)
+
+                # 5) periodic checkpoint
+                if rows_since_save >= SAVE_EVERY_ROWS:
+                    _save_checkpoint()
+                    rows_since_save = 0
+
+                self.last_counts = self.counts
+
+        except Exception as e:
+            logger.error(f"❌ process_02 crashed: {e}", exc_info=True)
+        finally:
+            if self.publish:
+                with shared.write_lock:
+                    shared.run_flag.clear()
+            else:
+                self.send("-sto")
+            # reset the flags so the next run starts clean
+            self.spec_stopflag = False
+            self.stopflag      = False
+            # final save + NPESv2 export
+            _save_checkpoint(final=True)
+            recovery.finish(name, 3)
+            self.metrics.close_log()
+            self.recording = False
+            logger.info(f"   ✅ process_02 stopped ({name})")
+
+    def record(self, filename, compression=8, t_interval=1, mode=2, device="MAX",
+               coeffs=None, max_counts=None, max_seconds=None):
+        """
+        Start a recording in a thread: mode 2 -> {filename}_{sn}.json,
+        mode 3 -> {filename}_{sn}_hmp.json for registry engines.
+        """
+        if self._rec_thread is not None and self._rec_thread.is_alive():
+            logger.warning(f"👆 MaxEngine {self.key} already recording")
+            return self._rec_thread
+
+        self.spec_stopflag = 0
+        self.start()
+        self.send("-rst")
+        self.send("-sta")
+
+        target = self.record_3d if mode == 3 else self.record_2d
+        self._rec_thread = threading.Thread(
+            target=target,
+            args=(filename, compression, device, t_interval),
+            kwargs={"coeffs": coeffs, "max_counts": max_counts, "max_seconds": max_seconds},
+            daemon=True,
+            name=f"MaxRecord-{self.key}",
+        )
+        self._rec_thread.start()
+        return self._rec_thread
+
+    def stop_recording(self):
+        self.spec_stopflag = 1
+        if self._rec_thread is not None:
+            self._rec_thread.join(timeout=5.0)
+            self._rec_thread = None
+
+
+# ============================================================
+# Registry keyed by serial number
+# ============================================================
+_engines       = {}
+_registry_lock = threading.Lock()
+
+
+def connect(sn=None, port_str=None, ring_len=3600):
+    """Return the running engine for sn/port_str, creating and starting it if needed."""
+    key = str(sn) if sn else str(port_str or "")
+    if not key:
+        raise ValueError("connect() needs a serial number or a port")
+    with _registry_lock:
+        eng = _engines.get(key)
+        if eng is None:
+            eng = MaxEngine(sn=sn, port_str=port_str, ring_len=ring_len)
+            _engines[key] = eng
+    eng.start()
+    return eng
+
+
+def connect_all():
+    """Start an engine for every FTDI port that reports a serial number."""
+    found = []
+    for p in shproto.port.getallports(ftdi_only=True):
+        sn = (getattr(p, "serial_number", "") or "").strip()
+        if sn:
+            found.append(connect(sn=sn, port_str=p.device))
+    return found
+
+
+def get(key):
+    with _registry_lock:
+        return _engines.get(str(key))
+
+
+def engines():
+    with _registry_lock:
+        return dict(_engines)
+
+
+def disconnect(key):
+    with _registry_lock:
+        eng = _engines.pop(str(key), None)
+    if eng is not None:
+        eng.close()
+
+
+def disconnect_all():
+    for key in list(engines()):
+        disconnect(key)
+
+
+def send_all(cmd):
+    for eng in engines().values():
+        eng.send(cmd)
+
+
+# ---- combined view ------------------------------------------
+
+def combined_histogram(compression=1):
+    """Channel-wise sum of every engine's histogram, compressed like record_2d."""
+    total = [0] * MAX_BINS
+    for eng in engines().values():
+        hst, _ = eng.snapshot()
+        total = [a + b for a, b in zip(total, hst)]
+    if compression > 1:
+        total = [sum(total[i:i + compression]) for i in range(0, MAX_BINS, compression)]
+    return total
+
+
+def combined_rows(n=60):
+    """Sum of the last n waterfall rows across engines (aligned from the newest row)."""
+    per = []
+    for eng in engines().values():
+        with eng.rows_lock:
+            per.append([r.dense() for r in list(eng.rows)[-n:]])
+    per = [r for r in per if r]
+    if not per:
+        return []
+    depth = min(len(r) for r in per)
+    out = []
+    for k in range(-depth, 0):
+        row = list(per[0][k])
+        for other in per[1:]:
+            row = [a + b for a, b in zip(row, other[k])]
+        out.append(row)
+    return out
+
+
+def combined_cps():
+    return sum(eng.cps for eng in engines().values())
+
+
+def status():
+    """Small per-engine dict for the UI."""
+    out = {}
+    for key, eng in engines().items():
+        out[key] = {
+            "sn":         eng.serial_number or eng.sn,
+            "alive":      eng.is_alive(),
+            "recording":  eng.recording,
+            "cps":        eng.cps,
+            "total_time": eng.total_time,
+            "dropped":    eng.dropped,
+        }
+    return out
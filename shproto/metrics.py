@@ -0,0 +1,265 @@
+# shproto/metrics.py
+#
+# Link health metrics for the MAX dispatcher.
+#
+# The dispatcher records into `metrics` (one lock, a few integer adds per
+# call). Once per wall-clock second the running totals are closed into a
+# bucket and kept in a bounded history, so tabs can poll snapshot() every
+# second without touching the serial loop.
+#
+# For post-mortem of long recordings the recorder opens a CSV log with
+# open_log(): every closed bucket is queued for it and flush_log() appends
+# the queued rows (called on the recorder's save cadence, and by close_log()
+# at the end), so the file holds the whole run however long it gets.
+# export_csv() still writes the in-memory history in one go.
+
+import os
+import csv
+import time
+import logging
+import threading
+
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Upper edges in milliseconds, last bucket is open ended
+LATENCY_EDGES_MS = (0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+PACKET_TYPES = {
+    0x01: "histogram",
+    0x02: "pulse",
+    0x03: "text",
+    0x04: "stat",
+}
+
+CSV_FIELDS = (
+    "t", "bytes", "histogram", "pulse", "text", "stat", "other",
+    "crc_fail", "max_gap_ms", "max_read_ms", "backlog_peak", "coverage",
+)
+
+
+def _bucket_index(ms):
+    for i, edge in enumerate(LATENCY_EDGES_MS):
+        if ms <= edge:
+            return i
+    return len(LATENCY_EDGES_MS)
+
+
+def _new_bucket(t):
+    return {
+        "t":            t,
+        "bytes":        0,
+        "histogram":    0,
+        "pulse":        0,
+        "text":         0,
+        "stat":         0,
+        "other":        0,
+        "crc_fail":     0,
+        "max_gap_ms":   0.0,
+        "max_read_ms":  0.0,
+        "backlog_peak": 0,
+        "coverage":     None,
+    }
+
+
+class ProtocolMetrics:
+
+    def __init__(self, history_seconds=3600):
+        self._lock    = threading.Lock()
+        self._history = deque(maxlen=int(history_seconds))
+        self._log_path = None
+        self._log_rows = []          # closed buckets not yet appended to the log
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._history.clear()
+            self._log_rows.clear()
+            self._cur          = _new_bucket(int(time.time()))
+            self.gap_hist      = [0] * (len(LATENCY_EDGES_MS) + 1)
+            self.read_hist     = [0] * (len(LATENCY_EDGES_MS) + 1)
+            self.total_bytes   = 0
+            self.total_packets = 0
+            self.total_crc     = 0
+            self.backlog_peak  = 0
+            self.coverage      = None
+            self.started       = time.time()
+
+    # ---- recording (dispatcher thread) -------------------------
+
+    def _roll(self, now):
+        """Close finished seconds. Caller holds the lock."""
+        sec = int(now)
+        cur = self._cur
+        if sec <= cur["t"]:
+            return cur
+        closed = [cur]
+        # seconds with no traffic at all still appear in the series
+        for t in range(cur["t"] + 1, min(sec, cur["t"] + 60)):
+            closed.append(_new_bucket(t))
+        self._history.extend(closed)
+        if self._log_path is not None:
+            self._log_rows.extend(closed)
+        self._cur = _new_bucket(sec)
+        return self._cur
+
+    def record_bytes(self, n, waiting=0):
+        now = time.time()
+        with self._lock:
+            cur = self._roll(now)
+            cur["bytes"]     += n
+            self.total_bytes += n
+            if waiting > cur["backlog_peak"]:
+                cur["backlog_peak"] = waiting
+            if waiting > self.backlog_peak:
+                self.backlog_peak = waiting
+
+    def record_packet(self, cmd):
+        now = time.time()
+        with self._lock:
+            cur = self._roll(now)
+            cur[PACKET_TYPES.get(cmd, "other")] += 1
+            self.total_packets += 1
+
+    def record_crc_failure(self, cmd=None):
+        now = time.time()
+        with self._lock:
+            cur = self._roll(now)
+            cur["crc_fail"] += 1
+            self.total_crc  += 1
+
+    def record_loop_gap(self, seconds):
+        ms = seconds * 1000.0
+        with self._lock:
+            cur = self._roll(time.time())
+            self.gap_hist[_bucket_index(ms)] += 1
+            if ms > cur["max_gap_ms"]:
+                cur["max_gap_ms"] = ms
+
+    def record_read(self, seconds):
+        ms = seconds * 1000.0
+        with self._lock:
+            cur = self._roll(time.time())
+            self.read_hist[_bucket_index(ms)] += 1
+            if ms > cur["max_read_ms"]:
+                cur["max_read_ms"] = ms
+
+    def record_coverage(self, covered, total=8192):
+        ratio = (covered / total) if total else 0.0
+        with self._lock:
+            cur = self._roll(time.time())
+            cur["coverage"] = ratio
+            self.coverage   = ratio
+
+    # ---- polling (UI thread) -----------------------------------
+
+    def rates(self, window=10):
+        """Average per-second rates over the last `window` closed seconds."""
+        with self._lock:
+            self._roll(time.time())
+            rows = list(self._history)[-int(window):] if window else []
+        n = len(rows) or 1
+        out = {}
+        for key in ("bytes", "histogram", "pulse", "text", "stat", "other", "crc_fail"):
+            out[key] = sum(r[key] for r in rows) / n
+        return out
+
+    def snapshot(self, window=10):
+        """Cheap dict for the UI: rolling rates plus lifetime totals and histograms."""
+        rates = self.rates(window)
+        with self._lock:
+            return {
+                "bytes_per_s":       rates["bytes"],
+                "frames_per_s":      {k: rates[k] for k in ("histogram", "pulse", "text", "stat", "other")},
+                "crc_fail_per_s":    rates["crc_fail"],
+                "total_bytes":       self.total_bytes,
+                "total_packets":     self.total_packets,
+                "total_crc":         self.total_crc,
+                "backlog_peak":      self.backlog_peak,
+                "coverage":          self.coverage,
+                "gap_hist":          list(self.gap_hist),
+                "read_hist":         list(self.read_hist),
+                "latency_edges_ms":  LATENCY_EDGES_MS,
+                "uptime_s":          time.time() - self.started,
+            }
+
+    def history(self):
+        with self._lock:
+            self._roll(time.time())
+            return [dict(r) for r in self._history]
+
+    @staticmethod
+    def _write_rows(f, rows, header):
+        w = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        if header:
+            w.writeheader()
+        for r in rows:
+            r = dict(r)
+            if r["coverage"] is not None:
+                r["coverage"] = f"{r['coverage']:.4f}"
+            r["max_gap_ms"]  = f"{r['max_gap_ms']:.2f}"
+            r["max_read_ms"] = f"{r['max_read_ms']:.2f}"
+            w.writerow(r)
+
+    def export_csv(self, path):
+        """Write the per-second time series to `path`. Returns the number of rows."""
+        rows = self.history()
+        try:
+            with open(path, "w", newline="") as f:
+                self._write_rows(f, rows, header=True)
+            logger.info(f"   ✅ Link metrics exported to {path} ({len(rows)} rows)")
+        except Exception as e:
+            logger.error(f"  ❌ Link metrics export failed: {e}")
+            return 0
+        return len(rows)
+
+    # ---- run log (recorder thread / save service) --------------
+
+    def open_log(self, path, append=False):
+        """
+        Start logging closed seconds to `path`. append=True continues the
+        file of a resumed run; otherwise it is started over.
+        """
+        try:
+            if not append or not os.path.exists(path):
+                with open(path, "w", newline="") as f:
+                    self._write_rows(f, [], header=True)
+        except Exception as e:
+            logger.error(f"  ❌ Link metrics log {path}: {e}")
+            return False
+        with self._lock:
+            self._roll(time.time())
+            self._log_rows = []
+            self._log_path = path
+        return True
+
+    def flush_log(self):
+        """Append the seconds closed since the last flush. Returns the number of rows."""
+        with self._lock:
+            self._roll(time.time())
+            path, rows, self._log_rows = self._log_path, self._log_rows, []
+        if path is None or not rows:
+            return 0
+        try:
+            with open(path, "a", newline="") as f:
+                self._write_rows(f, rows, header=False)
+        except Exception as e:
+            logger.error(f"  ❌ Link metrics log {path}: {e}")
+            return 0
+        return len(rows)
+
+    def close_log(self):
+        """Final flush; later seconds are no longer logged. Returns the log path."""
+        path = self._log_path
+        self.flush_log()
+        with self._lock:
+            self._log_path = None
+            self._log_rows = []
+        if path is not None:
+            logger.info(f"   ✅ Link metrics logged to {path}")
+        return path
+
+
+# Single instance used by the dispatcher
+metrics = ProtocolMetrics()
@@ -0,0 +1,187 @@
+# shproto/pulses.py
+#
+# MODE_PULSE sink for the MAX.
+#
+# Each pulse packet is decoded with np.frombuffer into a preallocated ring
+# (for the scope view) and appended to one long-lived buffered binary log.
+# The log rotates by size; CSV is only produced on demand by export_csv(),
+# which runs when the pulse view in tab 1 is stopped.
+#
+# Binary record layout: <u2 n> followed by n x <u2 samples
+
+import os
+import logging
+import threading
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RING_ROWS      = 256            # pulses kept for the scope view
+MAX_SAMPLES    = 2048           # BUFFER_SIZE / 2
+MAX_LOG_BYTES  = 32 * 1024**2   # rotate at 32 MB
+KEEP_LOGS      = 3              # .bin, .bin.1, .bin.2
+WRITE_BUFFER   = 256 * 1024
+
+
+class PulseSink:
+
+    def __init__(self, rows=RING_ROWS, max_samples=MAX_SAMPLES,
+                 max_bytes=MAX_LOG_BYTES, keep=KEEP_LOGS):
+        self._lock     = threading.Lock()
+        self._ring     = np.zeros((rows, max_samples), dtype=np.uint16)
+        self._lens     = np.zeros(rows, dtype=np.int32)
+        self._head     = 0              # next row to write
+        self._filled   = 0
+        self.max_bytes = int(max_bytes)
+        self.keep      = max(1, int(keep))
+        self.path      = None
+        self._fh       = None
+        self._size     = 0
+        self.total     = 0
+
+    # ---- file handling -----------------------------------------
+
+    def configure(self, path):
+        """Set the log path. The file itself is opened on the first pulse."""
+        with self._lock:
+            if path != self.path:
+                self._close_locked()
+            self.path = path
+
+    def _open_locked(self):
+        if self._fh is not None or not self.path:
+            return
+        try:
+            self._fh   = open(self.path, "ab", buffering=WRITE_BUFFER)
+            self._size = self._fh.tell()
+        except Exception as e:
+            logger.error(f"  ❌ pulse log open failed {self.path}: {e}")
+            self._fh = None
+
+    def _close_locked(self):
+        if self._fh is not None:
+            try:
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
+
+    def _rotate_locked(self):
+        self._close_locked()
+        try:
+            for i in range(self.keep - 1, 0, -1):
+                src = self.path if i == 1 else f"{self.path}.{i - 1}"
+                dst = f"{self.path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, dst)
+            if self.keep == 1 and os.path.exists(self.path):
+                os.remove(self.path)
+        except Exception as e:
+            logger.warning(f"👆 pulse log rotate failed: {e}")
+        self._open_locked()
+
+    def flush(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.flush()
+
+    def close(self):
+        with self._lock:
+            self._close_locked()
+
+    # ---- hot path ----------------------------------------------
+
+    def push(self, payload):
+        """Decode one MODE_PULSE payload (CRC still attached) and store it."""
+        raw = bytes(payload)
+        raw = raw[:len(raw) & ~1]
+        values = np.frombuffer(raw, dtype="<u2")[:-1]   # last word is the CRC
+        n = min(len(values), self._ring.shape[1])
+        if n <= 0:
+            return None
+
+        with self._lock:
+            row = self._head
+            self._ring[row, :n] = values[:n]
+            self._lens[row]     = n
+            self._head          = (row + 1) % self._ring.shape[0]
+            self._filled        = min(self._filled + 1, self._ring.shape[0])
+            self.total         += 1
+
+            if self.path:
+                self._open_locked()
+                if self._fh is not None:
+                    try:
+                        self._fh.write(np.uint16(n).tobytes())
+                        self._fh.write(values[:n].astype("<u2", copy=False).tobytes())
+                        self._size += 2 + 2 * n
+                        if self._size >= self.max_bytes:
+                            self._rotate_locked()
+                    except Exception as e:
+                        logger.error(f"  ❌ pulse log write failed: {e}")
+                        self._close_locked()
+        return n
+
+    # ---- readers -----------------------------------------------
+
+    def latest(self):
+        """Most recent pulse as a list (empty if none yet)."""
+        with self._lock:
+            if not self._filled:
+                return []
+            row = (self._head - 1) % self._ring.shape[0]
+            return self._ring[row, :self._lens[row]].tolist()
+
+    def recent(self, n=RING_ROWS):
+        """Up to n most recent pulses, oldest first."""
+        with self._lock:
+            n    = min(int(n), self._filled)
+            rows = [(self._head - n + i) % self._ring.shape[0] for i in range(n)]
+            return [self._ring[r, :self._lens[r]].copy() for r in rows]
+
+    def clear(self):
+        with self._lock:
+            self._lens[:] = 0
+            self._head    = 0
+            self._filled  = 0
+
+    def _log_files(self):
+        files = [f"{self.path}.{i}" for i in range(self.keep - 1, 0, -1)] + [self.path]
+        return [f for f in files if f and os.path.exists(f)]
+
+    def iter_pulses(self):
+        """Yield every logged pulse, oldest first, across rotated files."""
+        self.flush()
+        for path in self._log_files():
+            with open(path, "rb") as f:
+                buf = f.read()
+            pos = 0
+            while pos + 2 <= len(buf):
+                n = int(np.frombuffer(buf, dtype="<u2", count=1, offset=pos)[0])
+                pos += 2
+                if pos + 2 * n > len(buf):
+                    break   # torn tail from a crash
+                yield np.frombuffer(buf, dtype="<u2", count=n, offset=pos)
+                pos += 2 * n
+
+    def export_csv(self, csv_path):
+        """Write the logged pulses as CSV (header 0..n-1, one pulse per row)."""
+        rows = 0
+        try:
+            with open(csv_path, "w") as fd:
+                header_done = False
+                for p in self.iter_pulses():
+                    if not header_done:
+                        fd.write(",".join(map(str, range(len(p)))) + "\n")
+                        header_done = True
+                    fd.write(",".join(map(str, p.tolist())) + "\n")
+                    rows += 1
+            logger.info(f"   ✅ Exported {rows} pulses to {csv_path}")
+        except Exception as e:
+            logger.error(f"  ❌ pulse CSV export failed: {e}")
+        return rows
+
+
+# Single instance fed by the dispatcher
+sink = PulseSink()
@@ -0,0 +1,126 @@
+# snip.py
+#
+# SNIP background (statistics-sensitive non-linear iterative peak clipping).
+#
+# The counts are compressed with the LLS operator log(log(sqrt(y + 1) + 1) + 1),
+# then every channel is clipped to the mean of its neighbours at distance p
+# for p = iterations .. 1 (decreasing window, which keeps the shoulders of
+# wide peaks out of the background), and the result is transformed back.
+# Each iteration is one vectorised minimum over the whole array, and the last
+# axis is the channel axis, so a single spectrum and a (rows, bins) waterfall
+# block go through the same code.
+#
+# background() caches results per spectrum version (a digest of the counts
+# unless the caller passes one) and parameters.
+
+import hashlib
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+import shared
+
+ITERATIONS = 24
+CACHE_SIZE = 8
+
+
+def settings():
+    """(iterations, smoothing) from the snip_iterations / snip_smoothing settings."""
+    with shared.write_lock:
+        it = getattr(shared, "snip_iterations", ITERATIONS)
+        sm = getattr(shared, "snip_smoothing", 0)
+    try:
+        it = max(1, int(it))
+    except (TypeError, ValueError):
+        it = ITERATIONS
+    try:
+        sm = max(0, int(sm))
+    except (TypeError, ValueError):
+        sm = 0
+    return it, sm
+
+
+def smooth(v, window):
+    """Centred moving average along the last axis (edges use the shorter window)."""
+    if window < 2:
+        return v
+    half = window // 2
+    pad  = [(0, 0)] * (v.ndim - 1) + [(half, half)]
+    cs   = np.cumsum(np.pad(v, pad), axis=-1)
+    cs   = np.concatenate([np.zeros(v.shape[:-1] + (1,)), cs], axis=-1)
+    n    = v.shape[-1]
+    idx  = np.arange(n)
+    lo, hi = idx, idx + 2 * half + 1
+    cnt  = np.minimum(hi, n + half) - np.maximum(lo, half)
+    return (cs[..., hi] - cs[..., lo]) / cnt
+
+
+def compute(y, iterations=ITERATIONS, smoothing=0):
+    """SNIP background of a spectrum (1D) or of every row of a 2D block, uncached."""
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    if y.shape[-1] < 3:
+        return y.copy()
+    y = np.maximum(y, 0.0)
+    v = np.log(np.log(np.sqrt(y + 1.0) + 1.0) + 1.0)
+    v = smooth(v, int(smoothing))
+
+    n = v.shape[-1]
+    for p in range(min(int(iterations), (n - 1) // 2), 0, -1):
+        mid = 0.5 * (v[..., :-2 * p] + v[..., 2 * p:])
+        np.minimum(v[..., p:-p], mid, out=v[..., p:-p])
+
+    bkg = (np.exp(np.exp(v) - 1.0) - 1.0) ** 2 - 1.0
+    return np.minimum(np.maximum(bkg, 0.0), y)
+
+
+class BackgroundCache:
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size   = int(size)
+        self._lock  = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, y, iterations, smoothing, version=None):
+        y   = np.asarray(y, dtype=float)
+        key = (version if version is not None else
+               hashlib.blake2b(np.ascontiguousarray(y).tobytes(), digest_size=16).hexdigest(),
+               y.shape, int(iterations), int(smoothing))
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is not None:
+                self._items.move_to_end(key)
+                return hit
+        bkg = compute(y, iterations, smoothing)
+        bkg.flags.writeable = False
+        with self._lock:
+            self._items[key] = bkg
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return bkg
+
+
+_cache = BackgroundCache()
+
+
+def background(y, iterations=None, smoothing=None, version=None):
+    """Cached SNIP background; None parameters come from the settings. Read-only array."""
+    it, sm = settings()
+    return _cache.get(y, it if iterations is None else iterations,
+                      sm if smoothing is None else smoothing, version)
+
+
+def net(y, iterations=None, smoothing=None, version=None, cached=True):
+    """
+    Counts above the SNIP background (never negative). Use cached=False for
+    one-off blocks such as waterfall export chunks.
+    """
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    if cached:
+        bkg = background(y, iterations, smoothing, version)
+    else:
+        it, sm = settings()
+        bkg = compute(y, it if iterations is None else iterations,
+                      sm if smoothing is None else smoothing)
+    return np.maximum(y - bkg, 0.0)
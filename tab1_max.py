@@ -29,6 +29,7 @@ from shared import logger, FOOTER, DARK_BLUE, LIGHT_GREEN, WHITE
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
 from shproto.dispatcher import process_03
+from shproto.pulses import sink as pulse_sink
 from qss import apply_plot_theme, plot_theme_colors
 
 BTN_W = 130
@@ -361,7 +362,7 @@ class Tab1MaxWidget(QWidget):
         self.pulse_timer.start()
 
     def stop_max_pulse_check(self):
-        fn.stop_max_pulse_check()
+        fn.stop_max_pulse_check(export_csv=self.current_max_mode != 0)
         self.current_max_mode = 0
         self.pulse_timer.stop()
 
@@ -398,11 +399,10 @@ class Tab1MaxWidget(QWidget):
     def update_pulse_plot(self):
         mode = getattr(self, "current_max_mode", 2)
 
-        with shared.write_lock:
-            pulse_data = shared.max_pulse_shape[-4096:]
-            max_x = len(pulse_data) if pulse_data else 100
-            max_y = max(pulse_data) if pulse_data else 1
-            min_y = min(pulse_data) if pulse_data else 0
+        pulse_data = pulse_sink.latest()
+        max_x = len(pulse_data) if pulse_data else 100
+        max_y = max(pulse_data) if pulse_data else 1
+        min_y = min(pulse_data) if pulse_data else 0
 
         # Fallback if empty or all zeros
         if not pulse_data or all(v == 0 for v in pulse_data):
@@ -7,6 +7,17 @@ import json
 import numpy as np
 import shproto
 import time
+import jsonio
+import recovery
+import peak_search
+import roi_stats
+import isotope_index
+import peak_fit
+import snip
+import nuclide_id
+import pyramid
+import calibration
+import rebin
 
 from datetime import datetime
 from qt_compat import QWidget
@@ -39,7 +50,6 @@ from functions import (
     load_histogram_2, 
     load_histogram_csv,
     gaussian_correl,
-    peak_finder,
     get_isotope_options,
     resource_path,
     sanitize_for_log,
@@ -217,8 +227,13 @@ class Tab2(QWidget):
         self.plot_title_right.setProperty("typo", "p2")
         self.plot_title_right.setAlignment(Qt.AlignRight)
 
+        self.plot_title_center = QLabel("")
+        self.plot_title_center.setProperty("typo", "p2")
+        self.plot_title_center.setAlignment(Qt.AlignCenter)
+
         title_bar = QHBoxLayout()
         title_bar.addWidget(self.plot_title_left)
+        title_bar.addWidget(self.plot_title_center)
         title_bar.addWidget(self.plot_title_right)
 
         # --- Create the PlotWidget first ----------
@@ -1028,6 +1043,7 @@ class Tab2(QWidget):
             return                 
         self.update_labels()
         self.update_histogram()
+        self._update_nuclide_id()
 
     def _reload_isotope_combo(self):
         """Rebuild combo from LIB_DIR and preserve current selection in-memory only."""
@@ -1155,7 +1171,14 @@ class Tab2(QWidget):
             logger.info(f" 👆Invalid filename - can't write to i/ directory")
             return
 
-        if os.path.exists(file_path):
+        info = recovery.interrupted(filename, 2)
+        choice = self.confirm_resume(f"{filename}.json", info) if info is not None else None
+        if info is not None and choice is None:
+            return
+
+        if choice == "resume":
+            recovery.request(filename, 2)
+        elif choice is None and os.path.exists(file_path):
             if not self.confirm_overwrite(file_path, filename):
                 return
 
@@ -1176,6 +1199,33 @@ class Tab2(QWidget):
         self.update_histogram()
 
 
+    def confirm_resume(self, filename_display, info):
+        """'resume', 'new' (start over) or None (cancel) for an interrupted recording."""
+        started = info.get("started", "")
+        msg_box = QMessageBox(self)
+        msg_box.setIcon(QMessageBox.Question)
+        msg_box.setWindowTitle("Interrupted Recording")
+        msg_box.setText(f'"{filename_display}" did not stop cleanly{" (started " + started + ")" if started else ""}.\n'
+                        f'Resume from its last checkpoint or start over?')
+        msg_box.setStandardButtons(QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+        icon = QPixmap(ICON_PATH).scaled(48, 48)
+        msg_box.setIconPixmap(icon)
+
+        buttons = (msg_box.button(QMessageBox.Yes), msg_box.button(QMessageBox.No), msg_box.button(QMessageBox.Cancel))
+        buttons[0].setText("Resume")
+        buttons[1].setText("Start over")
+        for b in buttons:
+            b.setProperty("btn", "primary")
+            b.style().unpolish(b)
+            b.style().polish(b)
+
+        reply = msg_box.exec()
+        if reply == QMessageBox.Yes:
+            return "resume"
+        if reply == QMessageBox.No:
+            return "new"
+        return None
+
     def confirm_overwrite(self, file_path, filename_display=None):
         if filename_display is None:
             filename_display = os.path.basename(file_path)
@@ -1369,6 +1419,23 @@ class Tab2(QWidget):
             logger.error(f"❌ Invalid compression data: {data!r}")
             return
 
+        # recorded or loaded spectrum: show the stored level, no reload
+        if pyramid.switch(compression):
+            self.update_labels()
+            self.update_histogram()
+            return
+
+        if shared.run_flag.is_set():
+            # a running recording cannot be shown finer than it is recorded
+            with shared.write_lock:
+                current = int(shared.compression)
+            idx = self.bins_selector.findData(current)
+            if idx != -1:
+                self.bins_selector.blockSignals(True)
+                self.bins_selector.setCurrentIndex(idx)
+                self.bins_selector.blockSignals(False)
+            return
+
         with shared.write_lock:
             shared.compression = compression
             # guard against divide-by-zero and nonsense
@@ -1531,8 +1598,7 @@ class Tab2(QWidget):
             return
 
         try:
-            with open(json_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            data = jsonio.load(json_path)
 
             # Safely update note
             try:
@@ -1541,8 +1607,7 @@ class Tab2(QWidget):
                 logger.error(f"  ❌ Failed to update note field: {e} ")
                 return
 
-            with open(json_path, "w", encoding="utf-8") as f:
-                json.dump(data, f)  # no indent ➜ compact
+            jsonio.save(json_path, data, "json")  # compact, keeps compression setting
 
             # logger.info(f"   ✅ Updated note in {filename} ")
 
@@ -1586,8 +1651,7 @@ class Tab2(QWidget):
 
                 if cal_switch:
                     # Write calibrated energy axis
-                    poly = np.poly1d([coeff_1, coeff_2, coeff_3])
-                    energies = poly(np.arange(len(histogram)))
+                    energies = calibration.for_coeffs([coeff_1, coeff_2, coeff_3], len(histogram)).energies
                     writer.writerow(["Energy", "Counts"])
                     writer.writerows(zip(np.round(energies, 3), histogram))
                 else:
@@ -1700,44 +1764,37 @@ class Tab2(QWidget):
     def calibrate_spectrum(self, indices, coeffs, cal_switch):
         if not cal_switch or coeffs is None or not any(np.isfinite(coeffs)):
             return indices
-        poly = np.poly1d(coeffs)
-        return np.polyval(poly, np.asarray(indices, dtype=float)).tolist()
+        n = len(indices)
+        if n and indices[0] == 0 and indices[-1] == n - 1:
+            return list(calibration.for_coeffs(coeffs, n).axis())   # 0..n-1: cached table
+        return np.polyval(coeffs, np.asarray(indices, dtype=float)).tolist()
 
     # required for on_mouse_moved
     def inverse_calibration(self, energy, coeffs, n_channels):
-        poly = np.poly1d(coeffs)
-        roots = np.roots(poly - energy)
-        real_roots = roots[np.isreal(roots)].real
-        if len(real_roots) == 0:
-            return None
-        valid = [r for r in real_roots if 0 <= r < n_channels]
-        if not valid:
-            return None
-        return valid[0]
+        return calibration.for_coeffs(coeffs, n_channels).channel(energy)
 
     def _on_auto_roi_clicked(self):
         with shared.write_lock:
-            y = list(shared.histogram)
+            y = np.asarray(shared.histogram, dtype=float)
             sigma = float(shared.sigma)
             prom  = max(1, int(shared.peakfinder))
 
-        if not y or len(y) < 5:
+        if len(y) < 5:
             return
 
         try:
-            peaks, widths = peak_finder(y_values=np.asarray(y, float),
-                                        prominence=prom,
-                                        min_width=max(1e-3, sigma),
-                                        smoothing_window=3)
+            found = peak_search.engine.search(y, prominence=prom,
+                                              min_width=max(1e-3, sigma),
+                                              smoothing_window=3)
         except Exception:
-            peaks, widths = [], []
+            found = []
 
         # append up to, say, 12 peaks
         N = len(y)
         added = 0
-        for k in range(min(len(peaks), 12)):
-            p = int(peaks[k])
-            w = int(max(2, round(float(widths[k])))) if len(widths) > k else 4
+        for pk in found[:12]:
+            p = int(pk["index"])
+            w = int(max(2, round(pk["fwhm"])))
             i0 = max(0, p - w)
             i1 = min(N-1, p + w)
             self._append_peak_indices(i0, i1)
@@ -1841,67 +1898,49 @@ class Tab2(QWidget):
 
             # snapshot
             with shared.write_lock:
-                y      = list(shared.histogram)
+                y      = np.asarray(shared.histogram, dtype=float)
                 coeffs = [shared.coeff_1, shared.coeff_2, shared.coeff_3]
                 cal_on = bool(shared.cal_switch)
+                fit_model = getattr(shared, "roi_fit_model", "none")
+                roi_bkg   = getattr(shared, "roi_background", "linear")
 
             # ensure UIDs
             peak_list = self._ensure_peak_uids()
 
-            if not y:
+            if not len(y):
                 self.roi_table.setRowCount(0)
                 return
 
             def ch_to_gui(ch: float) -> float:
                 if cal_on and any(np.isfinite(coeffs)):
-                    return float(np.polyval(coeffs, float(ch)))
+                    return calibration.for_coeffs(coeffs, len(y)).energy(ch)
                 return float(ch)
 
-            rows = []
-            for pk in peak_list:
-                i0 = max(0, min(int(pk['i0']), len(y)-1))
-                i1 = max(0, min(int(pk['i1']), len(y)-1))
-                if i1 <= i0:
-                    continue
-
-                xv = np.arange(i0, i1+1, dtype=float)
-                yr = np.asarray(y[i0:i1+1], dtype=float)
-
-                gross = float(np.nansum(yr))
-                yL, yR = float(yr[0]), float(yr[-1])
-                m = (yR - yL) / max(1, len(yr)-1)
-                bkg = yL + m*np.arange(len(yr), dtype=float)
-                net = float(np.nansum(yr - bkg))
-
-                denom = float(np.nansum(yr))
-                centroid_ch = float(np.nansum(xv * yr) / denom) if denom > 0 else float((i0 + i1) / 2)
-
-                # FWHM
-                try:
-                    y_max = float(np.nanmax(yr)); half = 0.5 * y_max
-                    L = next((k for k in range(1, len(yr)) if yr[k-1] < half <= yr[k]), None)
-                    R = next((k for k in range(len(yr)-1, 0, -1) if yr[k] < half <= yr[k-1]), None)
-                    if L is None or R is None:
-                        fwhm_ch = float("nan")
-                    else:
-                        fracL = (half - yr[L-1]) / max(1e-12, (yr[L] - yr[L-1]))
-                        xL = (i0 + L - 1) + fracL
-                        fracR = (half - yr[R]) / max(1e-12, (yr[R-1] - yr[R]))
-                        xR = (i0 + R) - fracR
-                        fwhm_ch = float(abs(xR - xL))
-                except Exception:
-                    fwhm_ch = float("nan")
-
-                centroid_gui = ch_to_gui(centroid_ch)
+            # all ROIs in one call (prefix sums, vectorised FWHM)
+            n   = len(y)
+            use = [pk for pk in peak_list
+                   if max(0, min(int(pk['i1']), n-1)) > max(0, min(int(pk['i0']), n-1))]
+            cal = cal_on and any(np.isfinite(coeffs))
+            stats = roi_stats.roi_table(y, [(pk['i0'], pk['i1']) for pk in use],
+                                        coeffs if cal else None)
+            if roi_bkg == "snip" and use:
+                # net above the SNIP continuum instead of the edge-to-edge line
+                bkg = snip.background(y)
+                stats["net"] = stats["gross"] - roi_stats.range_sums(bkg, list(zip(stats["i0"], stats["i1"])))
+            if fit_model in peak_fit.MODELS and use:
+                self._apply_roi_fits(y, use, stats, fit_model, coeffs if cal else None)
 
-                if cal_on and any(np.isfinite(coeffs)) and np.isfinite(fwhm_ch):
-                    a, b, _ = coeffs
-                    dEdx = (2 * a * centroid_ch + b) if (a or b) else (ch_to_gui(centroid_ch+1) - ch_to_gui(centroid_ch))
-                    fwhm_keV = abs(dEdx) * fwhm_ch
-                    res_pct = (fwhm_keV / centroid_gui * 100.0) if centroid_gui > 0 else float("nan")
+            rows = []
+            for k, pk in enumerate(use):
+                i0, i1       = int(stats["i0"][k]), int(stats["i1"][k])
+                centroid_ch  = float(stats["centroid"][k])
+                fwhm_ch      = float(stats["fwhm"][k])
+                res_pct      = float(stats["resolution"][k])
+                centroid_gui = float(stats["energy"][k])
+
+                if cal and np.isfinite(fwhm_ch):
                     width_txt = f"{abs(ch_to_gui(i1) - ch_to_gui(i0)):.2f}"
                 else:
-                    res_pct   = (fwhm_ch / centroid_ch * 100.0) if (np.isfinite(fwhm_ch) and centroid_ch > 0) else float("nan")
                     width_txt = f"{abs(i1 - i0):.0f}"
                 
                 cent_txt = f"{centroid_ch:.0f}"
@@ -1916,11 +1955,14 @@ class Tab2(QWidget):
                     "centroid_txt":  cent_txt,
                     "res_txt":       f"{res_pct:.1f} %" if np.isfinite(res_pct) else "",
                     "width_txt":     width_txt,
-                    "net_txt":       str(int(round(net))),
-                    "gross_txt":     str(int(round(gross))),
-                    "iso_txt":       self._isotope_matches(centroid_ch, fwhm_ch),
+                    "net_txt":       str(int(round(float(stats["net"][k])))),
+                    "gross_txt":     str(int(round(float(stats["gross"][k])))),
                 })
 
+            iso_txt = self._isotope_matches_all([r["centroid_ch"] for r in rows], stats["fwhm"])
+            for row, txt in zip(rows, iso_txt):
+                row["iso_txt"] = txt
+
             # sort by centroid (keV or channel)
             rows.sort(key=lambda r: r["centroid_sort"])
 
@@ -2112,7 +2154,10 @@ class Tab2(QWidget):
         self.poly_label.setText(f"E = {coeff_1:.6f}x² + {coeff_2:.6f}x + {coeff_3:.6f}")
 
         if filename and not shared.run_flag.is_set():
-            update_calibration_in_json(filename, a, b, c)
+            # the file keeps its own resolution; the view may be re-binned
+            with shared.write_lock:
+                view = int(shared.compression)
+            update_calibration_in_json(filename, *pyramid.file_coeffs([a, b, c], view))
 
         return True
 
@@ -2226,62 +2271,82 @@ class Tab2(QWidget):
 
     
 
+    def _apply_roi_fits(self, y, peak_list, stats, model, coeffs):
+        """Replace model-free centroid/FWHM/net with Gaussian fits where they converged."""
+        fits = peak_fit.fitter.fit_all(
+            y, [{"i0": pk['i0'], "i1": pk['i1'], "uid": pk.get('uid')} for pk in peak_list], model)
+        for k, fit in enumerate(fits):
+            if not fit["ok"] or not fit["peaks"]:
+                continue
+            main = max(fit["peaks"], key=lambda p: p["area"])
+            stats["centroid"][k] = main["centroid"]
+            stats["fwhm"][k]     = main["fwhm"]
+            stats["net"][k]      = sum(p["area"] for p in fit["peaks"])
+        stats["energy"], stats["fwhm_energy"], stats["resolution"] = roi_stats.calibrate(
+            stats["centroid"], stats["fwhm"], coeffs)
+
+    def _update_nuclide_id(self):
+        """Top nuclides from the template matrix in the title bar (when enabled and calibrated)."""
+        with shared.write_lock:
+            enabled = bool(getattr(shared, "nuclide_id", False))
+            cal_on  = bool(shared.cal_switch)
+            coeffs  = [shared.coeff_1, shared.coeff_2, shared.coeff_3]
+            y       = np.asarray(shared.histogram, dtype=float)
+
+        if not enabled or not cal_on or not any(coeffs) or not len(y):
+            self.plot_title_center.setText("")
+            return
+
+        try:
+            ranked = nuclide_id.identify(y, coeffs, top=3)
+        except Exception as e:
+            logger.error(f"  ❌ Nuclide ID failed: {e} ")
+            ranked = []
+
+        txt = "   ".join(f"{r['nuclide']} {r['confidence'] * 100:.0f}%"
+                         for r in ranked if r["confidence"] >= 0.5)
+        self.plot_title_center.setText(txt)
+        self.plot_title_center.setToolTip("\n".join(
+            f"{r['nuclide']}: {r['counts']:.0f} counts, {r['significance']:.1f} σ" for r in ranked))
+
     def _isotope_matches(self, centroid_ch: float, fwhm_ch: float) -> str:
         """Return a short, sorted string of isotope matches for the centroid (keV), or '' if unavailable."""
+        return self._isotope_matches_all([centroid_ch], [fwhm_ch])[0]
+
+    def _isotope_matches_all(self, centroids_ch, fwhms_ch) -> list:
+        """Isotope match strings for many ROIs at once (one index query per call)."""
         with shared.write_lock:
-            isotope_flags = list(getattr(shared, "isotope_flags", []))
+            isotope_flags = getattr(shared, "isotope_flags", [])
             cal_on = bool(shared.cal_switch)
             coeffs = [shared.coeff_1, shared.coeff_2, shared.coeff_3]
 
-        if not cal_on or not isotope_flags or not any(coeffs):
-            return ""
+        n = len(centroids_ch)
+        if not cal_on or not isotope_flags or not any(coeffs) or not n:
+            return [""] * n
 
-        # energy at centroid (keV)
-        energy = float(np.polyval(coeffs, centroid_ch))
+        index = isotope_index.index_for(isotope_flags)
+        ch    = np.asarray(centroids_ch, dtype=float)
+        fw    = np.asarray(fwhms_ch, dtype=float)
 
-        # local slope dE/dx (keV per bin)
-        a, b, _ = coeffs
-        # NEW: finite-difference without helper
-        if any(coeffs):
-            poly = np.poly1d(coeffs)
-            dEdx = float(poly(float(centroid_ch) + 1.0) - poly(float(centroid_ch)))
-        else:
-            dEdx = 1.0  # uncalibrated case: 1 keV per bin equivalent (units cancel anyway)
+        # energy at centroid and local slope dE/dx (keV per bin), finite difference
+        energy = np.polyval(coeffs, ch)
+        dEdx   = np.polyval(coeffs, ch + 1.0) - energy
 
         # FWHM in keV (if available)
-        fwhm_keV = abs(dEdx) * float(fwhm_ch) if np.isfinite(fwhm_ch) else 0.0
+        fwhm_keV = np.where(np.isfinite(fw), np.abs(dEdx) * fw, 0.0)
 
-        # same tolerance recipe used in markers
-        base_tol_keV = 2.0
-        fwhm_mult    = 0.6
-        rel_frac     = 0.002
-        tol_keV = max(base_tol_keV, fwhm_mult * fwhm_keV, rel_frac * abs(energy))
-
-        candidates = []
-        for iso in isotope_flags:
-            try:
-                iso_e = float(iso["energy"])
-                d = abs(iso_e - energy)
-                if d <= tol_keV:
-                    intensity = float(iso.get("intensity", 0.0))  # 0..1
-                    score = (1.0 - (d / tol_keV)) * (0.1 + intensity)
-                    candidates.append((score, d, iso_e, iso))
-            except Exception:
-                continue
-
-        if not candidates:
-            return ""
-
-        # sort: best score, then smallest delta
-        candidates.sort(key=lambda t: (-t[0], t[1]))
+        # same tolerance recipe used in markers; best score, then smallest delta
+        ranked = index.match(energy, isotope_index.tolerance(energy, fwhm_keV), top=3)
 
         # format top few (keep it readable in a table cell)
         out = []
-        for _, d, iso_e, iso in candidates[:3]:
-            inten_pct = float(iso.get("intensity", 0.0)) * 100.0
-            out.append(f"{iso['isotope']} {iso_e:.1f} keV ({inten_pct:.0f}%), Δ{d:.2f} keV")
-
-        return "\n".join(out)
+        for candidates in ranked:
+            lines = []
+            for _, d, iso_e, iso in candidates:
+                inten_pct = float(iso.get("intensity", 0.0)) * 100.0
+                lines.append(f"{iso['isotope']} {iso_e:.1f} keV ({inten_pct:.0f}%), Δ{d:.2f} keV")
+            out.append("\n".join(lines))
+        return out
 
 
     def update_histogram(self):
@@ -2294,6 +2359,8 @@ class Tab2(QWidget):
             sigma          = shared.sigma
             coeff_abc      = [shared.coeff_1, shared.coeff_2, shared.coeff_3]
             comp_coeff_abc = [shared.comp_coeff_1, shared.comp_coeff_2, shared.comp_coeff_3]
+            compression    = shared.compression
+            compression_2  = shared.compression_2
             epb_switch     = shared.epb_switch
             log_switch     = shared.log_switch
             cal_switch     = shared.cal_switch
@@ -2318,21 +2385,15 @@ class Tab2(QWidget):
 
 
         if diff_switch and comp_switch:
-            eps = 1e-9
-            # pad to same length without mutating the originals mid-calc
-            max_len = max(len(y_vals), len(y_vals2))
-            y1 = y_vals  + [0]   * (max_len - len(y_vals))
-            y2 = y_vals2 + [0.0] * (max_len - len(y_vals2))
-
-            # scale background totals to match the *current* live elapsed window
-            scale = float(elapsed) / max(float(elapsed_2), eps)
-            y2_scaled = [b * scale for b in y2]
+            # background rebinned onto the primary's energy grid (cached
+            # overlap matrix) and scaled to the primary's live time
+            net, bkg = rebin.subtract(y_vals, elapsed, coeff_abc, compression,
+                                      y_vals2, elapsed_2, comp_coeff_abc, compression_2)
 
             # update protocol variables for downstream plotting
-            y_vals = [max(a - s, 0) for a, s in zip(y1, y2_scaled)]
-
-            y_vals2 = y2_scaled                              
-            x_vals  = list(range(max_len))
+            y_vals  = net.tolist()
+            y_vals2 = bkg.tolist()
+            x_vals  = list(range(len(y_vals)))
 
         # Keep a pre-EPB/log copy for peak detection
         y_for_peaks = y_vals[:]
@@ -2489,8 +2550,7 @@ class Tab2(QWidget):
             from shared import USER_DATA_DIR
             fpath = os.path.join(USER_DATA_DIR, f"{filename}.json")
             if os.path.exists(fpath):
-                with open(fpath) as _f:
-                    _d = _json.load(_f)
+                _d = jsonio.load(fpath)
                 raw = (_d.get("data", [{}])[0]
                          .get("resultData", {})
                          .get("endTime", ""))
@@ -10,6 +10,12 @@ import time
 import csv
 import webbrowser
 import save
+import waterfall_store
+import waterfall_mmap
+import catalog
+import recovery
+import roi_stats
+import calibration
 
 from qt_compat import QBrush
 from qt_compat import QCheckBox
@@ -590,14 +596,12 @@ class Tab3(QWidget):
 
     def refresh_file_list(self):
 
-        folder = Path(USER_DATA_DIR)
-
-        pattern = "*_hmp.json"
-
-        files = sorted(folder.glob(pattern), reverse=True)
+        # NPESv2 exports plus append-only stores of unfinished recordings
+        stems = {row["stem"] for kind in ("3d", "store")
+                 for row in catalog.files(kind) if "/" not in row["path"]}
 
         # Save original filenames and display names without extension
-        self.file_options = [f.stem.replace("_hmp", "") for f in files] 
+        self.file_options = sorted(stems, reverse=True)
         self.filename_dropdown.blockSignals(True)  
         self.filename_dropdown.clear()
         self.filename_dropdown.addItem("Select file to load")
@@ -642,7 +646,7 @@ class Tab3(QWidget):
             # Push all rows into plot_data at once
             with shared.write_lock:
                 for row in shared.histogram_hmp:
-                    self.plot_data.append(row[:])  # use slice to ensure deep copy if needed
+                    self.plot_data.append(row)     # rows are never mutated after append
 
             self.update_graph()
 
@@ -664,7 +668,14 @@ class Tab3(QWidget):
 
         file_path = os.path.join(USER_DATA_DIR, f"{filename}_hmp.json")
 
-        if os.path.exists(file_path):
+        info = recovery.interrupted(filename, 3)
+        choice = self.confirm_resume(f"{filename}_hmp", info) if info is not None else None
+        if info is not None and choice is None:
+            return
+
+        if choice == "resume":
+            recovery.request(filename, 3)
+        elif choice is None and waterfall_store.hmp_exists(file_path):
             if not self.confirm_overwrite(file_path, f"{filename}_hmp"):
                 return
 
@@ -682,11 +693,14 @@ class Tab3(QWidget):
             QMessageBox.warning(self, "Not Allowed", "Can not open full view while running !")
             return
 
+        if getattr(self, "_full_view_job", None) is not None:
+            return                      # still opening the last one
+
         try:
             from viewer_full_hmp import load_full_hmp_from_json, FullRecordingDialog  # <-- important
 
             json_path = USER_DATA_DIR / f"{shared.filename}_hmp.json"
-            if not json_path.exists():
+            if not waterfall_store.hmp_exists(json_path):
                 from qt_compat import QFileDialog
                 picked, _ = QFileDialog.getOpenFileName(
                     self, "Open HMP JSON", str(USER_DATA_DIR), "HMP JSON (*.json)"
@@ -695,17 +709,44 @@ class Tab3(QWidget):
                     return
                 json_path = Path(picked)
 
-            # NOTE: viewer_full_hmp loader expects fallback_t_interval
-            Z, x_axis, coeffs, t_interval = load_full_hmp_from_json(
-                json_path,
-                fallback_t_interval=int(getattr(shared, "t_interval", 1))
-            )
+            # opening may build the .wfb, which takes a while for long runs
+            job = {"result": None, "error": None}
+            fallback = int(getattr(shared, "t_interval", 1))
+
+            def work():
+                try:
+                    job["result"] = load_full_hmp_from_json(json_path, fallback_t_interval=fallback)
+                except Exception as e:
+                    job["error"] = e
+
+            job["thread"] = threading.Thread(target=work, daemon=True, name="full-view-open")
+            job["thread"].start()
+            self._full_view_job = job
+            QTimer.singleShot(100, self._show_full_view_when_ready)
+
+        except Exception as e:
+            logger.error(f"❌ Failed to open full recording: {e}", exc_info=True)
+            QMessageBox.critical(self, "Error", f"Failed to open full recording:\n{e}")
+
+    def _show_full_view_when_ready(self):
+        job = getattr(self, "_full_view_job", None)
+        if job is None:
+            return
+        if job["thread"].is_alive():
+            QTimer.singleShot(100, self._show_full_view_when_ready)
+            return
+        self._full_view_job = None
+
+        try:
+            if job["error"] is not None:
+                raise job["error"]
+            wm, x_axis, coeffs, t_interval = job["result"]
 
             hist_view = getattr(shared, "tab3_hist_view", False)
 
             dlg = FullRecordingDialog(
                 parent=self,
-                Z=Z,
+                wm=wm,
                 x_axis=x_axis,
                 coeffs=coeffs,
                 t_interval=t_interval,
@@ -763,17 +804,20 @@ class Tab3(QWidget):
         """Sum counts in `row` only within the given index ranges."""
         if not row or not ranges:
             return 0
-        n = len(row)
-        total = 0
-        for i0, i1 in ranges:
-            a = max(0, min(int(i0), n - 1))
-            b = max(0, min(int(i1), n - 1))
-            if b < a:
-                a, b = b, a
-            total += int(sum(row[a:b+1]))
-        return total
+        return int(roi_stats.range_sums(row, ranges).sum())
+
 
 
+    def _recorded_map(self, filename):
+        """
+        Memory-mapped copy of the saved recording for exports, or None while
+        recording (the live ring in shared.histogram_hmp is used then).
+        """
+        rf = shared.run_flag
+        if rf.is_set() if hasattr(rf, "is_set") else bool(rf):
+            return None
+        wm = waterfall_mmap.open_map(USER_DATA_DIR / f"{filename}_hmp.json")
+        return wm if wm is not None and len(wm) else None
 
     @Slot()
     def on_open_map_clicked(self):
@@ -784,8 +828,11 @@ class Tab3(QWidget):
             hist     = list(getattr(shared, "histogram_hmp", []) or [])
             gps_rows = list(getattr(shared, "gps_hmp", []) or [])
             peaks    = list(getattr(shared, "peak_list", []) or [])
+            roi_net  = getattr(shared, "roi_background", "linear") == "snip"
 
-        if not hist:
+        wm = self._recorded_map(filename)
+
+        if not hist and wm is None:
             QMessageBox.information(self, "No Data", "No interval histogram data to map yet.")
             return
 
@@ -802,29 +849,30 @@ class Tab3(QWidget):
             label = (pk.get("name") or pk.get("label") or pk.get("isotope") or pk.get("desc") or "").strip()
             roi_list.append({"i0": i0, "i1": i1, "label": label})
 
-        def sum_range(row, i0, i1):
-            if not row:
-                return 0
-            n = len(row)
-            a = max(0, min(i0, n - 1))
-            b = max(0, min(i1, n - 1))
-            if b < a: a, b = b, a
-            return int(sum(row[a:b+1]))
-
         def get_latlon(g):
             if not isinstance(g, dict):
                 return (None, None, None)
             return (g.get("lat"), g.get("lon"), g.get("t") or g.get("epoch"))
 
+        # per-row ROI sums and totals, from the file (prefix sums over the
+        # memmap) or from the live rows
+        if wm is not None:
+            tint      = wm.t_interval or tint
+            gps_rows  = wm.gps_rows()
+            per_rows  = wm.roi_sums([(r["i0"], r["i1"]) for r in roi_list], net=roi_net).tolist()
+            row_total = wm.row_totals().tolist()
+        else:
+            per_rows  = roi_stats.roi_sums_rows(hist, [(r["i0"], r["i1"]) for r in roi_list], net=roi_net).tolist()
+            row_total = [int(sum(row)) for row in hist]
+
         points = []
-        for i, row in enumerate(hist):
+        for i, per in enumerate(per_rows):
             g = gps_rows[i] if i < len(gps_rows) else None
             lat, lon, t = get_latlon(g)
 
-            per = [sum_range(row, r["i0"], r["i1"]) for r in roi_list]
             per_cps = [c / float(max(1, tint)) for c in per]
 
-            total_counts = int(sum(per)) if roi_list else int(sum(row))
+            total_counts = int(sum(per)) if roi_list else int(row_total[i])
             total_cps = total_counts / float(max(1, tint))
 
             p = {
@@ -868,8 +916,11 @@ class Tab3(QWidget):
             hist     = list(getattr(shared, "histogram_hmp", []) or [])
             gps_rows = list(getattr(shared, "gps_hmp", []) or [])
             peaks    = list(getattr(shared, "peak_list", []) or [])
+            roi_net  = getattr(shared, "roi_background", "linear") == "snip"
+
+        wm = self._recorded_map(filename)
 
-        if not hist:
+        if not hist and wm is None:
             QMessageBox.information(self, "No Data", "No interval histogram data to export yet.")
             return
 
@@ -945,21 +996,6 @@ class Tab3(QWidget):
 
             return rois
 
-        def clamp(a, lo, hi):
-            return max(lo, min(int(a), hi))
-
-        def sum_range(row, i0, i1):
-            if not row:
-                return 0
-            nrow = len(row)
-            if nrow <= 0:
-                return 0
-            a = clamp(i0, 0, nrow - 1)
-            b = clamp(i1, 0, nrow - 1)
-            if b < a:
-                a, b = b, a
-            return int(sum(row[a:b+1]))
-
         def merge_ranges(ranges):
             """Merge inclusive ranges [(i0,i1),...] to avoid double counting."""
             if not ranges:
@@ -974,17 +1010,29 @@ class Tab3(QWidget):
                     merged.append([a, b])
             return [(int(x[0]), int(x[1])) for x in merged]
 
-        def sum_ranges(row, ranges):
-            total = 0
-            for a, b in (ranges or []):
-                total += sum_range(row, a, b)
-            return int(total)
-
         roi_list = build_roi_list(peaks)
         using_roi = bool(roi_list)
 
         merged_total_ranges = merge_ranges([(r["i0"], r["i1"]) for r in roi_list]) if using_roi else []
 
+        # per-row ROI sums and totals, from the file (prefix sums over the
+        # memmap) or from the live rows
+        if wm is not None:
+            tint     = wm.t_interval or tint
+            gps_rows = wm.gps_rows()
+            gps_last = gps_rows[-1] if gps_rows else None
+            per_rows = wm.roi_sums([(r["i0"], r["i1"]) for r in roi_list], net=roi_net).tolist()
+            if using_roi:
+                totals = wm.roi_sums(merged_total_ranges, net=roi_net).sum(axis=1).tolist()
+            else:
+                totals = wm.row_totals().tolist()
+        else:
+            per_rows = roi_stats.roi_sums_rows(hist, [(r["i0"], r["i1"]) for r in roi_list], net=roi_net).tolist()
+            if using_roi:
+                totals = roi_stats.roi_sums_rows(hist, merged_total_ranges, net=roi_net).sum(axis=1).tolist()
+            else:
+                totals = [int(sum(row)) if row else 0 for row in hist]
+
         # --- write CSV ---
         try:
             with open(out_path, "w", newline="", encoding="utf-8") as f:
@@ -1001,20 +1049,13 @@ class Tab3(QWidget):
 
                 roi_labels = [r["label"] for r in roi_list]
 
-                for i, row in enumerate(hist):
+                for i, per in enumerate(per_rows):
                     # choose gps aligned to histogram index
                     g = gps_rows[i] if i < len(gps_rows) else gps_last
                     lat_s, lon_s, t_s = fmt_latlon_and_t(g)
 
-                    if using_roi:
-                        per = [sum_range(row, r["i0"], r["i1"]) for r in roi_list]
-                        per_cps = [c / float(max(1, tint)) for c in per]
-
-                        total_counts = sum_ranges(row, merged_total_ranges)
-                    else:
-                        per = []
-                        per_cps = []
-                        total_counts = int(sum(row)) if row else 0
+                    per_cps = [c / float(max(1, tint)) for c in per]
+                    total_counts = int(totals[i])
 
                     total_cps = total_counts / float(max(1, tint))
 
@@ -1030,6 +1071,33 @@ class Tab3(QWidget):
             QMessageBox.critical(self, "Error", f"Failed to export GPS CSV:\n{e}")
 
 
+    def confirm_resume(self, filename_display, info):
+        """'resume', 'new' (start over) or None (cancel) for an interrupted recording."""
+        started = info.get("started", "")
+        msg_box = QMessageBox(self)
+        msg_box.setIcon(QMessageBox.Question)
+        msg_box.setWindowTitle("Interrupted Recording")
+        msg_box.setText(f'"{filename_display}" did not stop cleanly{" (started " + started + ")" if started else ""}.\n'
+                        f'Resume from its last checkpoint or start over?')
+        msg_box.setStandardButtons(QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel)
+        icon = QPixmap(ICON_PATH).scaled(48, 48)
+        msg_box.setIconPixmap(icon)
+
+        buttons = (msg_box.button(QMessageBox.Yes), msg_box.button(QMessageBox.No), msg_box.button(QMessageBox.Cancel))
+        buttons[0].setText("Resume")
+        buttons[1].setText("Start over")
+        for b in buttons:
+            b.setProperty("btn", "primary")
+            b.style().unpolish(b)
+            b.style().polish(b)
+
+        reply = msg_box.exec()
+        if reply == QMessageBox.Yes:
+            return "resume"
+        if reply == QMessageBox.No:
+            return "new"
+        return None
+
     def confirm_overwrite(self, file_path, filename_display=None):
         if filename_display is None:
             filename_display = os.path.basename(file_path)
@@ -1152,7 +1220,7 @@ class Tab3(QWidget):
         json_path = USER_DATA_DIR / f"{filename}_hmp.json"
         csv_path  = DLD_DIR / f"{filename}_hmp.csv"
 
-        if not json_path.exists():
+        if not waterfall_store.hmp_exists(json_path):
             QMessageBox.warning(self, "Missing File", f"No JSON file found:\n{json_path}")
             return
 
@@ -1168,43 +1236,26 @@ class Tab3(QWidget):
                 counter += 1
 
         try:
-            with open(json_path, "r") as jf:
-                data = json.load(jf)
-
-            # ── Detect NPESv2 format ───────────────────────────────────────────────
-            if (
-                isinstance(data, dict)
-                and "data" in data
-                and isinstance(data["data"], list)
-                and "resultData" in data["data"][0]
-            ):
-                result = data["data"][0]["resultData"]
-                energy_spec = result["energySpectrum"]
-                hist_data = energy_spec["spectrum"]
-                bins = energy_spec.get("numberOfChannels", len(hist_data[0]))
-                coeffs = energy_spec.get("energyCalibration", {}).get("coefficients", [0, 1, 0])
-                coeff_1, coeff_2, coeff_3 = coeffs[:3] if len(coeffs) >= 3 else (0, 1, 0)
-            else:
+            wm = waterfall_mmap.open_map(json_path)
+            if wm is None:
                 raise ValueError("Unexpected JSON structure — not NPESv2 format")
+            bins = wm.bins
+            coeff_1, coeff_2, coeff_3 = wm.coeffs
 
-            # ── Write CSV ───────────────────────────────────────────────────────────
+            # ── Write CSV (rows are streamed from the memmap in chunks) ─────────────
             with open(csv_path, "w", newline="") as fh:
                 writer = csv.writer(fh)
 
                 if self.cal_switch.isChecked():
-                    poly = np.poly1d([coeff_1, coeff_2, coeff_3])
-                    energies = poly(np.arange(bins))
+                    energies = calibration.for_coeffs([coeff_1, coeff_2, coeff_3], bins).energies
                     header = [f"{e:.3f}" for e in energies]
                     writer.writerow(["Time Step"] + header)
                 else:
                     writer.writerow(["Time Step"] + [f"Bin {i}" for i in range(bins)])
 
-                for t, row in enumerate(hist_data):
-                    if len(row) < bins:
-                        row = list(row) + [0] * (bins - len(row))
-                    elif len(row) > bins:
-                        row = list(row)[:bins]
-                    writer.writerow([t] + row)
+                for start, block in wm.iter_chunks():
+                    for k, row in enumerate(block.tolist()):
+                        writer.writerow([start + k] + row)
 
             QMessageBox.information(self, "Download Complete", f"CSV saved to:\n{csv_path}")
 
@@ -1277,18 +1328,7 @@ class Tab3(QWidget):
                 # HISTOGRAM VIEW (plot LAST ROW ONLY, as a step line)
                 # ---------------------------------------------------------
                 if hist_view:
-                    last = rows[-1]
-                    y = np.zeros(bins, dtype=float)
-
-                    if isinstance(last, (list, tuple)):
-                        rlen = len(last)
-                        if rlen >= bins:
-                            y[:] = last[:bins]
-                        elif rlen > 0:
-                            y[:rlen] = last
-                    else:
-                        logger.warning(f"👆 Unexpected last-row type: {type(last)}")
-                        return
+                    y = waterfall_store.dense_matrix(rows[-1:], bins)[0]
 
                     total_counts = float(np.sum(y))
 
@@ -1312,7 +1352,7 @@ class Tab3(QWidget):
                         y = np.log10(y)
 
                     if cal_switch:
-                        x_axis = coeffs[0] * bin_indices**2 + coeffs[1] * bin_indices + coeffs[2]
+                        x_axis = calibration.for_coeffs(coeffs, bins).energies
 
                     order  = np.argsort(x_axis)
                     x_plot = np.asarray(x_axis)[order]
@@ -1453,17 +1493,8 @@ class Tab3(QWidget):
                 # ---------------------------------------------------------
                 # WATERFALL VIEW (2D heatmap of stacked histograms over time)
                 # ---------------------------------------------------------
-                Z = np.zeros((n_rows, bins), dtype=float)
-                for i, r in enumerate(rows):
-                    if isinstance(r, (list, tuple)):
-                        rlen = len(r)
-                        if rlen >= bins:
-                            Z[i, :] = r[:bins]
-                        elif rlen > 0:
-                            Z[i, :rlen] = r
-                    else:
-                        logger.warning(f"👆 Unexpected row type: {type(r)}")
-                        return
+                # rows are sparse; only the visible window is made dense
+                Z = waterfall_store.dense_matrix(rows, bins)
 
                 if Z.ndim != 2 or Z.shape[1] != bins:
                     logger.error(f"  ❌ Z shape mismatch: {Z.shape}, expected (n_rows, {bins}) ")
@@ -1482,7 +1513,7 @@ class Tab3(QWidget):
                     Z = np.log10(Z)
 
                 if cal_switch:
-                    x_axis = coeffs[0] * bin_indices**2 + coeffs[1] * bin_indices + coeffs[2]
+                    x_axis = calibration.for_coeffs(coeffs, bins).energies
 
                 tint    = max(1, int(t_interval))
                 y_last  = float(elapsed)
@@ -1910,50 +1941,12 @@ class Tab3(QWidget):
 
     def _load_full_hmp_from_json(self, path: Path):
         """
-        Returns (Z, x_axis, coeffs, t_interval) where:
-          Z is (T, bins) float array
+        Returns (wm, x_axis, coeffs, t_interval) where:
+          wm is the WaterfallMap (read-only memmap) of the recording
           x_axis is 'bin indices' (you'll map to energy if cal_switch)
           coeffs are INTERNAL order [c1, c2, c3] (a2, a1, a0)
-          t_interval is inferred if present, else falls back to shared.t_interval
+          t_interval is taken from the file if known, else shared.t_interval
         """
-        import json
-        with open(path, "r") as jf:
-            data = json.load(jf)
-
-        if not (isinstance(data, dict)
-                and "data" in data
-                and isinstance(data["data"], list)
-                and data["data"]
-                and "resultData" in data["data"][0]):
-            raise ValueError("Unexpected JSON structure — not NPESv2 format")
-
-        result     = data["data"][0]["resultData"]
-        energy_spec= result["energySpectrum"]
-        hist_data  = energy_spec["spectrum"]
-        bins       = energy_spec.get("numberOfChannels", len(hist_data[0]) if hist_data else 0)
-        npes_coeffs= energy_spec.get("energyCalibration", {}).get("coefficients", [0, 1, 0])
-        # Convert NPES [c3,c2,c1] -> internal [c1,c2,c3]
-        coeff_1    = npes_coeffs[2] if len(npes_coeffs) > 2 else 0.0
-        coeff_2    = npes_coeffs[1] if len(npes_coeffs) > 1 else 1.0
-        coeff_3    = npes_coeffs[0] if len(npes_coeffs) > 0 else 0.0
-        coeffs     = [coeff_1, coeff_2, coeff_3]
-
-        # measurementTime is total seconds; infer t_interval if possible
-        total_secs = energy_spec.get("measurementTime", None)
-        T          = len(hist_data)
-        if total_secs and T > 1:
-            t_interval = max(1, int(round(total_secs / T)))
-        else:
-            with shared.write_lock:
-                t_interval = int(shared.t_interval)
-
-        # Build Z (pad/trim rows defensively)
-        Z = np.zeros((T, bins), dtype=float)
-        for i, r in enumerate(hist_data):
-            if len(r) >= bins:
-                Z[i, :] = r[:bins]
-            elif len(r) > 0:
-                Z[i, :len(r)] = r
-
-        x_axis = np.arange(bins)
-        return Z, x_axis, coeffs, t_interval
+        with shared.write_lock:
+            t_interval = int(shared.t_interval)
+        return load_full_hmp_from_json(path, fallback_t_interval=t_interval)
@@ -30,6 +30,8 @@ from functions import start_recording, stop_recording, get_filename_options, loa
 from pathlib import Path
 from qss import apply_plot_theme, plot_theme_colors
 
+SHOW_ALL_POINTS = 4000      # "Show All" plots at most about this many points
+
 
 class Tab4(QWidget):
 
@@ -250,13 +252,11 @@ class Tab4(QWidget):
         
     def compute_smooth_cps(self, decimals: int = 0):
         try:
-            with shared.write_lock:
-                counts = shared.count_history
             n = max(1, int(self.sum_n))
-            if not counts:
+            window = shared.count_history.tail(n)
+            if not len(window):
                 return 0 if decimals == 0 else 0.0
-            window = counts[-n:] if len(counts) >= n else counts
-            avg = sum(window) / len(window)
+            avg = float(window.sum()) / len(window)
             return int(round(avg)) if decimals == 0 else round(avg, decimals)
         except Exception:
             return 0 if decimals == 0 else 0.0
@@ -295,7 +295,7 @@ class Tab4(QWidget):
             # --- Write CSV ---
             with open(file_path, "w") as f:
                 f.write("Second,Counts\n")
-                for i, count in enumerate(shared.count_history):
+                for i, count in enumerate(shared.count_history):   # streams spilled rows from disk
                     f.write(f"{i},{count}\n")
 
             QMessageBox.information(self, "Download Complete", f"Saved to:\n{file_path}")
@@ -337,17 +337,21 @@ class Tab4(QWidget):
         try:
             with shared.write_lock:
                 filename = shared.filename
-                counts = shared.count_history.copy()
 
-            # --- Trim history if needed ---
-            if not self.checkbox_show_all.isChecked() and len(counts) > 300:
-                counts = counts[-300:]
+            # --- Only the visible part of the history is fetched ---
+            # (the whole run as block means, so long runs stay cheap)
+            if self.checkbox_show_all.isChecked():
+                x, counts = shared.count_history.decimated(SHOW_ALL_POINTS)
+                step = int(x[1] - x[0]) if len(x) > 1 else 1
+            else:
+                counts = shared.count_history.tail(300)
+                x, step = np.arange(len(counts)), 1
 
             # --- Prepare data ---
-            counts = np.array(counts, dtype=float)
+            counts = counts.astype(float)
             counts[counts < 0] = 0
 
-            x = list(range(len(counts)))
+            x = x.tolist()
 
             # --- Log mode ---
             if self.checkbox_log.isChecked():
@@ -360,10 +364,10 @@ class Tab4(QWidget):
             self._curve_counts.setData(x, counts.tolist())
 
             # --- Rolling average ---
-            n = max(1, int(self.sum_n))
+            n = max(1, int(round(int(self.sum_n) / step)))     # seconds -> points
             if n > 1 and len(counts) >= n:
                 rolling_avg = np.convolve(counts, np.ones(n)/n, mode="valid")
-                x_avg = list(range(n - 1, len(counts)))
+                x_avg = x[n - 1:]
                 self._curve_avg.setData(x_avg, rolling_avg.tolist())
                 self._curve_avg.show()
             else:
@@ -371,7 +375,7 @@ class Tab4(QWidget):
 
             # --- Title and x range ---
             self.plot_widget.setTitle(f"Count Rate — {filename}")
-            self.plot_widget.setXRange(0, max(300, len(counts)), padding=0)
+            self.plot_widget.setXRange(0, max(300, (x[-1] + step) if x else 0), padding=0)
 
         except Exception as e:
             logger.error(f"❌ update_plot error: {e}")
@@ -0,0 +1,9 @@
+# tests/conftest.py
+#
+# The modules live at the repository root and shared must not load Qt.
+
+import os
+import sys
+
+os.environ.setdefault("IMPULSEQT_HEADLESS", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,40 @@
+# tests/test_nuclide_id.py
+#
+# A pure Cs-137 spectrum must come back as cs137 alone: not as a look-alike
+# near 662 keV (sb124de, cs132), and not with nuclides whose strongest lines
+# are K x-rays riding on the Ba K bump.
+
+import numpy as np
+import pytest
+
+import shared
+import nuclide_id
+
+
+def cs137_spectrum(bins, kev_per_ch, amplitude, xray=0.0, background=0.0, seed=1):
+    """Poisson counts of a 7 % FWHM gaussian at 661.66 keV, optional Ba K bump and continuum."""
+    e = np.arange(bins) * kev_per_ch
+    y = np.zeros(bins)
+    for energy, height in ((661.66, amplitude), (32.0, xray * amplitude)):
+        sigma = nuclide_id.RESOLUTION_662 / 100.0 * 662.0 * np.sqrt(energy / 662.0) / 2.3548
+        y += height * np.exp(-0.5 * ((e - energy) / sigma) ** 2)
+    y += background * np.exp(-e / 400.0)
+    return np.random.default_rng(seed).poisson(y).astype(float), [0.0, kev_per_ch, 0.0]
+
+
+@pytest.fixture(autouse=True)
+def bundled_library(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared, "USER_DATA_DIR", tmp_path)
+    yield
+
+
+@pytest.mark.parametrize("bins, kev_per_ch, scale", [(8192, 0.37, 1), (1024, 2.95, 8)])
+@pytest.mark.parametrize("amplitude", [300, 3000, 30000])
+@pytest.mark.parametrize("xray, background", [(0.0, 0.0), (0.0, 50.0), (0.4, 50.0)])
+def test_pure_cs137(bins, kev_per_ch, scale, amplitude, xray, background):
+    y, coeffs = cs137_spectrum(bins, kev_per_ch, amplitude * scale, xray, background * scale)
+    found = nuclide_id.Identifier().identify(y, coeffs)
+
+    assert found and found[0]["nuclide"] == "cs137"
+    assert found[0]["confidence"] > 0.99
+    assert [r["nuclide"] for r in found[1:] if r["confidence"] >= 0.5] == []
@@ -3,57 +3,33 @@ import numpy as np
 from pathlib import Path
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-from qt_compat import QDialog, QVBoxLayout
+from qt_compat import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QComboBox, QPushButton, QIntValidator
 from shared import DARK_BLUE
-import json
 import matplotlib.pyplot as plt
+import waterfall_mmap
+import calibration
+
+DISPLAY_ROWS = 1000         # heatmap rows drawn; longer ranges are decimated
 
 def load_full_hmp_from_json(path: Path, fallback_t_interval: int):
-    with open(path, "r") as jf:
-        data = json.load(jf)
-
-    if not (isinstance(data, dict)
-            and "data" in data
-            and isinstance(data["data"], list)
-            and data["data"]
-            and "resultData" in data["data"][0]):
-        raise ValueError("Unexpected JSON structure — not NPESv2 format")
-
-    result      = data["data"][0]["resultData"]
-    energy_spec = result["energySpectrum"]
-    hist_data   = energy_spec["spectrum"]
-    bins        = energy_spec.get("numberOfChannels", len(hist_data[0]) if hist_data else 0)
-    npes_coeffs = energy_spec.get("energyCalibration", {}).get("coefficients", [0, 1, 0])
-
-    # NPES [c3,c2,c1] -> internal [c1,c2,c3]
-    coeffs = [
-        npes_coeffs[2] if len(npes_coeffs) > 2 else 0.0,
-        npes_coeffs[1] if len(npes_coeffs) > 1 else 1.0,
-        npes_coeffs[0] if len(npes_coeffs) > 0 else 0.0,
-    ]
-
-    total_secs  = energy_spec.get("measurementTime", None)
-    T           = len(hist_data)
-    if total_secs and T > 1:
-        t_interval = max(1, int(round(total_secs / T)))
-    else:
-        t_interval = int(fallback_t_interval)
-
-    Z = np.zeros((T, bins), dtype=float)
-    for i, r in enumerate(hist_data):
-        if len(r) >= bins:
-            Z[i, :] = r[:bins]
-        elif len(r) > 0:
-            Z[i, :len(r)] = r
-
-    x_axis = np.arange(bins)
-    return Z, x_axis, coeffs, t_interval
+    """
+    Returns (wm, x_axis, coeffs, t_interval). wm is the WaterfallMap of the
+    recording (rows = intervals). Opening may build the .wfb first, so call
+    this off the UI thread.
+    """
+    wm = waterfall_mmap.open_map(path)
+    if wm is None:
+        raise ValueError(f"No 3D recording found for {Path(path).name}")
+
+    t_interval = wm.t_interval or int(fallback_t_interval)
+    x_axis = np.arange(wm.bins)
+    return wm, x_axis, wm.coeffs, t_interval
 
 class FullRecordingDialog(QDialog):
     def __init__(
         self,
         parent,
-        Z,
+        wm,
         x_axis,
         coeffs,
         t_interval,
@@ -75,21 +51,87 @@ class FullRecordingDialog(QDialog):
         self.setModal(True)
         self.setMinimumSize(1200, 800)
 
+        self.wm          = wm
+        self.coeffs      = coeffs
+        self.t_interval  = max(1, int(t_interval))
+        self.filename    = filename
+        self.opts = dict(
+            cal_switch=cal_switch, log_switch=log_switch, epb_switch=epb_switch,
+            hist_view=hist_view, y_fixed=y_fixed, y_max_user=y_max_user,
+            smooth_on=smooth_on, smooth_win=smooth_win,
+            fill_under_trace=fill_under_trace, line_color=line_color,
+        )
+        duration = wm.n_rows * self.t_interval
+
         layout = QVBoxLayout(self)
-        fig = Figure(facecolor=DARK_BLUE)
-        canvas = FigureCanvas(fig)
-        ax = fig.add_subplot(111, facecolor="#0b1d38")
-        layout.addWidget(canvas)
+
+        # time range and row reduction
+        controls = QHBoxLayout()
+        self.t0_edit = QLineEdit("0")
+        self.t1_edit = QLineEdit(str(duration))
+        for edit in (self.t0_edit, self.t1_edit):
+            edit.setValidator(QIntValidator(0, max(0, duration)))
+            edit.setMaximumWidth(90)
+        self.reduce_box = QComboBox()
+        self.reduce_box.addItem("Sum rows", "sum")
+        self.reduce_box.addItem("Max rows", "max")
+        apply_btn = QPushButton("Apply")
+        apply_btn.clicked.connect(self._redraw)
+        controls.addWidget(QLabel("From (s)"))
+        controls.addWidget(self.t0_edit)
+        controls.addWidget(QLabel("To (s)"))
+        controls.addWidget(self.t1_edit)
+        controls.addWidget(self.reduce_box)
+        controls.addWidget(apply_btn)
+        self.info_label = QLabel("")
+        controls.addWidget(self.info_label)
+        controls.addStretch(1)
+        layout.addLayout(controls)
+
+        self.fig    = Figure(facecolor=DARK_BLUE)
+        self.canvas = FigureCanvas(self.fig)
+        layout.addWidget(self.canvas)
+
+        self._redraw()
+
+    def _time_range(self):
+        def value(edit, default):
+            try:
+                return int(edit.text())
+            except ValueError:
+                return default
+        t0 = value(self.t0_edit, 0)
+        t1 = value(self.t1_edit, self.wm.n_rows * self.t_interval)
+        return min(t0, t1), max(t0, t1)
+
+    def _redraw(self):
+        t0, t1 = self._time_range()
+        i0, i1 = self.wm.time_range(t0, t1, self.t_interval)
+        self.fig.clear()
+        ax = self.fig.add_subplot(111, facecolor="#0b1d38")
+        self._draw(ax, i0, i1, self.reduce_box.currentData(), **self.opts)
+        self.canvas.draw()
+
+    def _draw(self, ax, i0, i1, how, cal_switch, log_switch, epb_switch, hist_view, y_fixed,
+              y_max_user, smooth_on, smooth_win, fill_under_trace, line_color):
+        fig, filename, coeffs, t_interval = self.fig, self.filename, self.coeffs, self.t_interval
 
         # ---------- common prep ----------
-        M = Z.copy()
+        # the histogram view needs only the last row of the range; the
+        # heatmap is reduced to DISPLAY_ROWS rows while the map is read
+        if hist_view:
+            M, step = np.asarray(self.wm.rows(max(i0, i1 - 1), i1), dtype=float), 1
+        else:
+            M, step = self.wm.decimate(i0, i1, DISPLAY_ROWS, how)
+        if not len(M):
+            M = np.zeros((1, self.wm.bins))
         bins = M.shape[1]
         bin_indices = np.arange(bins)
 
         # X axis (bin or calibrated energy)
         x = bin_indices.astype(float)
         if cal_switch:
-            x = coeffs[0] * bin_indices**2 + coeffs[1] * bin_indices + coeffs[2]
+            x = calibration.for_coeffs(coeffs, bins).energies
 
         # ---------- HISTOGRAM VIEW (last row) ----------
         if hist_view:
@@ -170,8 +212,10 @@ class FullRecordingDialog(QDialog):
                 M = np.log10(M)
 
             T = M.shape[0]
-            y_axis = np.arange(T) * max(1, int(t_interval))
+            y_axis = (i0 + np.arange(T) * step) * t_interval
             y_min, y_max = float(y_axis.min()), float(y_axis.max())
+            self.info_label.setText(
+                f"{i1 - i0} rows" + (f", {step} per display row ({how})" if step > 1 else ""))
             if y_min == y_max:
                 y_min -= 0.5
                 y_max += 0.5
@@ -206,5 +250,3 @@ class FullRecordingDialog(QDialog):
         ax.grid(True, color="white", alpha=0.2)
         for spine in ax.spines.values():
             spine.set_color("white")
-
-        canvas.draw()
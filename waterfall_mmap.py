@@ -0,0 +1,367 @@
+# waterfall_mmap.py
+#
+# Binary waterfall container for random access to long 3D recordings.
+#
+# {filename}_hmp.wfb is built once from the .jsonl store or the NPESv2
+# _hmp.json (whichever load_hmp would use) and rebuilt when that source is
+# newer. The maps are a cache in USER_DATA_DIR/.wfb_cache, not part of the
+# recording: each open marks its map as used, and after a build the least
+# recently used maps are removed until the cache fits shared.wfb_cache_mb.
+# Layout:
+#
+#   [0:8]        magic b"IMPWFB1\0"
+#   [8:12]       <u4 length of the JSON header
+#   [12:...]     JSON header (bins, rows, t_interval, coefficients, ...)
+#   [HEADER_SIZE]           rows  : (rows, bins) <u4 counts
+#   [gps_offset]            gps   : (rows, 3)    <f8 lat, lon, t (NaN = none)
+#
+# WaterfallMap opens both regions with np.memmap, so views, CSV export and
+# ROI sums only page in the rows they touch.
+
+import os
+import json
+import struct
+import hashlib
+
+import numpy as np
+
+from pathlib import Path
+
+import shared
+import jsonio
+import roi_stats
+import snip
+import waterfall_store
+from shared import logger
+
+MAGIC       = b"IMPWFB1\0"
+HEADER_SIZE = 4096
+ROW_DTYPE   = np.dtype("<u4")
+GPS_DTYPE   = np.dtype("<f8")
+CHUNK_ROWS  = 1024
+CACHE_DIR   = ".wfb_cache"
+COUNT_MAX   = np.iinfo(ROW_DTYPE).max
+
+
+def wfb_name(name):
+    """'foo', 'foo_hmp.json', ... -> 'foo_hmp.wfb'"""
+    return waterfall_store.json_path(name, ".").with_suffix(".wfb").name
+
+def cache_dir():
+    return Path(shared.USER_DATA_DIR) / CACHE_DIR
+
+def wfb_path(name, folder=None):
+    """Cache file for recording `name` in `folder` (tagged by folder, so equal names don't collide)."""
+    src_dir = Path(folder or shared.USER_DATA_DIR).resolve()
+    tag     = hashlib.sha1(str(src_dir).encode("utf-8")).hexdigest()[:8]
+    return cache_dir() / f"{Path(wfb_name(name)).stem}-{tag}.wfb"
+
+
+def prune_cache(keep=None, limit_mb=None):
+    """Remove the least recently used maps until the cache fits. Returns bytes removed."""
+    limit = int(shared.wfb_cache_mb if limit_mb is None else limit_mb) << 20
+    try:
+        files = [(p.stat(), p) for p in cache_dir().glob("*.wfb")]
+    except OSError:
+        return 0
+    total, removed = sum(st.st_size for st, _ in files), 0
+    for st, p in sorted(files, key=lambda f: f[0].st_mtime):
+        if total <= limit:
+            break
+        if keep is not None and p == Path(keep):
+            continue
+        try:
+            os.remove(p)
+        except OSError:
+            continue            # still mapped elsewhere (Windows)
+        total   -= st.st_size
+        removed += st.st_size
+    if removed:
+        logger.info(f"   ✅ waterfall cache: removed {removed >> 20} MB")
+    return removed
+
+
+def _remove_legacy(json_path):
+    """Drop a .wfb that older versions built next to the recording."""
+    old = Path(json_path).parent / wfb_name(Path(json_path).name)
+    try:
+        old.unlink()
+        logger.info(f"   ✅ Removed {old.name} (maps now live in {CACHE_DIR})")
+    except OSError:
+        pass
+
+
+def _source_for(json_path):
+    """The file load_hmp() would read for this recording, or None."""
+    p     = Path(json_path)
+    store = waterfall_store.jsonl_path(p.name, p.parent)
+    if store.exists() and (not p.exists() or store.stat().st_mtime > p.stat().st_mtime):
+        return store
+    return p if p.exists() else None
+
+
+def _gps_triplet(g):
+    if isinstance(g, dict):
+        lat, lon, t = g.get("lat"), g.get("lon"), g.get("t", g.get("epoch"))
+    elif isinstance(g, (list, tuple)) and len(g) >= 2:
+        lat, lon, t = g[0], g[1], (g[2] if len(g) > 2 else None)
+    else:
+        return (np.nan, np.nan, np.nan)
+    out = []
+    for v in (lat, lon, t):
+        try:
+            out.append(float(v) if v is not None else np.nan)
+        except (TypeError, ValueError):
+            out.append(np.nan)
+    return tuple(out)
+
+
+def _source_rows(src):
+    """(meta, row iterator, gps list) from a .jsonl store or an NPESv2 json."""
+    if src.suffix == ".jsonl":
+        hdr, ck, gps, n = waterfall_store.read_meta(src)
+        meta = {
+            "name":            hdr.get("name", ""),
+            "deviceName":      hdr.get("deviceName", ""),
+            "startTime":       hdr.get("startTime", ""),
+            "endTime":         ck.get("endTime", ""),
+            "coefficients":    hdr.get("coefficients", [0, 1, 0]),
+            "t_interval":      int(hdr.get("t_interval", 0) or 0),
+            "bins":            int(ck.get("numberOfChannels") or ck.get("_bins") or 0),
+            "validPulseCount": ck.get("validPulseCount", 0),
+            "measurementTime": ck.get("measurementTime", 0),
+        }
+        return meta, waterfall_store.iter_sparse_rows(src), gps
+
+    data = jsonio.load(src)
+    if not (isinstance(data, dict) and data.get("data") and "resultData" in data["data"][0]):
+        raise ValueError("Unexpected JSON structure — not NPESv2 format")
+    d    = data["data"][0]
+    res  = d["resultData"]
+    es   = res["energySpectrum"]
+    rows = es.get("spectrum", []) or []
+    meta = {
+        "name":            d.get("sampleInfo", {}).get("name", ""),
+        "deviceName":      d.get("deviceData", {}).get("deviceName", ""),
+        "startTime":       res.get("startTime", ""),
+        "endTime":         res.get("endTime", ""),
+        "coefficients":    es.get("energyCalibration", {}).get("coefficients", [0, 1, 0]),
+        "t_interval":      0,      # not stored in NPESv2, inferred on open
+        "bins":            int(es.get("numberOfChannels") or (len(rows[0]) if rows else 0)),
+        "validPulseCount": es.get("validPulseCount", 0),
+        "measurementTime": es.get("measurementTime", 0),
+    }
+    return meta, iter(rows), es.get("gps", []) or []
+
+
+def build(json_path, out_path=None):
+    """Convert a recording to .wfb in one streamed pass. Returns the .wfb path or None."""
+    src = _source_for(json_path)
+    if src is None:
+        logger.warning(f"👆 No 3D recording for {json_path}")
+        return None
+    dst = Path(out_path) if out_path else wfb_path(Path(json_path).name, Path(json_path).parent)
+    tmp = dst.with_name(dst.name + ".part")
+
+    try:
+        meta, rows, gps = _source_rows(src)
+        bins = meta["bins"]
+        buf  = None
+        n    = 0
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(b"\0" * HEADER_SIZE)
+            for r in rows:
+                if not bins:
+                    bins = len(r)
+                if buf is None:
+                    buf = np.zeros(bins, dtype=np.int64)
+                else:
+                    buf[:] = 0
+                if isinstance(r, waterfall_store.SparseRow):
+                    r.into(buf)
+                elif len(r):
+                    k = min(len(r), bins)
+                    buf[:k] = np.asarray(r[:k], dtype=np.float64)
+                # negative deltas (device resets) would wrap in <u4
+                f.write(np.clip(buf, 0, COUNT_MAX).astype(ROW_DTYPE).tobytes())
+                n += 1
+
+            gps_offset = HEADER_SIZE + n * bins * ROW_DTYPE.itemsize
+            g = np.full((n, 3), np.nan, dtype=GPS_DTYPE)
+            for i, row in enumerate(gps[:n]):
+                g[i] = _gps_triplet(row)
+            f.write(g.tobytes())
+
+            t_interval = meta["t_interval"]
+            if not t_interval and meta["measurementTime"] and n > 1:
+                t_interval = max(1, int(round(meta["measurementTime"] / n)))
+
+            header = dict(meta, rows=n, bins=bins, t_interval=t_interval,
+                          dtype=ROW_DTYPE.str, gps_offset=gps_offset,
+                          source=src.name)
+            blob = json.dumps(header, separators=(",", ":")).encode("utf-8")
+            if 12 + len(blob) > HEADER_SIZE:
+                raise ValueError("waterfall header too large")
+            f.seek(0)
+            f.write(MAGIC + struct.pack("<I", len(blob)) + blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, dst)
+        logger.info(f"   ✅ Built {dst.name} ({n} rows x {bins} bins)")
+        return dst
+    except Exception as e:
+        logger.error(f"  ❌ waterfall build failed {dst}: {e}")
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return None
+
+
+def _read_header(path):
+    with open(path, "rb") as f:
+        head = f.read(HEADER_SIZE)
+    if head[:8] != MAGIC:
+        raise ValueError(f"{path} is not a waterfall container")
+    (length,) = struct.unpack("<I", head[8:12])
+    return json.loads(head[12:12 + length].decode("utf-8"))
+
+
+class WaterfallMap:
+    """
+    Read-only memory-mapped view of one recording. Row slices are numpy views
+    onto the file; nothing is read until it is touched.
+    """
+
+    def __init__(self, path):
+        self.path   = Path(path)
+        self.header = _read_header(self.path)
+        self.bins   = int(self.header["bins"])
+        self.n_rows = int(self.header["rows"])
+        self.t_interval = int(self.header.get("t_interval") or 0)
+
+        shape = (self.n_rows, self.bins)
+        if self.n_rows and self.bins:
+            self.data = np.memmap(self.path, dtype=self.header.get("dtype", ROW_DTYPE.str),
+                                  mode="r", offset=HEADER_SIZE, shape=shape)
+            self.gps  = np.memmap(self.path, dtype=GPS_DTYPE, mode="r",
+                                  offset=int(self.header["gps_offset"]), shape=(self.n_rows, 3))
+        else:
+            self.data = np.zeros(shape, dtype=ROW_DTYPE)
+            self.gps  = np.zeros((self.n_rows, 3), dtype=GPS_DTYPE)
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def coeffs(self):
+        """Internal order [c1, c2, c3] from the stored NPES [c3, c2, c1]."""
+        c = list(self.header.get("coefficients") or [0, 1, 0])
+        return [
+            c[2] if len(c) > 2 else 0.0,
+            c[1] if len(c) > 1 else 1.0,
+            c[0] if len(c) > 0 else 0.0,
+        ]
+
+    def rows(self, i0=0, i1=None):
+        """Rows i0..i1-1 as a memmap view."""
+        return self.data[i0:i1]
+
+    def time_range(self, t0=None, t1=None, t_interval=None):
+        """Row index range [i0, i1) covering seconds t0..t1 from the start."""
+        dt = max(1, int(t_interval or self.t_interval or 1))
+        i0 = 0 if t0 is None else max(0, int(t0 // dt))
+        i1 = self.n_rows if t1 is None else min(self.n_rows, int(t1 // dt) + 1)
+        return i0, max(i0, i1)
+
+    def slice_time(self, t0=None, t1=None, t_interval=None):
+        i0, i1 = self.time_range(t0, t1, t_interval)
+        return self.data[i0:i1]
+
+    def iter_chunks(self, i0=0, i1=None, chunk=CHUNK_ROWS):
+        """Yield (start, block) with blocks of at most `chunk` rows."""
+        i1 = self.n_rows if i1 is None else min(i1, self.n_rows)
+        for a in range(i0, i1, chunk):
+            yield a, self.data[a:min(a + chunk, i1)]
+
+    def decimate(self, i0=0, i1=None, max_rows=1000, how="sum"):
+        """
+        Rows i0..i1-1 reduced to at most `max_rows` display rows, each the sum
+        (or channel-wise max, how="max") of `step` consecutive rows. Reads the
+        map in chunks; returns (float32 array (rows, bins), step).
+        """
+        i1   = self.n_rows if i1 is None else min(i1, self.n_rows)
+        n    = max(0, i1 - i0)
+        step = max(1, -(-n // max(1, int(max_rows))))
+        out  = np.zeros((-(-n // step), self.bins), dtype=np.float32)
+        ufunc = np.maximum if how == "max" else np.add
+        chunk = step * max(1, CHUNK_ROWS // step)        # chunks hold whole display rows
+        for a, block in self.iter_chunks(i0, i1, chunk):
+            k = (a - i0) // step
+            r = ufunc.reduceat(block, np.arange(0, len(block), step), axis=0)
+            out[k:k + len(r)] = r
+        return out, step
+
+    def row_totals(self, i0=0, i1=None):
+        out = np.empty(max(0, (self.n_rows if i1 is None else i1) - i0), dtype=np.int64)
+        for a, block in self.iter_chunks(i0, i1):
+            out[a - i0:a - i0 + len(block)] = block.sum(axis=1, dtype=np.int64)
+        return out
+
+    def roi_sums(self, ranges, i0=0, i1=None, net=False):
+        """
+        Counts per row inside each inclusive channel range, shape (rows, len(ranges)).
+        Uses a per-chunk prefix sum, so any number of ROIs costs one pass.
+        With net=True each row's SNIP background is subtracted first.
+        """
+        i1 = self.n_rows if i1 is None else min(i1, self.n_rows)
+        out = np.zeros((max(0, i1 - i0), len(ranges)), dtype=np.int64)
+        if not ranges or not self.bins:
+            return out
+        for a, block in self.iter_chunks(i0, i1):
+            if net:
+                block = snip.net(block, cached=False)
+            out[a - i0:a - i0 + len(block)] = roi_stats.roi_sums(block, ranges)
+        return out
+
+    def gps_rows(self, i0=0, i1=None):
+        """GPS as the dicts the rest of the app uses ({"lat", "lon", "t"}, None for missing)."""
+        out = []
+        for lat, lon, t in np.asarray(self.gps[i0:i1]):
+            out.append({
+                "lat": None if np.isnan(lat) else float(lat),
+                "lon": None if np.isnan(lon) else float(lon),
+                "t":   None if np.isnan(t) else int(t),
+            })
+        return out
+
+
+def open_map(json_path, out_path=None):
+    """
+    Open the .wfb for a recording, building or rebuilding it first when the
+    .jsonl / _hmp.json source is newer. The .wfb goes to the cache unless
+    out_path names another place (not pruned). Returns None if there is no
+    recording.
+    """
+    p   = Path(json_path)
+    wfb = Path(out_path) if out_path else wfb_path(p.name, p.parent)
+    src = _source_for(p)
+    if src is None and not wfb.exists():
+        return None
+    if not wfb.exists() or (src is not None and src.stat().st_mtime > wfb.stat().st_mtime):
+        if build(p, wfb) is None:
+            return None
+        if out_path is None:
+            prune_cache(keep=wfb)
+            _remove_legacy(p)
+    elif out_path is None:
+        try:
+            os.utime(wfb)       # most recently used
+        except OSError:
+            pass
+    try:
+        return WaterfallMap(wfb)
+    except Exception as e:
+        logger.error(f"  ❌ waterfall open failed {wfb}: {e}")
+        return None
@@ -0,0 +1,550 @@
+# waterfall_store.py
+#
+# Append-only store for 3D (waterfall) recordings.
+#
+# A recording is written to {filename}_hmp.jsonl as JSON Lines:
+#
+#   {"hdr": {...}}                      first line, written once
+#   {"s": {n, i, c}, "g": {lat, lon, t}} one line per waterfall row (sparse)
+#   {"ck": {...}}                       after every checkpoint (counts, elapsed, endTime)
+#
+# and {filename}_hmp.idx gets one "rows,offset" line per checkpoint, so a torn
+# tail after a crash can be found and cut off. Each checkpoint only writes the
+# rows added since the last one, so the cost per checkpoint is constant.
+#
+# A checkpoint is taken in two steps: cut() runs on the recording thread and
+# moves the buffered rows, together with the counts and elapsed time that
+# belong to them, into one snapshot; flush() runs on the save thread and
+# writes the snapshots. Only flush() touches the disk, and it does so
+# without holding the lock append() takes, so acquisition never waits for
+# an fsync.
+#
+# The NPESv2 {filename}_hmp.json is produced by export_npes() (streamed, rows
+# are never all held in memory) and load_hmp() reads either format. When a
+# recording is closed and its export reads back complete, the .jsonl and
+# .idx are removed, so a finished run is one _hmp.json as before.
+#
+# Rows are kept sparse (SparseRow: channel index / count pairs) in memory, in
+# the store and in the shared.histogram_hmp UI ring; most 1 s rows at 4096+
+# channels are almost all zeros. Dense arrays are only built for the rows a
+# view actually draws (dense_matrix) and for the NPESv2 export.
+
+import os
+import json
+import bisect
+import threading
+
+import numpy as np
+
+from array import array
+from collections import deque
+from pathlib import Path
+from datetime import datetime
+
+import shared
+import checkpoint
+import jsonio
+from shared import logger
+
+STORE_VERSION = "IMPWF1"
+_TS_FMT       = "%Y-%m-%dT%H:%M:%S+00:00"
+
+
+def _stem(name):
+    """'foo', 'foo_hmp', 'foo_hmp.json' -> 'foo'"""
+    s = Path(str(name)).name
+    for sfx in (".jsonl", ".json", ".idx"):
+        if s.endswith(sfx):
+            s = s[: -len(sfx)]
+    return s.removesuffix("_hmp")
+
+def jsonl_path(name, folder=None):
+    return Path(folder or shared.USER_DATA_DIR) / f"{_stem(name)}_hmp.jsonl"
+
+def idx_path(name, folder=None):
+    return Path(folder or shared.USER_DATA_DIR) / f"{_stem(name)}_hmp.idx"
+
+def json_path(name, folder=None):
+    return Path(folder or shared.USER_DATA_DIR) / f"{_stem(name)}_hmp.json"
+
+def _ts(dt):
+    if isinstance(dt, datetime):
+        return dt.strftime(_TS_FMT)
+    return dt or ""
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(",", ":"))
+
+
+# ------------------------------------------------------------
+# Sparse rows
+# ------------------------------------------------------------
+class SparseRow:
+    """
+    Non-zero channels of one waterfall row. Behaves like a read-only list of
+    length n (len, iteration, indexing and slicing give dense values), so code
+    written for list rows keeps working; use dense()/sum_range() directly when
+    it matters.
+    """
+
+    __slots__ = ("n", "idx", "val")
+
+    def __init__(self, n, idx=None, val=None):
+        self.n   = int(n)
+        self.idx = idx if idx is not None else array('I')
+        self.val = val if val is not None else array('q')
+
+    @classmethod
+    def from_dense(cls, row):
+        if isinstance(row, SparseRow):
+            return row
+        idx = array('I')
+        val = array('q')
+        for i, v in enumerate(row):
+            if v:
+                idx.append(i)
+                val.append(int(v))
+        return cls(len(row), idx, val)
+
+    @classmethod
+    def from_json(cls, obj):
+        """{"n": bins, "i": [first, gap, gap, ...], "c": [counts]}"""
+        idx, acc = array('I'), 0
+        for k, d in enumerate(obj.get("i", [])):
+            acc = d if k == 0 else acc + d
+            idx.append(acc)
+        return cls(obj.get("n", 0), idx, array('q', obj.get("c", [])))
+
+    def to_json(self):
+        gaps = [self.idx[0]] + [self.idx[k] - self.idx[k - 1] for k in range(1, len(self.idx))] if self.idx else []
+        return {"n": self.n, "i": gaps, "c": self.val.tolist()}
+
+    def dense(self, bins=None):
+        out = [0] * (self.n if bins is None else int(bins))
+        lim = len(out)
+        for i, v in zip(self.idx, self.val):
+            if i < lim:
+                out[i] = v
+        return out
+
+    def into(self, target):
+        """Write counts into a preallocated numpy row (zeroed by the caller)."""
+        if self.idx:
+            idx = np.frombuffer(self.idx, dtype=np.uint32)
+            val = np.frombuffer(self.val, dtype=np.int64)
+            keep = idx < target.shape[0]
+            target[idx[keep]] = val[keep]
+
+    def total(self):
+        return sum(self.val)
+
+    def sum_range(self, i0, i1):
+        """Sum of channels i0..i1 inclusive."""
+        a = bisect.bisect_left(self.idx, i0)
+        b = bisect.bisect_right(self.idx, i1)
+        return sum(self.val[a:b])
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.dense())
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self.dense()[k]
+        if k < 0:
+            k += self.n
+        j = bisect.bisect_left(self.idx, k)
+        return self.val[j] if j < len(self.idx) and self.idx[j] == k else 0
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"SparseRow(n={self.n}, nnz={len(self.idx)})"
+
+
+def dense_matrix(rows, bins):
+    """Rebuild a dense (len(rows), bins) float array for the rows being displayed."""
+    Z = np.zeros((len(rows), int(bins)), dtype=float)
+    for i, r in enumerate(rows):
+        if isinstance(r, SparseRow):
+            r.into(Z[i])
+        elif r is not None and len(r):
+            n = min(len(r), bins)
+            Z[i, :n] = r[:n]
+    return Z
+
+
+class WaterfallStore:
+    """
+    Writer for one recording. append() buffers rows in memory, cut() turns
+    them into a checkpoint snapshot and flush() writes the snapshots;
+    checkpoint() does both. close() writes the rest and (by default) exports
+    NPESv2.
+    """
+
+    def __init__(self, filename, device="", coeffs=None, dt_start=None,
+                 t_interval=1, sn=None, folder=None):
+        self.filename   = _stem(filename)
+        self.folder     = Path(folder or shared.USER_DATA_DIR)
+        self.path       = jsonl_path(self.filename, self.folder)
+        self.idx        = idx_path(self.filename, self.folder)
+        self._lock      = threading.Lock()      # _pending, _cuts
+        self._io_lock   = threading.Lock()      # file writes
+        self._pending   = []
+        self._cuts      = []         # [(rows, ck)] waiting for flush()
+        self._cut_rows  = 0          # rows in cuts so far
+        self.rows       = 0          # rows on disk
+        self.bytes      = 0
+        self.bins       = 0
+
+        if sn is None:
+            with shared.write_lock:
+                sn = shared.serial_number
+
+        self.header = {
+            "schemaVersion": STORE_VERSION,
+            "name":          self.filename,
+            "deviceName":    f"{device}{sn or ''}",
+            "startTime":     _ts(dt_start or datetime.now()),
+            "coefficients":  list(coeffs or [0, 1, 0]),     # NPES order [c3, c2, c1]
+            "t_interval":    int(t_interval or 1),
+        }
+
+        # fresh recording: truncate both files
+        with open(self.path, "w") as f:
+            f.write(_dumps({"hdr": self.header}) + "\n")
+        with open(self.idx, "w") as f:
+            f.write("rows,offset\n")
+        self.bytes = os.path.getsize(self.path)
+
+    @classmethod
+    def reopen(cls, filename, folder=None, bins=None):
+        """
+        Continue an interrupted recording. The .jsonl is cut back to the last
+        checkpoint listed in the .idx (rows after it were never confirmed) and
+        new rows are appended from there. Returns (store, last checkpoint
+        dict), or (None, {}) if there is no usable store or its checkpoint has
+        a channel count other than `bins`; the file is left untouched then.
+        """
+        path = jsonl_path(filename, folder)
+        idx  = idx_path(filename, folder)
+        try:
+            size = os.path.getsize(path)
+            with open(path, "rb") as f:
+                first = f.readline()
+            header = json.loads(first)["hdr"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"  ❌ Cannot resume {path.name}: {e}")
+            return None, {}
+
+        rows, offset = 0, len(first)
+        try:
+            with open(idx, "r") as f:
+                next(f, None)
+                for line in f:
+                    r, _, o = line.strip().partition(",")
+                    if r.isdigit() and o.isdigit() and int(o) <= size:
+                        rows, offset = int(r), int(o)
+        except OSError:
+            pass
+
+        with open(path, "rb") as f:
+            f.seek(max(len(first), offset - 4096))
+            tail = f.read(offset - f.tell()).splitlines()
+        ck = {}
+        if tail:
+            try:
+                ck = json.loads(tail[-1]).get("ck", {})
+            except ValueError:
+                ck = {}
+        have = int(ck.get("numberOfChannels", 0) or 0)
+        if bins is not None and have and have != int(bins):
+            logger.error(f"  ❌ Cannot resume {path.name}: {have} channels, recording uses {int(bins)}")
+            return None, {}
+
+        with open(path, "r+b") as f:
+            f.truncate(offset)
+
+        store = cls.__new__(cls)
+        store.filename  = _stem(filename)
+        store.folder    = Path(folder or shared.USER_DATA_DIR)
+        store.path      = path
+        store.idx       = idx
+        store._lock     = threading.Lock()
+        store._io_lock  = threading.Lock()
+        store._pending  = []
+        store._cuts     = []
+        store._cut_rows = rows
+        store.rows      = rows
+        store.bytes     = offset
+        store.bins      = int(ck.get("numberOfChannels", 0) or 0)
+        store.header    = header
+
+        with open(idx, "w") as f:
+            f.write(f"rows,offset\n{rows},{offset}\n")
+        return store, ck
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def append(self, row, gps=None):
+        row = SparseRow.from_dense(row)
+        with self._lock:
+            if not self.bins:
+                self.bins = len(row)
+            self._pending.append((row, gps or {"lat": None, "lon": None, "t": None}))
+
+    def cut(self, counts=0, elapsed=0, dt_now=None):
+        """
+        Close a checkpoint on the recording thread: the rows appended so far
+        and the counts, elapsed time and end time that go with them become
+        one snapshot for flush(). No file I/O.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._cut_rows += len(pending)
+            self._cuts.append((pending, {
+                "rows":             self._cut_rows,
+                "numberOfChannels": self.bins,
+                "validPulseCount":  int(counts),
+                "measurementTime":  int(elapsed),
+                "endTime":          _ts(dt_now or datetime.now()),
+            }))
+
+    def flush(self):
+        """
+        Write the snapshots cut so far. Returns bytes written, or None if the
+        write failed (the snapshots are kept for the next attempt).
+        """
+        with self._io_lock:
+            with self._lock:
+                cuts, self._cuts = self._cuts, []
+            if not cuts:
+                return 0
+
+            blobs = []
+            for pending, ck in cuts:
+                lines = [_dumps({"s": r.to_json(), "g": g}) for r, g in pending]
+                lines.append(_dumps({"ck": ck}))
+                blobs.append(("\n".join(lines) + "\n").encode("utf-8"))
+            try:
+                with open(self.path, "ab") as f:
+                    f.write(b"".join(blobs))
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception as e:
+                logger.error(f"  ❌ waterfall checkpoint failed {self.path}: {e}")
+                try:
+                    os.truncate(self.path, self.bytes)      # drop a partial write
+                except OSError:
+                    pass
+                with self._lock:
+                    self._cuts = cuts + self._cuts
+                return None
+
+            index = []
+            for (_, ck), blob in zip(cuts, blobs):
+                self.bytes += len(blob)
+                index.append(f"{ck['rows']},{self.bytes}\n")
+            self.rows = cuts[-1][1]["rows"]
+            try:
+                with open(self.idx, "a") as f:
+                    f.write("".join(index))
+            except OSError as e:
+                logger.error(f"  ❌ waterfall index write failed {self.idx}: {e}")
+            return sum(len(b) for b in blobs)
+
+    def checkpoint(self, counts=0, elapsed=0, dt_now=None):
+        """cut() and flush() in one call. Returns bytes written."""
+        self.cut(counts, elapsed, dt_now)
+        return self.flush() or 0
+
+    def close(self, counts=None, elapsed=0, dt_now=None, export=True):
+        """
+        Write the remaining snapshots (cutting one first when counts is
+        given) and export NPESv2. The store files are removed once the
+        export is verified; they stay if anything failed.
+        """
+        if counts is not None:
+            self.cut(counts, elapsed, dt_now)
+        if self.flush() is None or not export:
+            return
+        dst = export_npes(self.filename, folder=self.folder)
+        if dst is None or not _export_complete(dst):
+            logger.warning(f"👆 Keeping {self.path.name}: export not verified")
+            return
+        for p in (self.path, self.idx):
+            try:
+                os.remove(p)
+            except OSError as e:
+                logger.warning(f"👆 Could not remove {p.name}: {e}")
+
+
+# ------------------------------------------------------------
+# Readers
+# ------------------------------------------------------------
+def iter_records(path):
+    """Yield parsed lines, stopping quietly at a torn tail."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            try:
+                yield json.loads(line)
+            except ValueError:
+                break
+
+def read_meta(path):
+    """Header, last checkpoint and gps list (rows are skipped)."""
+    hdr, ck, gps, n, bins = {}, {}, [], 0, 0
+    for rec in iter_records(path):
+        if "s" in rec or "r" in rec:
+            gps.append(rec.get("g") or {"lat": None, "lon": None, "t": None})
+            n += 1
+            if not bins:
+                bins = rec["s"].get("n", 0) if "s" in rec else len(rec["r"])
+        elif "ck" in rec:
+            ck = rec["ck"]
+        elif "hdr" in rec:
+            hdr = rec["hdr"]
+    ck = dict(ck)
+    ck["_bins"] = bins
+    return hdr, ck, gps, n
+
+def iter_sparse_rows(path):
+    for rec in iter_records(path):
+        if "s" in rec:
+            yield SparseRow.from_json(rec["s"])
+        elif "r" in rec:                        # dense rows from early stores
+            yield SparseRow.from_dense(rec["r"])
+
+def tail_rows(path, n):
+    """Newest n rows (SparseRow) and their gps entries, for refilling the UI rings."""
+    rows, gps = deque(maxlen=int(n)), deque(maxlen=int(n))
+    for rec in iter_records(path):
+        if "s" in rec or "r" in rec:
+            rows.append(SparseRow.from_json(rec["s"]) if "s" in rec else SparseRow.from_dense(rec["r"]))
+            gps.append(rec.get("g") or {"lat": None, "lon": None, "t": None})
+    return list(rows), list(gps)
+
+def iter_rows(path):
+    """Dense rows (lists), for NPESv2 export."""
+    for row in iter_sparse_rows(path):
+        yield row.dense()
+
+def _npes_head(hdr, ck, bins):
+    return {
+        "deviceData": {"softwareName": "IMPULSE", "deviceName": hdr.get("deviceName", "")},
+        "sampleInfo": {"name": hdr.get("name", ""), "location": "", "note": ""},
+        "startTime":  hdr.get("startTime", ""),
+        "endTime":    ck.get("endTime", ""),
+        "energySpectrum": {
+            "numberOfChannels": bins,
+            "energyCalibration": {"polynomialOrder": 2, "coefficients": hdr.get("coefficients", [0, 1, 0])},
+            "validPulseCount": ck.get("validPulseCount", 0),
+            "measurementTime": ck.get("measurementTime", 0),
+        },
+    }
+
+def to_npes(path, sparse=False):
+    """Build the NPESv2 dict for a .jsonl store in memory (SparseRow rows if sparse)."""
+    hdr, ck, gps, _ = read_meta(path)
+    rows = list(iter_sparse_rows(path) if sparse else iter_rows(path))
+    bins = ck.get("numberOfChannels") or ck.get("_bins") or (len(rows[0]) if rows else 0)
+    h    = _npes_head(hdr, ck, bins)
+    es   = dict(h["energySpectrum"], spectrum=rows, gps=gps)
+    return {
+        "schemaVersion": "NPESv2",
+        "data": [{
+            "deviceData": h["deviceData"],
+            "sampleInfo": h["sampleInfo"],
+            "resultData": {"startTime": h["startTime"], "endTime": h["endTime"], "energySpectrum": es},
+        }],
+    }
+
+def export_npes(name, out_path=None, folder=None):
+    """Stream a .jsonl store into an NPESv2 _hmp.json. Returns the output path or None."""
+    src = jsonl_path(name, folder)
+    dst = Path(out_path) if out_path else json_path(name, folder)
+    if not src.exists():
+        logger.warning(f"👆 No waterfall store for {name}")
+        return None
+    try:
+        hdr, ck, gps, n = read_meta(src)
+        bins = ck.get("numberOfChannels") or ck.get("_bins") or 0
+        h    = _npes_head(hdr, ck, bins)
+        es   = h["energySpectrum"]
+
+        head = (
+            '{"schemaVersion":"NPESv2","data":[{'
+            f'"deviceData":{_dumps(h["deviceData"])},'
+            f'"sampleInfo":{_dumps(h["sampleInfo"])},'
+            f'"resultData":{{"startTime":{_dumps(h["startTime"])},"endTime":{_dumps(h["endTime"])},'
+            '"energySpectrum":{'
+            f'"numberOfChannels":{es["numberOfChannels"]},'
+            f'"energyCalibration":{_dumps(es["energyCalibration"])},'
+            f'"validPulseCount":{_dumps(es["validPulseCount"])},'
+            f'"measurementTime":{_dumps(es["measurementTime"])},'
+            f'"gps":{_dumps(gps)},'             # before the rows: readers of the header get it cheaply
+            '"spectrum":['
+        )
+        written = 0
+        with checkpoint.atomic_writer(dst, "wb") as raw:
+            with jsonio.wrap_writer(raw, "hmp") as f:
+                f.write(head)
+                for row in iter_rows(src):
+                    if written:
+                        f.write(",")
+                    f.write(_dumps(row))
+                    written += 1
+                if written != n:
+                    raise ValueError(f"{written} of {n} rows read")
+                f.write("]}}}]}")
+        logger.info(f"   ✅ Exported {dst.name}")
+        return dst
+    except Exception as e:
+        logger.error(f"  ❌ waterfall export failed {dst}: {e}")
+        return None
+
+def _export_complete(path, chunk=1 << 20):
+    """True if the exported file decodes to the end (compression checksums
+    included) and ends with the closing brackets export_npes() writes."""
+    tail = ""
+    try:
+        with jsonio.open_text(path) as f:
+            while True:
+                block = f.read(chunk)
+                if not block:
+                    break
+                tail = (tail + block)[-16:]
+    except Exception as e:
+        logger.error(f"  ❌ waterfall export check failed {path}: {e}")
+        return False
+    return tail.endswith("]}}}]}")
+
+def hmp_exists(path):
+    p = Path(path)
+    return p.exists() or jsonl_path(p.name, p.parent).exists()
+
+def load_hmp(path, sparse=False):
+    """
+    Load a 3D recording as an NPESv2 dict. `path` is the _hmp.json path; if the
+    append-only store next to it is newer (live or interrupted recording) it is
+    read instead. With sparse=True the spectrum rows are SparseRow objects.
+    """
+    p     = Path(path)
+    store = jsonl_path(p.name, p.parent)
+    if store.exists() and (not p.exists() or store.stat().st_mtime > p.stat().st_mtime):
+        return to_npes(store, sparse=sparse)
+    data = jsonio.load(p)
+    if sparse:
+        try:
+            es = data["data"][0]["resultData"]["energySpectrum"]
+            es["spectrum"] = [SparseRow.from_dense(r) for r in es.get("spectrum", []) or []]
+        except (KeyError, IndexError, TypeError):
+            pass
+    return data